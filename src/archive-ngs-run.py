@@ -13,9 +13,30 @@ from argparse import (
     RawTextHelpFormatter)
 import pathlib
 # --------------------------------------------------
+import os
 import subprocess
 import datetime
 import logging
+import shutil
+import glob
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from contextvars import ContextVar, copy_context
+# --------------------------------------------------
+import transfer
+import checksum
+import run_index
+import stages
+import phix
+import fastq_qc
+import profiling
+# --------------------------------------------------
+# archived files with the same size and a modification time within this many seconds are already correct
+MTIME_TOLERANCE: float = 2.0
+NGS_ROOT: pathlib.Path = pathlib.Path('/mnt/Z/Raw-data/NGS/')
+LOG_DIR: pathlib.Path = pathlib.Path('/mnt/data/archive/archive_logs')
+# prefix of every message logged while a run of a batch is archived, e.g. "[221210-run01_info] "
+LOG_PREFIX: ContextVar = ContextVar('log_prefix', default='')
 # --------------------------------------------------
 def get_args() -> Namespace:
     """ Get command-line arguments """
@@ -27,11 +48,31 @@ def get_args() -> Namespace:
     parser.add_argument(
         '-z',
         '--z-drive',
-        dest='z_drive_ngs_dir',
+        dest='z_drive_ngs_dirs',
+        metavar='<PATH>',
+        type=pathlib.Path,
+        nargs='+',
+        default=[],
+        help='path to NGS run directory (/path/to/NGS/run/on/Z-drive/{date}-{run}_{information}), several paths or\nglob patterns (e.g. "/mnt/Z/Raw-data/NGS/2212*") archive every run in one batch [REQUIRED unless --pending]')
+    parser.add_argument(
+        '--pending',
+        dest='pending_arg',
+        action='store_true',
+        help='also archive every run directory in the --ngs-root that isn\'t in the archive destination yet [Default: False]')
+    parser.add_argument(
+        '--ngs-root',
+        dest='ngs_root',
         metavar='<PATH>',
         type=pathlib.Path,
-        required=True,
-        help='path to NGS run directory (/path/to/NGS/run/on/Z-drive/{date}-{run}_{information}) [REQUIRED]')
+        default=NGS_ROOT,
+        help=f'NGS directory on the Z-drive, used by --resolve and --pending [Default: {NGS_ROOT}]')
+    parser.add_argument(
+        '--batch-runs',
+        dest='batch_runs',
+        metavar='<int>',
+        type=int,
+        default=1,
+        help='number of runs of a batch archived at the same time, sharing the --threads, --copy-workers and --max-rate [Default: 1]')
     parser.add_argument(
         '-d',
         '--dest',
@@ -57,6 +98,33 @@ def get_args() -> Namespace:
         dest='do_phix_arg',
         action='store_true',
         help='perform PhiX analysis on Undetermined reads [Default: False]')
+    parser.add_argument(
+        '--phiX-subsample',
+        dest='phix_subsample',
+        metavar='<fraction>',
+        type=float,
+        default=1.0,
+        help='fraction of the Undetermined read pairs aligned to estimate the PhiX content, the same reads are always picked for a --phiX-seed [Default: 1 (all)]')
+    parser.add_argument(
+        '--phiX-seed',
+        dest='phix_seed',
+        metavar='<int>',
+        type=int,
+        default=0,
+        help='seed of the --phiX-subsample [Default: 0]')
+    parser.add_argument(
+        '--phiX-reference',
+        dest='phix_reference',
+        metavar='<PATH>',
+        type=pathlib.Path,
+        default=phix.PHIX_REFERENCE,
+        help=f'PhiX reference, indexed with bwa index [Default: {phix.PHIX_REFERENCE}]')
+    parser.add_argument(
+        '--qc',
+        dest='qc_mode',
+        choices=['fastqc', 'quick', 'full'],
+        default='fastqc',
+        help='how the .fastq.gz files are checked: fastqc (and multiqc), quick (read counts, lengths, quality per cycle and N content\nwith the built-in QC, written to analysis/qc and {run}.qc.tsv, without fastqc or multiqc), or full (both) [Default: fastqc]')
     parser.add_argument(
         '--show-fastqc',
         dest='show_fastqc_arg',
@@ -80,63 +148,127 @@ def get_args() -> Namespace:
         metavar='<int>',
         type=int,
         default=32,
-        help='number of threads to run fastqc analysis [Default: 32]')
+        help='number of threads shared by the fastqc (or quick QC) and PhiX analyses (which run at the same time as the archive copy) [Default: 32]')
+    parser.add_argument(
+        '--copy-backend',
+        dest='copy_backend',
+        choices=transfer.BACKENDS,
+        default='auto',
+        help='how files are copied to the archive, falling back per file to the next one that works [Default: auto]')
+    parser.add_argument(
+        '--max-rate',
+        dest='max_rate',
+        metavar='<rate>',
+        type=transfer.parse_rate,
+        default=None,
+        help='limit on the bytes copied from the Z-drive per second, with an optional K/M/G suffix (e.g. 50M) [Default: unlimited]')
+    parser.add_argument(
+        '--copy-workers',
+        dest='copy_workers',
+        metavar='<int>',
+        type=int,
+        default=4,
+        help='number of files copied to the archive at the same time [Default: 4]')
+    parser.add_argument(
+        '--checksum',
+        dest='checksum_algorithm',
+        choices=checksum.CHECKSUM_ALGORITHMS,
+        default='md5',
+        help='algorithm the copies are verified with, blake2b is faster than md5 on 64-bit CPUs (checksum.<algorithm> is written beside the MiSeqOutput directory) [Default: md5]')
+    parser.add_argument(
+        '--checksum-workers',
+        dest='checksum_workers',
+        metavar='<int>',
+        type=int,
+        default=checksum.CHECKSUM_WORKERS,
+        help=f'number of files hashed at the same time [Default: {checksum.CHECKSUM_WORKERS}]')
+    parser.add_argument(
+        '--low-priority',
+        dest='low_priority_arg',
+        action='store_true',
+        help='run (and run fastqc/multiqc/bwa) with lowered CPU and I/O priority [Default: False]')
 
     args = parser.parse_args()
     # parser errors and processing
     # --------------------------------------------------
-    if args.resolve_arg:
-        args.z_drive_ngs_dir = pathlib.Path('/mnt/Z/Raw-data/NGS/').joinpath(args.z_drive_ngs_dir)
-    if not args.z_drive_ngs_dir.exists():
-        parser.error(f'ERROR! NGS run {args.z_drive_ngs_dir.name} ({args.z_drive_ngs_dir}) doesn\'t exist! Double-check your path!')
+    if not args.z_drive_ngs_dirs and not args.pending_arg:
+        parser.error('ERROR! Give the NGS run directories to archive (-z) or use --pending!')
+    if not 0 < args.phix_subsample <= 1:
+        parser.error(f'ERROR! --phiX-subsample must be more than 0 and at most 1, got {args.phix_subsample}.')
+    if args.batch_runs < 1:
+        parser.error(f'ERROR! --batch-runs must be at least 1, got {args.batch_runs}.')
+    z_drive_ngs_dirs = []
+    for z_drive_ngs_dir in args.z_drive_ngs_dirs:
+        if args.resolve_arg: z_drive_ngs_dir = args.ngs_root.joinpath(z_drive_ngs_dir)
+        # patterns the shell didn't expand (e.g. quoted, or with --resolve)
+        if any([character in str(z_drive_ngs_dir) for character in '*?[']):
+            matches = [pathlib.Path(match) for match in sorted(glob.glob(str(z_drive_ngs_dir))) if pathlib.Path(match).is_dir()]
+            if not matches: parser.error(f'ERROR! No NGS run matches {z_drive_ngs_dir}! Double-check your path!')
+        else: matches = [z_drive_ngs_dir]
+        for match in matches:
+            if not match.exists():
+                parser.error(f'ERROR! NGS run {match.name} ({match}) doesn\'t exist! Double-check your path!')
+            if match not in z_drive_ngs_dirs: z_drive_ngs_dirs.append(match)
+    if args.pending_arg:
+        z_drive_ngs_dirs += [run_dir for run_dir in _find_pending_runs(args.ngs_root, args.archive_dir) if run_dir not in z_drive_ngs_dirs]
+    args.z_drive_ngs_dirs = z_drive_ngs_dirs
 
     return args
 # --------------------------------------------------
-def _find_fastq_files(input_dir: pathlib.Path, dry_run_arg: bool = True) -> pathlib.Path:
+def _find_pending_runs(ngs_root: pathlib.Path, archive_dir: pathlib.Path) -> list:
+    """
+    Finds the NGS run directories ({date}-{run}_{information}) in the NGS directory that aren't in the archive yet.
+
+    Parameters:
+        ngs_root (pathlib.Path): the NGS directory on the Z-drive.
+        archive_dir (pathlib.Path): the archive destination.
+
+    Returns:
+        (list): the paths (pathlib.Path) of the run directories to archive, sorted.
+    """
+    if not ngs_root.is_dir(): return []
+    with os.scandir(ngs_root) as directory:
+        run_names = [entry.name for entry in directory if entry.is_dir() and entry.name.split('-')[0].isdigit() and '_' in entry.name]
+    return [ngs_root.joinpath(run_name) for run_name in sorted(run_names) if not archive_dir.joinpath(run_name).exists()]
+def _find_fastq_files(index: run_index.RunIndex, dry_run_arg: bool = True) -> pathlib.Path:
     """
-    Finds the directory containing FASTQ files within a specified MiSeqOutput directory.
+    Finds the directory containing FASTQ files within the MiSeqOutput directory of a run.
 
     Parameters:
-        input_dir (pathlib.Path): The directory to search for FASTQ files, the MiSeqOutput directory.
+        index (run_index.RunIndex): the index of the run directory.
         dry_run_arg (bool): optional (default=True), if True, performs a dry run without executing any operations.
 
     Returns:
         (pathlib.Path): The path to the directory containing the FASTQ files.
     """
-    command = f'find {input_dir.resolve()} -name "*.fastq.gz"'
-    result = subprocess.run(command, capture_output=True, shell=True)
-    logging.debug(f"Found fastq files in directory: '{pathlib.Path(result.stdout.decode().splitlines()[0]).parent}'.")
-    if result.stdout.decode().splitlines()[0].strip(): return pathlib.Path(result.stdout.decode().splitlines()[0]).parent
+    if index.fastq_dir:
+        logging.debug(f"Found fastq files in directory: '{index.fastq_dir}'.")
+        return index.fastq_dir
     logging.critical("Couldn't find any FASTQ files! Quitting!")
     quit()
-def _find_miseq_output(input_dir: pathlib.Path, dry_run_arg: bool = True) -> pathlib.Path:
+def _find_miseq_output(index: run_index.RunIndex, dry_run_arg: bool = True) -> pathlib.Path:
     """
     Finds specifically the MiSeqOutput directory.
 
     Parameters:
-        input_dir (pathlib.Path): The root run directory to search for the MiSeqOutput directory.
+        index (run_index.RunIndex): the index of the root run directory.
         dry_run_arg (bool): optional (default=True), if True, performs a dry run without executing any operations.
 
     Returns:
         (pathlib.Path): The path to the MiSeqOutput directory.
     """
-    logging.debug(f'Trying to find MiSeqOutput directory in {input_dir} ...')
-    dirs = [i for i in input_dir.glob('*') if (i.is_dir() and i.name not in ('analysis', 'docs'))]
-    for dir in dirs:
-        if all([
-            all([True if i in '0123456789' else False for i in dir.name.split('_')[0]]),
-            len(dir.name.split('_')) == 4,
-            len(dir.name.split('-')) == 2]):
-            logging.debug(f"Found MiSeqOutput directory: '{dir}'.")
-            return dir
+    logging.debug(f'Trying to find MiSeqOutput directory in {index.root} ...')
+    if index.miseq_output:
+        logging.debug(f"Found MiSeqOutput directory: '{index.miseq_output}'.")
+        return index.miseq_output
     logging.critical('No MiSeq output directory! Quitting!')
     quit()
-def _do_fastqc(input_dir: pathlib.Path, fastqc_out_dir: pathlib.Path, dry_run_arg: bool = True, show_fastqc_arg: bool = True, threads: int = 32) -> None:
+def _do_fastqc(index: run_index.RunIndex, fastqc_out_dir: pathlib.Path, dry_run_arg: bool = True, show_fastqc_arg: bool = True, threads: int = 32) -> None:
     """
-    Performs fastqc analysis on a given directory containing .fastq.gz files with a given number of threads. and outputs the analysis.
+    Performs fastqc analysis on the .fastq.gz files of a run with a given number of threads. and outputs the analysis.
 
     Parameters:
-        input_dir (pathlib.Path): the directory containing .fastq.gz files.
+        index (run_index.RunIndex): the index of the run directory, with the .fastq.gz files.
         fastqc_out_dir (pathlib.Path): the directory to output the fastqc analysis.
         dry_run_arg (bool): optional (default=True), if True, performs a dry run without executing any operations.
         show_fastqc_arg (bool): show the analysis progress if True, else keep this hidden.
@@ -145,11 +277,11 @@ def _do_fastqc(input_dir: pathlib.Path, fastqc_out_dir: pathlib.Path, dry_run_ar
     Returns:
         (None)
     """
-    fastq_files = [str(file) for file in input_dir.glob('*.fastq*')]
-    logging.debug(f'Found {len(fastq_files)} files to process in {input_dir}.')
+    fastq_files = [str(file) for file in index.fastq_files]
+    logging.debug(f'Found {len(fastq_files)} files to process in {_find_fastq_files(index, dry_run_arg)}.')
     logging.info(f'Running fastqc using {threads} threads ...')
     command = f'fastqc -t {threads} -o {fastqc_out_dir} ' + ' '.join(fastq_files)
-    if not dry_run_arg: subprocess.run(command, shell=True, capture_output=not show_fastqc_arg)
+    if not dry_run_arg: profiling.run_command(command, shell=True, stdout=None if show_fastqc_arg else subprocess.DEVNULL, stderr=None if show_fastqc_arg else subprocess.DEVNULL)
     return None
 def _do_multiqc(input_dir: pathlib.Path, dry_run_arg: bool = True, show_multiqc_arg = False) -> None:
     """
@@ -165,218 +297,356 @@ def _do_multiqc(input_dir: pathlib.Path, dry_run_arg: bool = True, show_multiqc_
     """
     logging.info(f'Running multiqc on fastqc analysis dir: {input_dir} ...')
     command = f'multiqc {input_dir} --interactive --outdir {input_dir.parent} --filename multiqc.html'
-    if not dry_run_arg: subprocess.run(command, shell=True, capture_output=not show_multiqc_arg)
+    if not dry_run_arg: profiling.run_command(command, shell=True, stdout=None if show_multiqc_arg else subprocess.DEVNULL, stderr=None if show_multiqc_arg else subprocess.DEVNULL)
     run_name = input_dir.parent.parent.name
     source_html_path = input_dir.parent.joinpath('multiqc.html')
     dest_html_path = input_dir.parent.parent.joinpath(f'{run_name}.html')
     command = f'cp {source_html_path} {dest_html_path}'
-    if not dry_run_arg: subprocess.run(command, shell=True)
+    if not dry_run_arg: profiling.run_command(command, shell=True)
     return None
-def _generate_md5(input_dir: pathlib.Path) -> None:
+def _do_quick_qc(index: run_index.RunIndex, qc_out_dir: pathlib.Path, dry_run_arg: bool = True, threads: int = 32) -> list:
     """
-    Generate an md5 checksum for a given directory.
+    Performs the built-in QC (fastq_qc) on the .fastq.gz files of a run, threads files at a time in separate processes.
+    The summary of each file is written to {sample}.qc.json in the output directory and a line per file to {run}.qc.tsv.
+
+    Parameters:
+        index (run_index.RunIndex): the index of the run directory, with the .fastq.gz files.
+        qc_out_dir (pathlib.Path): the directory to output the QC summaries.
+        dry_run_arg (bool): optional (default=True), if True, performs a dry run without executing any operations.
+        threads (int): number of processes to run.
+
+    Returns:
+        (list): the summary (dict) of every file.
+    """
+    fastq_files = [file for file in index.fastq_files if file.name.endswith('.fastq.gz')]
+    logging.debug(f'Found {len(fastq_files)} files to process in {_find_fastq_files(index, dry_run_arg)}.')
+    logging.info(f'Running quick QC using {threads} processes ...')
+    if dry_run_arg: return []
+    start_time = time.perf_counter()
+    summaries = fastq_qc.qc_fastq_files(fastq_files, qc_out_dir, index.root.joinpath(f'{index.root.name}.qc.tsv'), threads)
+    for summary in summaries:
+        if 'error' in summary: logging.error(f"Quick QC of {summary['file']} failed: {summary['error']}")
+    logging.info(f"Quick QC of {len(summaries)} files ({sum([summary.get('reads', 0) for summary in summaries])} reads) took {time.perf_counter() - start_time:.1f} s.")
+    if any(['error' in summary for summary in summaries]): raise RuntimeError(f"Quick QC failed for {sum(['error' in summary for summary in summaries])} files.")
+    return summaries
+def _generate_md5(input_dir: pathlib.Path, algorithm: str = 'md5', workers: int = checksum.CHECKSUM_WORKERS, files: list = None) -> None:
+    """
+    Generate a checksum manifest for a given directory, readable by md5sum -c (or b2sum -c, ...) from the parent directory.
+    Files are hashed in parallel; if any file can't be read no manifest is written and checksum.ChecksumError is raised.
+    Digests are cached beside the manifest (checksum.cache_name()) with the size, modification time and inode of each
+    file, so generating it again only reads the files that are new or changed.
 
     Parameters:
         input_dir (pathlib.Path): target directory.
+        algorithm (str): hashlib algorithm, one of checksum.CHECKSUM_ALGORITHMS.
+        workers (int): number of files hashed at the same time.
+        files (list): optional relative paths of the files to hash (e.g. from a run_index.RunIndex), listed again if None.
 
     Returns:
         (None)
     """
-    logging.info(f'Generating md5 hash of {input_dir} ...')
-    commmand = f"(cd {input_dir} && find . -type f -print0 | xargs -0 md5sum | sort -k2) > {input_dir.parent.joinpath('checksum.md5')}"
-    result = subprocess.run(commmand, shell=True, capture_output=True)
-    logging.info(f'Generated md5 hash of {input_dir} .')
+    logging.info(f'Generating {algorithm} hash of {input_dir} ...')
+    start_time = time.perf_counter()
+    cache = checksum.ChecksumCache(input_dir.parent.joinpath(checksum.cache_name(algorithm)), algorithm)
+    digests = checksum.checksum_tree(input_dir, algorithm, workers, cache, files)
+    checksum.write_manifest(digests, input_dir.parent.joinpath(checksum.manifest_name(algorithm)))
+    logging.info(f'Generated {algorithm} hash of {input_dir} ({cache.misses} files hashed, {cache.hits} unchanged since the last hash, in {time.perf_counter() - start_time:.1f} s).')
     return None
-def _check_md5(z_drive_dir: pathlib.Path, local_archive_dir: pathlib.Path) -> bool:
+def _check_md5(z_drive_index: run_index.RunIndex, local_archive_dir: pathlib.Path, algorithm: str = 'md5', workers: int = checksum.CHECKSUM_WORKERS) -> bool:
     """
-    Compare the md5 checksum between the Z-drive copy and the local archive copy and return True if they're the same.
+    Compare the checksums between the Z-drive copy and the local archive copy and return True if they're the same.
+    Both manifests are always brought up to date first; only files that changed since they were last hashed are read.
+    The files of the Z-drive copy come from its index, the archive copy is listed once.
 
     Parameters:
-        z_drive_dir (pathlib.Path): the Z-drive copy of the MiSeqOutput directory.
-        local_archive_dir (pathlib.Path): the Z-drive copy of the MiSeqOutput directory.
+        z_drive_index (run_index.RunIndex): the index of the Z-drive copy of the run directory.
+        local_archive_dir (pathlib.Path): the local archive copy of the run directory.
+        algorithm (str): hashlib algorithm, one of checksum.CHECKSUM_ALGORITHMS.
+        workers (int): number of files hashed at the same time.
 
     Returns:
         (bool): True if they match, False otherwise
     """
-    z_drive_dir = _find_miseq_output(z_drive_dir)
-    local_archive_dir = _find_miseq_output(local_archive_dir)
-
-    if not z_drive_dir.parent.joinpath('checksum.md5').exists(): _generate_md5(z_drive_dir)
-    else: logging.debug(f'md5 hash of {z_drive_dir} already exists ?')
-
-    if not local_archive_dir.parent.joinpath('checksum.md5').exists(): _generate_md5(local_archive_dir)
-    else: logging.debug(f'md5 hash of {local_archive_dir} already exists ?')
+    local_archive_index = run_index.RunIndex(local_archive_dir)
+    z_drive_dir = _find_miseq_output(z_drive_index)
+    local_archive_dir = _find_miseq_output(local_archive_index)
+    manifest_name = checksum.manifest_name(algorithm)
+
+    try:
+        _generate_md5(z_drive_dir, algorithm, workers, z_drive_index.files_below(z_drive_index.relative(z_drive_dir)))
+        _generate_md5(local_archive_dir, algorithm, workers, local_archive_index.files_below(local_archive_index.relative(local_archive_dir)))
+    except checksum.ChecksumError as error:
+        for path, path_error in error.errors.items(): logging.error(f"Couldn't hash {path}: {path_error}")
+        logging.critical(f'{algorithm} hashes incomplete! {error}')
+        return False
 
-    logging.info(f'Comparing md5 hashes of {z_drive_dir} and {local_archive_dir} ...')
-    with open(z_drive_dir.parent.joinpath('checksum.md5')) as z_drive_checksum_file: z_drive_checksum =  z_drive_checksum_file.read()
-    with open(local_archive_dir.parent.joinpath('checksum.md5')) as local_checksum_file: local_checksum =  local_checksum_file.read()
+    logging.info(f'Comparing {algorithm} hashes of {z_drive_dir} and {local_archive_dir} ...')
+    z_drive_checksum = checksum.read_manifest(z_drive_dir.parent.joinpath(manifest_name))
+    local_checksum = checksum.read_manifest(local_archive_dir.parent.joinpath(manifest_name))
+    differences = checksum.compare_manifests(z_drive_checksum, local_checksum)
 
-    logging.info(f'Comparing md5 hashes of {z_drive_dir} and {local_archive_dir} .')
-    if z_drive_checksum == local_checksum:
-        logging.info(f'md5 hashes validated .')
+    logging.info(f'Comparing {algorithm} hashes of {z_drive_dir} and {local_archive_dir} .')
+    if not any(differences.values()):
+        logging.info(f'{algorithm} hashes validated .')
         return True
     else:
-        logging.critical(f'md5 hashes invalid! Something went wrong!')
+        for path in differences['missing']: logging.error(f'Missing from the archive: {path}')
+        for path in differences['extra']: logging.error(f'Not on the Z-drive: {path}')
+        for path in differences['mismatched']: logging.error(f'Different {algorithm} hash: {path}')
+        logging.critical(f'{algorithm} hashes invalid! Something went wrong!')
         return False
-def _analyze_phix(input_fastq_dir: pathlib.Path, destination_dir: pathlib.Path, show_fastqc_arg: bool, show_multiqc_arg: bool, threads: int):
+def _analyze_phix(index: run_index.RunIndex, destination_dir: pathlib.Path, show_fastqc_arg: bool, show_multiqc_arg: bool, threads: int, reference: pathlib.Path = phix.PHIX_REFERENCE, fraction: float = 1.0, seed: int = 0):
     """
     Find the Undetermined reads, do the PhiX analysis, and output the analysis.
+    The reads are aligned with phix.stream_phix(), which keeps the reads that mapped to PhiX straight from the bwa output
+    (no SAM file is written), optionally from a subsample of the reads. The PhiX alignment rate is written as JSON
+    next to {run}.phiX.html ({run}.phiX.json).
 
     Parameters:
-        input_fastq_dir (pathlib.Path): the directory containing .fastq.gz files in the MiSeqOutput directory.
+        index (run_index.RunIndex): the index of the run directory, with the Undetermined reads.
         destination_dir (pathlib.Path): the directory to output analysis files.
         show_fastq_arg (bool): show the fastqc analysis progress if True, else keep this hidden.
         show_multiqc_arg (bool): show the fastqc analysis progress if True, else keep this hidden.
-        threads (int): number of threads to run for fastqc.
+        threads (int): number of threads to run for bwa and fastqc.
+        reference (pathlib.Path): the PhiX reference, indexed with bwa index.
+        fraction (float): fraction of the Undetermined read pairs to align, 1 for all of them.
+        seed (int): seed of the subsample.
 
     Returns:
-        (many)
+        (dict): the summary of the PhiX alignment.
+
+    Raises RuntimeError if fastqc or multiqc of the PhiX reads fails.
 
     TODO: consider using the pre-built functions for fastqc and multiqc.
     """
-    logging.info(f'Finding Undetermined reads in {input_fastq_dir} ...')
-    undetermined_reads: list[pathlib.Path] = list(input_fastq_dir.glob('Undetermined*'))
-    if len(undetermined_reads) != 2:
-        return ValueError("Expected exactly two (R1/R2) Undetermined reads files.")
-    logging.info(f'Found Undetermined reads in {input_fastq_dir}.')
-
-    undetermined_read_1, undetermined_read_2 = None, None
-    for file in undetermined_reads:
-        read_orientation = file.stem.split('_')[3]
-        if '1' in read_orientation:
-            undetermined_read_1 = file
-        elif '2' in read_orientation:
-            undetermined_read_2 = file
-        else:
-            raise ValueError(f"Unexpected read orientation '{read_orientation}' in file {file}.")
-    if not all([undetermined_read_1, undetermined_read_2]): raise ValueError("Both read orientations 'R1' and 'R2' must be present.")
-
-    dest_file: pathlib.Path = destination_dir.joinpath('aln.sam')
-
-    command = f'bwa mem /home/agc/Documents/ref/genomes/phiX/phix174.fasta {undetermined_read_1} {undetermined_read_2} > {dest_file}'
-    try: subprocess.run(command, shell=True, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as exc:
-        logging.critical(f"Alignment failed.\n{exc.returncode}\n{exc.output}")
-        return SyntaxError
-    # looks for alignment file
-    samfile = list(destination_dir.glob('*sam'))
-    if not samfile:
-        logging.critical(f"SAM file not found.")
-        return ValueError
-
-    # separate forward and reverse files
-    command = f'samtools view -h -F 4 {" ".join([str(file) for file in samfile])} | samtools fastq -1 {destination_dir.joinpath("PhiX.R1.fastq.gz")} -2 {destination_dir.joinpath("PhiX.R2.fastq.gz")}'
-    try: subprocess.run(command, shell=True, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as exc:
-        logging.critical(f"Separation of reads failed.\n{exc.returncode}\n{exc.output}")
-        return SyntaxError
-
-    fw_fastq = list(destination_dir.glob('*.R1.fastq*'))[0]
-    rv_fastq = list(destination_dir.glob('*.R2.fastq*'))[0]
-
-    if not fw_fastq or not rv_fastq:
-        logging.critical('fastq not found')
-        return LookupError
+    logging.info(f'Finding Undetermined reads in {index.fastq_dir} ...')
+    if not index.undetermined:
+        raise ValueError("Expected exactly two (R1/R2) Undetermined reads files.")
+    undetermined_read_1, undetermined_read_2 = index.undetermined
+    logging.info(f'Found Undetermined reads in {index.fastq_dir}.')
+
+    destination_dir.mkdir(exist_ok=True)
+    logging.info(f"Aligning {f'{fraction:.1%} of ' if fraction < 1 else ''}the Undetermined reads to PhiX with {threads} threads ...")
+    summary = phix.stream_phix(undetermined_read_1, undetermined_read_2, destination_dir, reference, threads, fraction, seed)
+    logging.info(f"{summary['reads_mapped']} of {summary['reads_aligned']} Undetermined reads ({summary['phix_rate']:.2%}) aligned to PhiX.")
+    fw_fastq = destination_dir.joinpath('PhiX.R1.fastq.gz')
+    rv_fastq = destination_dir.joinpath('PhiX.R2.fastq.gz')
 
     command = f'fastqc -t {threads} -o {destination_dir} {fw_fastq} {rv_fastq} {undetermined_read_1} {undetermined_read_2}'
-    try: subprocess.run(command, shell=True,
-        stdout=subprocess.PIPE if show_fastqc_arg else subprocess.DEVNULL,
-        stderr=subprocess.PIPE if show_fastqc_arg else subprocess.DEVNULL)
-    except subprocess.CalledProcessError as exc:
-        logging.critical(f"FastQC of reads failed.\n{exc.returncode}\n{exc.output}")
-        return SyntaxError
+    exit_code = profiling.run_command(command, shell=True,
+        stdout=None if show_fastqc_arg else subprocess.DEVNULL,
+        stderr=None if show_fastqc_arg else subprocess.DEVNULL)
+    if exit_code != 0: raise RuntimeError(f"FastQC of the PhiX reads exited with {exit_code}.")
     run_name: str = destination_dir.parent.parent.stem
     command = f"multiqc {destination_dir} --interactive --outdir {destination_dir} --filename phiX_multiqc.html"
-    try: subprocess.run(command, shell=True,
-        stdout=subprocess.PIPE if show_multiqc_arg else subprocess.DEVNULL,
-        stderr=subprocess.PIPE if show_multiqc_arg else subprocess.DEVNULL)
-    except subprocess.CalledProcessError as exc:
-        logging.critical(f"MultiQC failed.\n{exc.returncode}\n{exc.output}")
-        return SyntaxError
+    exit_code = profiling.run_command(command, shell=True,
+        stdout=None if show_multiqc_arg else subprocess.DEVNULL,
+        stderr=None if show_multiqc_arg else subprocess.DEVNULL)
+    if exit_code != 0: raise RuntimeError(f"MultiQC of the PhiX reads exited with {exit_code}.")
 
     source_html_path = destination_dir.joinpath('phiX_multiqc.html')
     dest_html_path = destination_dir.parent.parent.joinpath(f'{run_name}.phiX.html')
     command = f'cp {source_html_path} {dest_html_path}'
-    subprocess.run(command, shell=True)
-def _check_outputs(input_dir: pathlib.Path, dry_run: bool, do_phix_arg: bool, show_fastqc_arg: bool, show_multiqc_arg: bool, threads: int) -> None:
+    profiling.run_command(command, shell=True)
+    phix.write_summary(summary, destination_dir.parent.parent.joinpath(f'{run_name}.phiX.json'))
+    return summary
+def _plan_stages(index: run_index.RunIndex, args: Namespace, pool: transfer.WorkerPool = None, limiter: transfer.RateLimiter = None) -> list:
     """
-    Checks the analysis directory for the expected structure and performs analyses as needed.
+    Checks the analysis directory for the expected structure and plans the analyses, the archive and its verification
+    as stages for stages.run_stages(). The analyses are skipped if their outputs exist, fastqc and multiqc also with
+    --qc quick and the built-in QC unless --qc quick or full. The MiSeqOutput directory is copied (and its Z-drive copy
+    hashed) while the QC and the PhiX analysis use the CPUs; the rest of the run, with the analyses, is copied (only
+    the files that weren't copied yet) once they're over and the checksum manifest is written into the run, and then
+    the archive is verified.
+    A run without a MiSeqOutput directory fails the copy of it, so nothing of the run is archived.
 
     Parameters:
-        input_fastq_dir (pathlib.Path): the root run directory for the MiSeq run.
-        dry_run (bool): flag to produce outputs or just test.
-        do_phix_arg (bool): flag to perform PhiX analysis--considering defaulting to True here as our protocols develop.
-        show_fastq_arg (bool): show the fastqc analysis progress if True, else keep this hidden.
-        show_multiqc_arg (bool): show the fastqc analysis progress if True, else keep this hidden.
-        threads (int): number of threads to run for fastqc.
+        index (run_index.RunIndex): the index of the root run directory for the MiSeq run, rescanned where analyses are written.
+        args (Namespace): the command-line arguments.
+        pool (transfer.WorkerPool): optional copy workers shared with the other runs of a batch.
+        limiter (transfer.RateLimiter): optional limit on the bytes copied per second shared with the other runs of a batch.
 
     Returns:
-        (None)
-
-    TODO: consider putting PhiX analysis separate from this loop.
+        (list): the stages.Stage of every step.
     """
+    input_dir = index.root
+    dry_run = args.dry_run_arg
+
     # Check directory structure
     logging.info(f'Checking directory structure ...')
-    if not input_dir.joinpath('analysis/fastqc').exists():
-        if not dry_run: input_dir.joinpath('analysis/fastqc').mkdir(exist_ok=True, parents=True)
+    if not index.exists('analysis/fastqc'):
+        if not dry_run:
+            input_dir.joinpath('analysis/fastqc').mkdir(exist_ok=True, parents=True)
+            index.rescan('analysis')
         logging.info(f"Created directory structure .")
     else: logging.warning('Analysis directory exists!')
 
-
-    # Check fastqc analysis
-    logging.info(f'Checking fastqc analysis ...')
-    if not list(input_dir.joinpath('analysis/fastqc').glob('*.html')):
-        MiSeq_output_dir = _find_miseq_output(input_dir, dry_run)
-        fastq_dir = _find_fastq_files(MiSeq_output_dir, dry_run)
-        _do_fastqc(fastq_dir, input_dir.joinpath('analysis/fastqc'), dry_run, show_fastqc_arg, threads)
+    def _fastqc(threads: int) -> None:
+        _find_miseq_output(index, dry_run)
+        _do_fastqc(index, input_dir.joinpath('analysis/fastqc'), dry_run, args.show_fastqc_arg, threads)
         logging.info(f'Performed fastqc analysis!')
-    else: logging.warning('Fastqc analysis already exists!')
-
-
-    # Check MultiQC analysis
-    logging.info(f"Checking multiqc analysis ...")
-    if not input_dir.joinpath('analysis').joinpath('multiqc.html').exists():
-        _do_multiqc(input_dir.joinpath('analysis/fastqc'), dry_run, show_multiqc_arg)
+    def _quick_qc(threads: int) -> None:
+        _do_quick_qc(index, input_dir.joinpath('analysis/qc'), dry_run, threads)
+        logging.info(f'Performed quick QC!')
+    def _multiqc() -> None:
+        _do_multiqc(input_dir.joinpath('analysis/fastqc'), dry_run, args.show_multiqc_arg)
         logging.info(f"Performed multiqc analysis!")
-    else: logging.warning('MultiQC analysis already exists!')
-
-
-    # Check phiX analysis
-    if do_phix_arg:
-        logging.info(f"Checking phiX analysis ...")
-        if not input_dir.joinpath('analysis/phiX').exists():
-            if not dry_run:
-                input_dir.joinpath('analysis/phiX').mkdir(exist_ok=True)
-                MiSeq_output_dir = _find_miseq_output(input_dir, dry_run)
-                fastq_dir = _find_fastq_files(MiSeq_output_dir, dry_run)
-                _analyze_phix(
-                    input_fastq_dir=fastq_dir,
-                    destination_dir=input_dir.joinpath('analysis/phix'),
-                    show_fastqc_arg=show_fastqc_arg,
-                    show_multiqc_arg=show_multiqc_arg,
-                    threads=threads)
-            logging.info(f"Performed phiX analysis!")
-        else: logging.warning(f"phiX analysis already exists!")
-    else: logging.info(f"phiX analysis not specified .")
-    return None
-def _perform_archive(input_dir: pathlib.Path, destination_dir: pathlib.Path, dry_run: bool) -> None:
+    def _phix(threads: int) -> None:
+        if not dry_run:
+            _find_fastq_files(index, dry_run)
+            _analyze_phix(
+                index=index,
+                destination_dir=input_dir.joinpath('analysis/phix'),
+                show_fastqc_arg=args.show_fastqc_arg,
+                show_multiqc_arg=args.show_multiqc_arg,
+                threads=threads,
+                reference=args.phix_reference,
+                fraction=args.phix_subsample,
+                seed=args.phix_seed)
+        logging.info(f"Performed phiX analysis!")
+    def _archive_run_data() -> None:
+        _perform_archive(index, args.archive_dir, dry_run, args.copy_backend, args.max_rate, args.copy_workers, args.checksum_algorithm, only=index.relative(_find_miseq_output(index, dry_run)), pool=pool, limiter=limiter)
+    def _hash_z_drive() -> None:
+        # files copied by _archive_run_data() are already in the checksum cache, this reads the ones it skipped
+        miseq_output = _find_miseq_output(index, dry_run)
+        try: _generate_md5(miseq_output, args.checksum_algorithm, args.checksum_workers, index.files_below(index.relative(miseq_output)))
+        except checksum.ChecksumError as error: logging.warning(f"{error}, trying again when verifying.")
+    def _archive() -> None:
+        # the analyses wrote into analysis/ and their reports into the run directory
+        if not dry_run:
+            index.rescan('analysis')
+            index.rescan('', recursive=False)
+        _perform_archive(index, args.archive_dir, dry_run, args.copy_backend, args.max_rate, args.copy_workers, args.checksum_algorithm, pool=pool, limiter=limiter)
+    def _verify() -> bool:
+        return _check_md5(index, args.archive_dir.joinpath(input_dir.stem), args.checksum_algorithm, args.checksum_workers)
+
+    return [
+        stages.Stage('fastqc', _fastqc, cpu=True,
+            skip=lambda: 'quick QC only.' if args.qc_mode == 'quick' else ('Fastqc analysis already exists!' if index.files_in('analysis/fastqc', '*.html') else None)),
+        stages.Stage('multiqc', _multiqc, depends=['fastqc'],
+            skip=lambda: 'quick QC only.' if args.qc_mode == 'quick' else ('MultiQC analysis already exists!' if index.exists('analysis/multiqc.html') else None)),
+        stages.Stage('quick-qc', _quick_qc, cpu=True,
+            skip=lambda: 'quick QC not specified .' if args.qc_mode == 'fastqc' else ('Quick QC already exists!' if index.exists(f'{input_dir.name}.qc.tsv') else None)),
+        stages.Stage('phiX', _phix, cpu=True,
+            skip=lambda: 'phiX analysis not specified .' if not args.do_phix_arg else ('phiX analysis already exists!' if index.exists(f'{input_dir.stem}.phiX.html') and index.exists(f'{input_dir.stem}.phiX.json') else None)),
+        stages.Stage('archive-run-data', _archive_run_data),
+        stages.Stage('hash-z-drive', _hash_z_drive, depends=['archive-run-data'],
+            skip=lambda: 'dry run.' if dry_run else None),
+        # hash-z-drive writes the manifest into the run directory, which the archive lists and copies
+        stages.Stage('archive', _archive, depends=['archive-run-data'], after=['fastqc', 'multiqc', 'quick-qc', 'phiX', 'hash-z-drive']),
+        stages.Stage('verify', _verify, depends=['archive'], after=['hash-z-drive'],
+            skip=lambda: 'dry run.' if dry_run else None)]
+def _perform_archive(index: run_index.RunIndex, destination_dir: pathlib.Path, dry_run: bool, copy_backend: str = 'auto', max_rate: float = None, workers: int = 4, algorithm: str = 'md5', only: str = None, pool: transfer.WorkerPool = None, limiter: transfer.RateLimiter = None) -> None:
     """
-    Copy the files directly from the Z-drive to the local archival directory.
+    Copy the files directly from the Z-drive to the local archival directory, workers files at a time.
+    Files are copied with transfer.copy_file(), which copies to a temporary name, resumes large files from their last
+    checkpoint and hashes the data as it's copied; every copy is read back and compared. Files already in the archive
+    with the same size and modification time are skipped, so an archive that was interrupted is finished by running again.
+    The digests of the MiSeqOutput directory are saved in the checksum caches of both sides, so _check_md5() doesn't
+    have to read the copied files again.
 
     Parameters:
-        input_fastq_dir (pathlib.Path): the root run directory for the MiSeq run.
+        index (run_index.RunIndex): the index of the root run directory for the MiSeq run.
         destination_dir (pathlib.Path): the destination dir for archival.
         dry_run (bool): flag to produce outputs or just test.
+        copy_backend (str): copy backend to try first, one of transfer.BACKENDS.
+        max_rate (float): limit on the bytes copied per second, None for unlimited.
+        workers (int): number of files copied at the same time.
+        algorithm (str): hashlib algorithm of the checksums, one of checksum.CHECKSUM_ALGORITHMS.
+        only (str): optional folder of the run directory (relative to it) to copy instead of the whole run, e.g. the
+            MiSeqOutput directory while the analyses still write into the run directory.
+        pool (transfer.WorkerPool): optional copy workers shared with other runs (instead of workers), each run gets
+            an equal share of them.
+        limiter (transfer.RateLimiter): optional limit on the bytes copied per second shared with other runs (instead of max_rate).
 
     Returns:
         (None)
+
+    Raises OSError if any file couldn't be copied, once every other file is.
     """
+    input_dir = index.root
+    below_only = lambda path: only is None or path == only or path.startswith(f'{only}/')
+    archive_dir = destination_dir.joinpath(input_dir.name)
     logging.info(f"Checking destination {destination_dir} for {input_dir.name} ...")
-    if not destination_dir.joinpath(input_dir.name).exists():
-        logging.info(f'Copying {input_dir} to {destination_dir} ...')
-        if not dry_run: subprocess.run(f'cp -r {input_dir} {destination_dir}', shell=True)
-        logging.info(f'Copied {input_dir} to {destination_dir}!')
-    else: logging.warning(f'Destination {destination_dir.joinpath(input_dir.name)} already exists!')
+    if archive_dir.exists(): logging.warning(f'Destination {archive_dir} already exists! Only copying files that are missing or different ...')
+
+    # the checksum caches at the root of the run directory aren't copied, every copy keeps its own
+    files = [(relative_path, source_stat) for relative_path, source_stat in sorted(index.files.items()) if below_only(relative_path) and ('/' in relative_path or not relative_path.startswith('.checksum.'))]
+    folders = sorted([folder for folder in index.folders if below_only(folder) or (only and only.startswith(f'{folder}/'))])
+    pending = []
+    for relative_path, source_stat in files:
+        try: archive_stat = archive_dir.joinpath(relative_path).stat()
+        except FileNotFoundError: archive_stat = None
+        if archive_stat and archive_stat.st_size == source_stat.st_size and abs(archive_stat.st_mtime - source_stat.st_mtime) <= MTIME_TOLERANCE: continue
+        pending.append((relative_path, source_stat))
+    pending_bytes = sum([source_stat.st_size for _, source_stat in pending])
+    logging.info(f'Copying {len(pending)} of {len(files)} files ({pending_bytes / 1e6:.1f} MB) from {input_dir.joinpath(only or "")} to {destination_dir} ...')
+    if dry_run:
+        for relative_path, _ in pending: logging.debug(f'Would copy {relative_path} .')
+        return None
+
+    for folder in folders: archive_dir.joinpath(folder).mkdir(parents=True, exist_ok=True)
+    for relative_path in sorted([path for path in index.symlinks if below_only(path)]):
+        if not archive_dir.joinpath(relative_path).is_symlink(): os.symlink(os.readlink(input_dir.joinpath(relative_path)), archive_dir.joinpath(relative_path))
+
+    # digests are only cached for the MiSeqOutput directory, relative to it, like the manifests
+    miseq_output = index.relative(index.miseq_output) if index.miseq_output else None
+    if miseq_output:
+        source_cache = checksum.ChecksumCache(input_dir.joinpath(checksum.cache_name(algorithm)), algorithm)
+        archive_cache = checksum.ChecksumCache(archive_dir.joinpath(checksum.cache_name(algorithm)), algorithm)
+    limiter = limiter or transfer.RateLimiter(max_rate)
+
+    def _copy(relative_path: str, source_stat: os.stat_result) -> str:
+        digest, backend = transfer.copy_file(input_dir.joinpath(relative_path), archive_dir.joinpath(relative_path), algorithm=algorithm, verify=True, backend=copy_backend, limiter=limiter)
+        if miseq_output and relative_path.startswith(f'{miseq_output}/'):
+            miseq_path = relative_path[len(miseq_output) + 1:]
+            # verified copies return the digest of the source, whichever backend copied them
+            source_cache.record(miseq_path, source_stat, digest)
+            archive_cache.record(miseq_path, archive_dir.joinpath(relative_path).stat(), digest)
+        logging.debug(f'Copied {relative_path} ({backend}).')
+        return backend
+
+    backend_counts: dict = {}
+    copied_bytes: int = 0
+    failed: int = 0
+    start_time = time.perf_counter()
+    own_pool = pool is None
+    if own_pool: pool = transfer.WorkerPool(max(1, workers))
+    pool.attach()
+    futures: dict = {}
+    def _collect(finished) -> None:
+        nonlocal copied_bytes, failed
+        for future in finished:
+            relative_path, source_stat = futures.pop(future)
+            try: backend = future.result()
+            except (OSError, transfer.ChecksumMismatchError) as error:
+                logging.error(f"Couldn't copy {relative_path}: {error}")
+                failed += 1
+                continue
+            backend_counts[backend] = backend_counts.get(backend, 0) + 1
+            copied_bytes += source_stat.st_size
+        return None
+    try:
+        for relative_path, source_stat in pending:
+            # with a shared pool, at most this run's share of the workers is queued, so runs copy side by side
+            while len(futures) >= pool.max_pending(): _collect(wait(futures, return_when=FIRST_COMPLETED)[0])
+            futures[pool.submit(_copy, relative_path, source_stat)] = (relative_path, source_stat)
+        _collect(wait(futures)[0])
+    finally:
+        pool.detach()
+        if own_pool: pool.shutdown()
+        if miseq_output:
+            source_cache.save(prune=False)
+            archive_cache.save(prune=False)
+    # folders get the modification times of the Z-drive last, copying into them changes them
+    for folder in reversed(folders): shutil.copystat(input_dir.joinpath(folder), archive_dir.joinpath(folder))
+    shutil.copystat(input_dir, archive_dir)
+
+    elapsed_time = time.perf_counter() - start_time
+    logging.info(f"Copied {sum(backend_counts.values())} files ({copied_bytes / 1e6:.1f} MB) in {elapsed_time:.1f} s ({copied_bytes / 1e6 / max(elapsed_time, 1e-9):.1f} MB/s).")
+    if backend_counts: logging.info(f"Files copied per backend: {', '.join([f'{backend}={count}' for backend, count in sorted(backend_counts.items())])}")
+    if failed: raise OSError(f"Couldn't copy {failed} files to {destination_dir}! Run again to retry them.")
+    logging.info(f'Copied {input_dir.joinpath(only or "")} to {destination_dir}!')
     return None
 def _check_dependencies(software_list: list) -> None:
     """
@@ -421,14 +691,9 @@ def _print_versions(args: Namespace) -> None:
         result = subprocess.run(command, shell=True, capture_output=True)
         return result.stdout.decode().split(' ')[-1].strip()
     
-    def _get_samtools_v() -> str:
-        command = 'samtools --version'
-        result = subprocess.run(command, shell=True, capture_output=True)
-        return result.stdout.decode().splitlines()[0].split(' ')[-1].strip()
-    
     for software, version in zip(
-        ['fastQC', 'multiQC', 'bwa', 'samtools'],
-        [_get_fastqc_v(), _get_multiqc_v(), _get_bwa_v(), _get_samtools_v()]):
+        ['fastQC', 'multiQC', 'bwa'],
+        [_get_fastqc_v(), _get_multiqc_v(), _get_bwa_v()]):
         logging.info(f"VERSION: {software}={version}")
     
     logging.info(f"VERSION: ngs-backup.py={__version__}\n")
@@ -441,34 +706,144 @@ def _print_versions(args: Namespace) -> None:
     logging.info(f"Hopefully this works!\n")
 
     return None
+def _archive_run(z_drive_ngs_dir: pathlib.Path, args: Namespace, threads: int, pool: transfer.WorkerPool = None, limiter: transfer.RateLimiter = None, log_prefix: str = '', profile_path: pathlib.Path = None) -> dict:
+    """
+    Archive a run: its analyses, the copy to the archive and the verification, as planned by _plan_stages().
+    What every stage used (time, CPU, peak memory, bytes read and written and the exit status of its commands, see
+    profiling.Profile) is written as JSON and logged as a table at the end.
+
+    Parameters:
+        z_drive_ngs_dir (pathlib.Path): the run directory on the Z-drive.
+        args (Namespace): the command-line arguments.
+        threads (int): number of threads shared by the analyses of the run.
+        pool (transfer.WorkerPool): optional copy workers shared with the other runs of a batch.
+        limiter (transfer.RateLimiter): optional limit on the bytes copied per second shared with the other runs of a batch.
+        log_prefix (str): prefix of every message logged for the run.
+        profile_path (pathlib.Path): optional JSON the profile of every stage is written to.
+
+    Returns:
+        (dict): the run, its status (archived, dry run, failed or crashed), how long it took (seconds) and the status of every stage.
+    """
+    LOG_PREFIX.set(log_prefix)
+    start_time = time.perf_counter()
+    status = {'run': z_drive_ngs_dir.name, 'status': 'crashed', 'seconds': None, 'stages': {}}
+    try:
+        logging.info(f"Found NGS run directory: '{z_drive_ngs_dir}' .")
+        index = run_index.RunIndex(z_drive_ngs_dir)
+        results = stages.run_stages(_plan_stages(index, args, pool, limiter), threads)
+        status['stages'] = {name: stage.status for name, stage in results.items()}
+        profiles = stages.stage_profiles(results)
+        logging.info(f"Profile of every stage (cpu, child cpu, read and written are for the whole script, so they include the stages that ran at the same time):\n{profiling.summary_table(profiles)}")
+        if profile_path:
+            profiling.write_profile({'run': z_drive_ngs_dir.name, 'threads': threads, 'stages': profiles}, profile_path)
+            logging.info(f"Profile written to {profile_path} .")
+        if results['verify'].status == 'skipped':
+            logging.info("DRY RUN COMPLETE !")
+            status['status'] = 'dry run'
+        elif results['verify'].status != 'done' or not results['verify'].result:
+            logging.critical("CATASTROPHIC FAILURE SOMEWHERE !")
+            status['status'] = 'failed'
+        else:
+            logging.info("BACKUP COMPLETE !")
+            status['status'] = 'archived'
+    except Exception as error:
+        logging.critical(f"Archiving {z_drive_ngs_dir} crashed: {error!r}")
+    finally:
+        status['seconds'] = time.perf_counter() - start_time
+    return status
+def _archive_batch(z_drive_ngs_dirs: list, args: Namespace, runtime: str) -> dict:
+    """
+    Archive several runs through one queue, --batch-runs of them at a time. The runs being archived share the --threads
+    (split evenly between them), one pool of --copy-workers and the --max-rate. The status of every run is written to a
+    TSV ({runtime}_batch.tsv) every time a run is over, so the batch can be followed while it runs, and the profile of
+    every run to {runtime}_{run}.profile.json.
+
+    Parameters:
+        z_drive_ngs_dirs (list): the run directories (pathlib.Path) on the Z-drive, archived in this order.
+        args (Namespace): the command-line arguments.
+        runtime (str): the time the batch started, the TSV and the profiles are named after.
+
+    Returns:
+        (dict): name of every run: its status from _archive_run().
+    """
+    status_path = LOG_DIR.joinpath(f'{runtime}_batch.tsv')
+    concurrent_runs = min(args.batch_runs, len(z_drive_ngs_dirs))
+    threads = max(1, args.threads // concurrent_runs)
+    logging.info(f"Archiving {len(z_drive_ngs_dirs)} runs, {concurrent_runs} at a time ({threads} threads each, {args.copy_workers} copy workers shared) ...")
+    statuses = {z_drive_ngs_dir.name: {'run': z_drive_ngs_dir.name, 'status': 'queued', 'seconds': None, 'stages': {}} for z_drive_ngs_dir in z_drive_ngs_dirs}
+    _write_batch_status(statuses, status_path)
+
+    pool = transfer.WorkerPool(args.copy_workers)
+    limiter = transfer.RateLimiter(args.max_rate)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrent_runs, thread_name_prefix='run') as executor:
+            futures = {executor.submit(copy_context().run, _archive_run, z_drive_ngs_dir, args, threads, pool, limiter, f'[{z_drive_ngs_dir.name}] ', LOG_DIR.joinpath(f'{runtime}_{z_drive_ngs_dir.name}.profile.json')): z_drive_ngs_dir for z_drive_ngs_dir in z_drive_ngs_dirs}
+            for future in as_completed(futures):
+                status = future.result()
+                statuses[status['run']] = status
+                _write_batch_status(statuses, status_path)
+    finally:
+        pool.shutdown()
+
+    summary_lines = '\n'.join([f"\t{run_name}: {status['status']} ({status['seconds'] or 0:.0f} s)" for run_name, status in statuses.items()])
+    message = f"Batch finished for {len(statuses)} runs, {sum([status['status'] in ('archived', 'dry run') for status in statuses.values()])} succeeded:\n{summary_lines}"
+    if all([status['status'] in ('archived', 'dry run') for status in statuses.values()]): logging.info(message)
+    else: logging.warning(message)
+    logging.info(f"Status of every run written to {status_path} .")
+    return statuses
+def _write_batch_status(statuses: dict, status_path: pathlib.Path) -> None:
+    """
+    Write the status of every run of a batch as a TSV (run, status, seconds and the status of every stage), replacing it atomically.
+
+    Parameters:
+        statuses (dict): name of every run: its status from _archive_run().
+        status_path (pathlib.Path): the TSV to write.
+
+    Returns:
+        (None)
+    """
+    stage_names = list(dict.fromkeys([name for status in statuses.values() for name in status['stages']]))
+    rows = ['\t'.join(['run', 'status', 'seconds', *stage_names])]
+    for status in statuses.values():
+        rows.append('\t'.join([status['run'], status['status'], f"{status['seconds']:.1f}" if status['seconds'] is not None else '', *[status['stages'].get(name, '') for name in stage_names]]))
+    temporary_status_path = status_path.with_name(f'{status_path.name}.tmp')
+    temporary_status_path.write_text('\n'.join(rows) + '\n', encoding='utf-8')
+    os.replace(temporary_status_path, status_path)
+    return None
+def _add_log_prefix(record: logging.LogRecord) -> bool:
+    """ Logging filter that adds the prefix of the run being archived to a record. """
+    record.log_prefix = LOG_PREFIX.get()
+    return True
 # --------------------------------------------------
 def main() -> None:
     """ Do the thing. """
     args = get_args()
-    software_list = ['fastqc', 'multiqc', 'samtools', 'bwa']
+    if args.low_priority_arg: transfer.lower_priority()
+    software_list = ['fastqc', 'multiqc', 'bwa']
     _check_dependencies(software_list=software_list)
 
     runtime = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    batch = len(args.z_drive_ngs_dirs) != 1
     logging.basicConfig(
         encoding='utf-8',
         level=logging.DEBUG if args.verbose_arg else logging.INFO,
         handlers=[
-            logging.FileHandler(pathlib.Path('/mnt/data/archive/archive_logs').joinpath(f'{runtime}_{args.z_drive_ngs_dir.stem}.log')),
+            logging.FileHandler(LOG_DIR.joinpath(f'{runtime}_{"batch" if batch else args.z_drive_ngs_dirs[0].stem}.log')),
             logging.StreamHandler()],
         datefmt='%Y-%m-%d %H:%M:%S',
-        format='%(asctime)s %(levelname)s : %(message)s')
+        format='%(asctime)s %(levelname)s [%(threadName)s] : %(log_prefix)s%(message)s')
+    for handler in logging.getLogger().handlers: handler.addFilter(_add_log_prefix)
 
+    # dependencies and versions are checked once for the whole batch
     _print_versions(args=args)
-    logging.info(f"Found NGS run directory: '{args.z_drive_ngs_dir}' .")
-    _check_outputs(args.z_drive_ngs_dir, args.dry_run_arg, args.do_phix_arg, args.show_fastqc_arg, args.show_multiqc_arg, args.threads)
-    # consider adding phiX analysis here as a separate "module" ? -Erick
-    _perform_archive(args.z_drive_ngs_dir, args.archive_dir, args.dry_run_arg)
-
-    if not _check_md5(args.z_drive_ngs_dir, args.archive_dir.joinpath(args.z_drive_ngs_dir.stem)):
-        logging.critical("CATASTROPHIC FAILURE SOMEWHERE !")
+    if not args.z_drive_ngs_dirs:
+        logging.info(f"Every run in {args.ngs_root} is already in {args.archive_dir}, nothing to archive.")
         return None
-
-    logging.info("BACKUP COMPLETE !")
+    if batch:
+        _archive_batch(args.z_drive_ngs_dirs, args, runtime)
+        return None
+    # consider adding phiX analysis here as a separate "module" ? -Erick
+    _archive_run(args.z_drive_ngs_dirs[0], args, args.threads, profile_path=LOG_DIR.joinpath(f'{runtime}_{args.z_drive_ngs_dirs[0].stem}.profile.json'))
     return None
 # --------------------------------------------------
 if __name__ == '__main__':
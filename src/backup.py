@@ -13,10 +13,48 @@ from argparse import (
     RawTextHelpFormatter)
 from pathlib import Path
 # --------------------------------------------------
-import shutil
+import os
+import stat
 import logging
 import json
+import sqlite3
+import time
+import signal
+import threading
 from datetime import datetime
+from collections.abc import Iterator, Iterable
+from contextvars import ContextVar, copy_context
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+# --------------------------------------------------
+from transfer import (
+    BACKENDS,
+    ChecksumMismatchError,
+    RateLimiter,
+    WorkerPool,
+    SignatureCache,
+    parse_rate,
+    parse_size,
+    lower_priority,
+    copy_file,
+    sync_file,
+    is_partial)
+from watch import InotifyWatcher, PollingWatcher
+from metrics import RunMetrics, ProgressHandler, ProgressReporter, format_bytes
+from bundle import (
+    BUNDLE_DIR,
+    BUNDLE_MAX_SIZE,
+    BUNDLE_MAX_FILES,
+    write_bundle,
+    bundled_files)
+# --------------------------------------------------
+# FAT-formatted flash drives only store modification times to the nearest 2 seconds
+MTIME_TOLERANCE: float = 2.0
+# errors that won't go away by trying again
+PERMANENT_ERRORS: tuple = (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError)
+# prefix of every message logged while an instrument is backed up, only set when there are several
+LOG_PREFIX: ContextVar = ContextVar('log_prefix', default='')
+# longest time --watch waits for changes before checking whether it should stop
+WATCH_TICK: float = 1.0
 # --------------------------------------------------
 def get_args(_configs) -> Namespace:
     """ Get command-line arguments """
@@ -28,126 +66,1168 @@ def get_args(_configs) -> Namespace:
     parser.add_argument(
         'input_path',
         type=Path,
-        help="(INPUT) the root path of the flash-drive from where files will be copied")
-    parser.add_argument(
+        nargs='?',
+        help="(INPUT) the root path of the flash-drive from where files will be copied\n"
+            "(not needed with --apply-plan, or if the instrument is in the \"sources\" section of config.json)")
+    instrument_group = parser.add_mutually_exclusive_group(required=True)
+    instrument_group.add_argument(
         '--instrument',
-        dest='instrument',
+        dest='instruments',
         choices=_configs['instruments'],
         metavar="NAME",
-        required=True,
-        help=f"(DESTINATION) target instrument folder on the Z-drive, CHOOSE: {sorted(_configs['instruments'].keys())}")
+        action='append',
+        help=f"(DESTINATION) target instrument folder on the Z-drive, CHOOSE: {sorted(_configs['instruments'].keys())};\n"
+            "repeat it to back up several instruments together from their input in the \"sources\" section of config.json")
+    instrument_group.add_argument(
+        '--all',
+        dest='all_instruments',
+        action='store_true',
+        help="back up every instrument in the \"sources\" section of config.json together.")
     parser.add_argument(
         '--check',
         action='store_true',
-        help=f"do not copy files, just identify files that do not already exist on the Z-drive.")
+        help=f"do not copy files, just identify files that do not already exist on the Z-drive;\n"
+            "the result is saved as a plan beside the log that can be copied later with --apply-plan.")
+    parser.add_argument(
+        '--apply-plan',
+        dest='plan_path',
+        metavar='PLAN',
+        type=Path,
+        help="copy the files in a plan written by an earlier --check, without checking the whole input again.")
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        metavar='N',
+        type=int,
+        default=1,
+        help="number of files to copy concurrently, shared by all instruments [Default: 1]")
+    parser.add_argument(
+        '--reindex',
+        action='store_true',
+        help="rebuild the local index of backed up files from the destination before checking for changes.")
+    parser.add_argument(
+        '--hash',
+        dest='algorithm',
+        choices=['md5', 'sha1', 'sha256', 'blake2b', 'none'],
+        default='md5',
+        help="checksum computed while copying and written to the checksum manifest beside the log, 'none' to skip it [Default: md5]")
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help="read every copied file back from the destination and compare its checksum.")
+    parser.add_argument(
+        '--sync-updated',
+        dest='sync_updated',
+        action='store_true',
+        help="bring modified files up to date on the Z-drive by only sending the blocks that changed.")
+    parser.add_argument(
+        '--bundle-small',
+        dest='bundle_small',
+        metavar='SIZE',
+        type=parse_size,
+        help="pack new files smaller than SIZE (e.g. 64K) into tar bundles in the .bundles folder of the instrument,\n"
+            "each written in one go, instead of copying them one by one; see bundle.py to list, extract or unpack them")
+    parser.add_argument(
+        '--retries',
+        dest='retries',
+        metavar='N',
+        type=int,
+        default=3,
+        help="number of times a file is retried after a transient error before it is queued as failed [Default: 3]")
+    parser.add_argument(
+        '--backoff',
+        dest='backoff',
+        metavar='SECONDS',
+        type=float,
+        default=2.0,
+        help="seconds to wait before the first retry, doubled for every retry after that [Default: 2.0]")
+    parser.add_argument(
+        '--retry-failed',
+        dest='retry_failed',
+        action='store_true',
+        help="only copy the files queued as failed by earlier runs, without checking the input for changes.")
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help="after the backup, keep watching the input and copy files as they're written, until stopped with Ctrl+C.")
+    parser.add_argument(
+        '--settle',
+        dest='settle',
+        metavar='SECONDS',
+        type=float,
+        default=60.0,
+        help="with --watch, only copy a file once it hasn't changed for this long [Default: 60]")
+    parser.add_argument(
+        '--poll',
+        dest='poll_interval',
+        metavar='SECONDS',
+        type=float,
+        help="with --watch, check the input for changes every SECONDS instead of using inotify;\n"
+            "needed when the input is a network share written to by another machine [Default: inotify, if available]")
+    parser.add_argument(
+        '--max-rate',
+        dest='max_rate',
+        metavar='RATE',
+        help="limit on the bytes sent to the Z-drive per second (by all instruments), with an optional K/M/G suffix (e.g. 20M), 0 for unlimited;\n"
+            "overrides \"max_rate\" of the instruments in the \"throttle\" section of config.json [Default: unlimited]")
+    parser.add_argument(
+        '--low-priority',
+        dest='low_priority',
+        action='store_true',
+        help="run with lowered CPU (nice) and I/O (idle class) priority so that the instrument PCs come first.")
+    parser.add_argument(
+        '--copy-backend',
+        dest='backend',
+        choices=BACKENDS,
+        default='auto',
+        help="how files are copied, falling back per file to the next one that works:\n"
+            "  copy_file_range/sendfile: in the kernel, the checksum is computed by reading the copy back\n"
+            "  buffered: through a buffer that is also hashed\n"
+            "  auto: the kernel backends with --hash none, otherwise buffered [Default: auto]")
 
     args = parser.parse_args()
 
     # parser errors and processing
     # --------------------------------------------------
-    args.destination_path = Path(_configs['instruments'][args.instrument])
+    if args.workers < 1: parser.error(f"--workers must be at least 1, got {args.workers}.")
+    if args.retries < 0: parser.error(f"--retries can't be negative, got {args.retries}.")
+    sources: dict = _configs.get('sources', {})
+    if args.all_instruments:
+        args.instruments = [instrument for instrument in sources if instrument in _configs['instruments']]
+        if not args.instruments: parser.error("--all needs the input of every instrument in the \"sources\" section of config.json.")
+    # remove duplicates, but keep the order
+    args.instruments = list(dict.fromkeys(args.instruments))
+    if len(args.instruments) > 1:
+        if args.input_path or args.plan_path: parser.error("input_path and --apply-plan can only be used with a single --instrument.")
+        missing_sources: list = [instrument for instrument in args.instruments if not sources.get(instrument)]
+        if missing_sources: parser.error(f"No input for {', '.join(missing_sources)} in the \"sources\" section of config.json.")
+    if args.plan_path:
+        if args.check or args.retry_failed: parser.error("--apply-plan can't be used with --check or --retry-failed.")
+        try: plan_header: dict = _read_plan_header(args.plan_path)
+        except (OSError, ValueError, KeyError) as error: parser.error(f"Couldn't read plan {args.plan_path}: {error}")
+        if plan_header['instrument'] != args.instruments[0]: parser.error(f"Plan {args.plan_path} was made for --instrument {plan_header['instrument']}, not {args.instruments[0]}.")
+        if args.input_path is None: args.input_path = Path(plan_header['input_path'])
+    elif args.input_path is None and not sources.get(args.instruments[0]): parser.error("the following arguments are required: input_path")
+    if args.algorithm == 'none':
+        if args.verify: parser.error("--verify needs a checksum, it can't be used with --hash none.")
+        args.algorithm = None
+    if args.watch and (args.check or args.plan_path or args.retry_failed): parser.error("--watch can't be used with --check, --apply-plan or --retry-failed.")
+    if args.settle < 0: parser.error(f"--settle can't be negative, got {args.settle}.")
+    if args.poll_interval is not None and args.poll_interval <= 0: parser.error(f"--poll must be positive, got {args.poll_interval}.")
     args.log_path = Path(_configs['log_output'])
 
+    # bandwidth limits: --max-rate wins over the config (and is shared when there are several instruments), the schedule only comes from the config
+    try:
+        max_rate: int = parse_rate(args.max_rate)
+        shared_limiter: RateLimiter = RateLimiter(max_rate) if max_rate and len(args.instruments) > 1 else None
+    except ValueError as error:
+        parser.error(f"Invalid --max-rate: {error}")
+
+    # everything that differs between instruments
+    jobs: list = []
+    for instrument in args.instruments:
+        job = Namespace(**vars(args))
+        job.instrument = instrument
+        job.input_path = args.input_path or Path(sources[instrument])
+        job.destination_path = Path(_configs['instruments'][instrument])
+        job.failure_queue_path = args.log_path.joinpath(f'{instrument}_failed.json')
+        throttle: dict = _configs.get('throttle', {}).get(instrument, {})
+        try:
+            job.max_rate = max_rate if args.max_rate is not None else parse_rate(throttle.get('max_rate'))
+            job.limiter = shared_limiter or RateLimiter(job.max_rate, throttle.get('schedule'))
+        except (ValueError, KeyError) as error:
+            parser.error(f"Invalid throttle config for {instrument}: {error}")
+        jobs.append(job)
+    args.jobs = jobs
+
     return args
 # --------------------------------------------------
-def _copy_to_drive(_input_path: Path, _destination_path: Path, _directory_changes: dict, ) -> None:
+def _copy_file(_input_path: Path, _destination_path: Path, _file: Path, _algorithm: str = 'md5', _verify: bool = False, _backend: str = 'auto', _limiter: RateLimiter = None, _metrics: RunMetrics = None) -> tuple:
+    """
+    Function copies a single file (and all of its metadata) from the input to the destination, see transfer.copy_file().
+
+    Parameters:
+        _input_path: Path
+            path of input directory, should be the root
+        _destination_path: Path
+            path of destination directory, should be the instrument
+        _file: Path
+            path of the file, relative to the input directory
+        _algorithm: str
+            name of the hashlib algorithm used for the checksum, or None to skip the checksum
+        _verify: bool
+            if True, read the copy back from the destination and compare its checksum
+        _backend: str
+            copy backend to try first, one of transfer.BACKENDS
+        _limiter: RateLimiter
+            optional limit on the bytes sent per second, shared by all workers
+        _metrics: RunMetrics
+            optional metrics the bytes and duration of the copy are added to
+
+    Returns:
+        (tuple): (digest, backend)
+            digest: hex digest of the input file, or None if no algorithm was given
+            backend: name of the backend that actually copied the file
+    """
+
+    logging.info(f"Copying {_file} ...")
+    started: float = time.perf_counter()
+    digest, backend = copy_file(_input_path.joinpath(_file), _destination_path.joinpath(_file), _algorithm, _verify, _backend, _limiter)
+    seconds: float = time.perf_counter() - started
+    size: int = os.stat(_input_path.joinpath(_file)).st_size
+    if _metrics: _metrics.record_copy(_file, size, seconds, backend)
+    logging.info(f"Successfully copied {_file} ({backend}, {format_bytes(size)} in {seconds:.2f} s).")
+    return (digest, backend)
+def _sync_file(_input_path: Path, _destination_path: Path, _file: Path, _algorithm: str = 'md5', _verify: bool = False, _limiter: RateLimiter = None, _metrics: RunMetrics = None, _signature_cache: SignatureCache = None) -> tuple:
+    """
+    Function brings the destination copy of a modified file up to date, see transfer.sync_file().
+
+    Parameters:
+        _input_path: Path
+            path of input directory, should be the root
+        _destination_path: Path
+            path of destination directory, should be the instrument
+        _file: Path
+            path of the file, relative to the input directory
+        _algorithm: str
+            name of the hashlib algorithm used for the checksum, or None to skip the checksum
+        _verify: bool
+            if True, read the copy back from the destination and compare its checksum
+        _limiter: RateLimiter
+            optional limit on the bytes sent per second, shared by all workers
+        _metrics: RunMetrics
+            optional metrics the bytes (sent or reused) and duration of the sync are added to
+        _signature_cache: SignatureCache
+            optional local cache of the block signatures of the copies, so they aren't read back from the destination
+
+    Returns:
+        (tuple): (digest, "delta")
+            digest: hex digest of the input file, or None if no algorithm was given
+    """
+
+    logging.info(f"Syncing {_file} ...")
+    started: float = time.perf_counter()
+    digest, literal_bytes, matched_bytes = sync_file(_input_path.joinpath(_file), _destination_path.joinpath(_file), _algorithm, _verify, limiter=_limiter, signature_cache=_signature_cache)
+    seconds: float = time.perf_counter() - started
+    if _metrics: _metrics.record_copy(_file, literal_bytes + matched_bytes, seconds, 'delta')
+    logging.info(f"Successfully synced {_file} (sent {literal_bytes} byte(s), reused {matched_bytes} byte(s) in {seconds:.2f} s).")
+    return (digest, 'delta')
+def _bundle_files(_input_path: Path, _destination_path: Path, _files: list, _algorithm: str = 'md5', _verify: bool = False, _limiter: RateLimiter = None, _metrics: RunMetrics = None) -> tuple:
+    """
+    Function packs small files into a single bundle at the destination, see bundle.write_bundle().
+
+    Parameters:
+        _input_path: Path
+            path of input directory, should be the root
+        _destination_path: Path
+            path of destination directory, should be the instrument
+        _files: list
+            paths of the files, relative to the input directory
+        _algorithm: str
+            name of the hashlib algorithm used for the checksum, or None to skip the checksum
+        _verify: bool
+            if True, read the bundle back from the destination and compare its checksum
+        _limiter: RateLimiter
+            optional limit on the bytes sent per second, shared by all workers
+        _metrics: RunMetrics
+            optional metrics the bytes and duration of the bundle are added to
+
+    Returns:
+        (tuple): (digests, errors)
+            digests: dict, file: hex digest of every bundled file
+            errors: dict, file: error for the files that couldn't be read
+    """
+
+    logging.info(f"Bundling {len(_files)} small file(s) ...")
+    started: float = time.perf_counter()
+    bundle_file, digests, errors = write_bundle(_input_path, _destination_path, _files, _algorithm, _verify, _limiter)
+    seconds: float = time.perf_counter() - started
+    size: int = sum([os.stat(_input_path.joinpath(file)).st_size for file in digests])
+    if _metrics: _metrics.record_copy(bundle_file.relative_to(_destination_path), size, seconds, 'bundle', len(digests))
+    logging.info(f"Successfully bundled {len(digests)} file(s) into {bundle_file.relative_to(_destination_path)} ({format_bytes(size)} in {seconds:.2f} s).")
+    return (digests, errors)
+def _retry(_retries: int, _backoff: float, _function, _input_path: Path, _destination_path: Path, _file: Path, *args) -> tuple:
+    """
+    Function calls a copy function, retrying it with exponential backoff if it fails with a transient error.
+    Interrupted copies of large files are resumed rather than started over (see transfer.copy_file()).
+
+    Parameters:
+        _retries: int
+            number of times to retry
+        _backoff: float
+            seconds to wait before the first retry, doubled for every retry after that
+        _function: function
+            _copy_file(), _sync_file() or _bundle_files() (with a list of files)
+        _input_path, _destination_path, _file, *args:
+            passed on to the function
+
+    Returns:
+        (tuple): whatever the function returns
+    """
+
+    for attempt in range(_retries + 1):
+        try: return _function(_input_path, _destination_path, _file, *args)
+        except Exception as error:
+            if attempt == _retries or not _is_transient(error): raise
+            delay: float = _backoff * 2 ** attempt
+            logging.warning(f"Error occured trying to copy {f'bundle of {len(_file)} file(s)' if isinstance(_file, list) else f'file: {_file}'} ({error}); retrying in {delay:g} s ({attempt + 1}/{_retries}) ...")
+            time.sleep(delay)
+def _is_transient(_error: Exception) -> bool:
+    """
+    Function decides whether an error is worth retrying: I/O errors (dropped network share, unplugged drive, ...) and
+    corrupted transfers are, missing files and permission errors are not.
+
+    Parameters:
+        _error: Exception
+            error raised by a copy
+
+    Returns:
+        (bool): True if the copy should be retried
+    """
+
+    if isinstance(_error, PERMANENT_ERRORS): return False
+    return isinstance(_error, (OSError, ChecksumMismatchError))
+def _copy_to_drive(_input_path: Path, _destination_path: Path, _changes: Iterable, _workers: int = 1, _index: sqlite3.Connection = None, _check: bool = False, _manifest_path: Path = None, _algorithm: str = 'md5', _verify: bool = False, _backend: str = 'auto', _sync_updated: bool = False, _retries: int = 0, _backoff: float = 2.0, _failure_queue: dict = None, _limiter: RateLimiter = None, _pool: WorkerPool = None, _bundle_small: int = None, _metrics: RunMetrics = None, _signature_cache: SignatureCache = None) -> dict:
     """
-    Function uses shutil to copy input files to destination from a list of directory changes.
+    Function copies input files to destination as directory changes are found.
+    Changes are consumed one at a time, so copying starts as soon as the first new file is found.
 
     Paramaters:
         _input_path: Path
             path of input directory, should be the root
         _destination_path: Path
             path of destination directory, should be the instrument
-        _directory_changes: dict
-            "new_files": list of files that do not exist in the destination
-            "updated_files": list of files that do exist, but have been updated
+        _changes: Iterable
+            (change, path, stat) records, usually streamed from _identify_changes()
+                change: "new" for paths that do not exist in the destination, "updated" for files that do exist, but have been updated
+                path: path relative to the input directory
+                stat: cached stat of the path in the input
+        _workers: int
+            number of files to copy concurrently
+        _index: sqlite3.Connection
+            optional index of backed up files, every successfully copied path is recorded in it
+        _check: bool
+            if True, only consume the changes without copying anything
+        _manifest_path: Path
+            optional path of the checksum manifest (md5sum -c format, relative to the destination) the copied files are added to
+        _algorithm: str
+            name of the hashlib algorithm used for the checksum, or None to skip the checksum
+        _verify: bool
+            if True, read every copied file back from the destination and compare its checksum
+        _backend: str
+            copy backend to try first, one of transfer.BACKENDS
+        _sync_updated: bool
+            if True, bring modified files up to date by only sending the blocks that changed
+        _retries: int
+            number of times a file is retried after a transient error
+        _backoff: float
+            seconds to wait before the first retry, doubled for every retry after that
+        _failure_queue: dict
+            optional queue of failed files (see _load_failure_queue()), copied files are removed from it and failed files are added
+        _limiter: RateLimiter
+            optional limit on the bytes sent per second, shared by all workers
+        _pool: WorkerPool
+            optional workers shared with other instruments, otherwise _workers workers are started just for this
+        _bundle_small: int
+            optional size in bytes, new files smaller than this are packed into bundles instead of copied one by one
+        _metrics: RunMetrics
+            optional metrics of the scan (the time spent waiting on _changes) and of every copy
+        _signature_cache: SignatureCache
+            optional local cache of the block signatures of synced copies (see transfer.SignatureCache)
 
     Returns:
-        None
+        summary: dict
+            "copied": number of paths copied
+            "failed": list of (path, error) for the paths that couldn't be copied
+            "skipped_updated": number of modified files that weren't copied
     """
 
-    logging.info("Starting backup ...")
+    pool: WorkerPool = _pool or WorkerPool(_workers)
+    if _check: logging.info("Starting check ...")
+    else: logging.info(f"Starting backup using {pool.workers} {'shared ' if _pool else ''}worker(s) ...")
 
     success_count = 0
     failed_transfers = []
+    skipped_updated_count = 0
+    # number of files copied by each backend
+    backend_counts: dict = {}
+    # the manifest is only opened once there's a checksum to write, so backups that copy nothing don't leave one behind
+    write_manifest: bool = bool(_manifest_path and _algorithm and not _check)
+    manifest = None
+    manifest_count: int = 0
 
-    # iterate over directory changes and perform backup
-    for file in _directory_changes['new_files']:
-        logging.info(f"Copying {file} ...")
-        try:
-            # copy the file and all metadata
-            if _input_path.joinpath(file).is_file(): shutil.copy2(_input_path.joinpath(file), _destination_path.joinpath(file))
-            # dirs don't copy their metadata, just make a dir
-            elif _input_path.joinpath(file).is_dir(): _destination_path.joinpath(file).mkdir()
-            logging.info(f"Successfully copied {file} .")
-            success_count += 1
-        except:
-            # proceed with the other files but log that this one failed
-            logging.warning(f"Error occured trying to copy file: {file}")
-            failed_transfers.append(file)
+    # files waiting on (or being copied by) the workers, at most pool.max_pending() at any time
+    pending: dict = {}
+    # small files waiting to be bundled, and their total size
+    bundle_batch: list = []
+    bundle_size: int = 0
+    if _metrics:
+        _changes = _metrics.timed_scan(_changes)
+        _metrics.start_copy()
 
-    failed_transfers_str: str = '\n'.join(failed_transfers)
+    def _collect(_futures) -> None:
+        """ account for copies that have finished """
+        nonlocal manifest, manifest_count
+        for future in _futures:
+            change, file, file_stat = pending.pop(future)
+            if change == 'bundle':
+                _collect_bundle(future, file, file_stat)
+                continue
+            try:
+                digest, backend = future.result()
+                _succeeded(change, file, file_stat)
+                backend_counts[backend] = backend_counts.get(backend, 0) + 1
+                if write_manifest and digest:
+                    if manifest is None: manifest = open(_manifest_path, 'a', encoding='utf-8')
+                    manifest.write(f"{digest}  {file.as_posix()}\n")
+                    manifest_count += 1
+            except Exception as error:
+                _failed(change, file, error)
+        return None
+    def _collect_bundle(_future, _files: list, _file_stats: list) -> None:
+        """ account for a bundle that has finished, the checksums of bundled files are kept in the index of the bundle """
+        try: digests, errors = _future.result()
+        except Exception as error:
+            for file in _files: _failed('new', file, error)
+            return None
+        for file, file_stat in zip(_files, _file_stats):
+            if file in errors: _failed('new', file, errors[file])
+            else:
+                _succeeded('new', file, file_stat)
+                backend_counts['bundle'] = backend_counts.get('bundle', 0) + 1
+        return None
+    def _make_room() -> None:
+        """ don't let the scan run too far ahead of the workers: wait for a copy to finish if too many are pending """
+        if len(pending) < pool.max_pending(): return None
+        started: float = time.perf_counter()
+        _collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        if _metrics: _metrics.worker_wait_seconds += time.perf_counter() - started
+        return None
+    def _submit_bundle() -> None:
+        """ hand the small files collected so far to a worker as a single bundle """
+        nonlocal bundle_batch, bundle_size
+        if not bundle_batch: return None
+        _make_room()
+        files, file_stats = [file for file, _ in bundle_batch], [file_stat for _, file_stat in bundle_batch]
+        pending[pool.submit(_retry, _retries, _backoff, _bundle_files, _input_path, _destination_path, files, _algorithm, _verify, _limiter, _metrics)] = ('bundle', files, file_stats)
+        bundle_batch, bundle_size = [], 0
+        return None
+    def _succeeded(_change: str, _file: Path, _file_stat: os.stat_result) -> None:
+        """ account for a path that was copied """
+        nonlocal success_count
+        success_count += 1
+        if _index: _record_in_index(_index, _file, _file_stat)
+        if _failure_queue is not None: _failure_queue.pop(_file.as_posix(), None)
+        return None
+    def _failed(_change: str, _file: Path, _error: Exception) -> None:
+        """ account for a path that couldn't be copied, proceed with the other files but log that this one failed """
+        logging.warning(f"Error occured trying to copy file: {_file} ({_error})")
+        failed_transfers.append((_file, _error))
+        if _metrics: _metrics.record_failure()
+        if _failure_queue is not None: _failure_queue[_file.as_posix()] = {'path': _file.as_posix(), 'change': _change, 'error': str(_error), 'failed_at': datetime.now().isoformat(timespec='seconds')}
+        return None
+
+    pool.attach()
+    try:
+        for change, file, file_stat in _changes:
+            # modified files are only reported, unless they should be synced
+            if change == 'updated' and not _sync_updated: skipped_updated_count += 1
+            if _check or (change == 'updated' and not _sync_updated): continue
+            if _metrics: _metrics.record_found(file_stat)
+            # files that are only in a bundle, or whose copy is gone, have nothing to sync against, so they're copied (or bundled) again
+            if change == 'updated' and not _destination_path.joinpath(file).is_file():
+                logging.info(f"Modified file {file} has no copy of its own in the destination, copying it instead of syncing it.")
+                change = 'new'
+
+            if change == 'updated':
+                _make_room()
+                pending[pool.submit(_retry, _retries, _backoff, _sync_file, _input_path, _destination_path, file, _algorithm, _verify, _limiter, _metrics, _signature_cache)] = (change, file, file_stat)
+            elif stat.S_ISDIR(file_stat.st_mode):
+                # folders are found before anything inside them, so make them right away
+                logging.info(f"Copying {file} ...")
+                try:
+                    # dirs don't copy their metadata, just make a dir
+                    _destination_path.joinpath(file).mkdir(parents=True, exist_ok=True)
+                    logging.info(f"Successfully copied {file} .")
+                    _succeeded(change, file, file_stat)
+                except Exception as error:
+                    _failed(change, file, error)
+            elif stat.S_ISREG(file_stat.st_mode) and _bundle_small and file_stat.st_size < _bundle_small:
+                # small files are sent together once there are enough of them
+                bundle_batch.append((file, file_stat))
+                bundle_size += file_stat.st_size
+                if bundle_size >= BUNDLE_MAX_SIZE or len(bundle_batch) >= BUNDLE_MAX_FILES: _submit_bundle()
+            elif stat.S_ISREG(file_stat.st_mode):
+                # copy the file and all metadata, but don't let the scan run too far ahead of the workers
+                _make_room()
+                pending[pool.submit(_retry, _retries, _backoff, _copy_file, _input_path, _destination_path, file, _algorithm, _verify, _backend, _limiter, _metrics)] = (change, file, file_stat)
+
+        # account for whatever is left once the scan is done
+        _submit_bundle()
+        _collect(wait(pending).done)
+    finally:
+        pool.detach()
+        if not _pool: pool.shutdown()
+        if _metrics: _metrics.finish_copy()
+
+    if _index: _index.commit()
+    if manifest:
+        manifest.close()
+        logging.info(f"Wrote {_algorithm} checksums of {manifest_count} copied file(s) to {_manifest_path} .")
+
+    summary: dict = {'copied': success_count, 'failed': failed_transfers, 'skipped_updated': skipped_updated_count}
+    if skipped_updated_count: logging.info(f"{skipped_updated_count} modified file(s) were not copied; use --sync-updated to copy them.")
+    if _check: return summary
+    if backend_counts: logging.info(f"Files copied per backend: {', '.join([f'{backend}={count}' for backend, count in sorted(backend_counts.items())])}")
+    if _metrics: logging.info(_metrics.summary())
+    failed_transfers_str: str = '\n'.join([f"\t{file} ({error})" for file, error in failed_transfers])
     if failed_transfers: logging.warning(f"Backup finished. Successfully copied {success_count} file(s); {len(failed_transfers)} file(s) failed:\n{failed_transfers_str}")
     else: logging.info(f"Backup finished. Successfully copied {success_count} file(s).")
+    return summary
+def _scan_directory(_path: Path) -> dict:
+    """
+    Function lists a single directory exactly once.
+
+    Parameters:
+        _path: Path
+            path of the directory to list
+
+    Returns:
+        entries: dict
+            entry name: os.DirEntry, which caches its own stat after the first call
+    """
+
+    with os.scandir(_path) as directory:
+        return {entry.name: entry for entry in directory}
+def _identify_changes(_input_path: Path, _destination_path: Path, _index: sqlite3.Connection = None, _metrics: RunMetrics = None) -> Iterator:
+    """
+    Function identifies identifies differences between paths and yields them as they are found.
+    Both trees are walked together and only once: every input directory is listed once, and the
+    matching destination directory is listed at most once. If an index of backed up files is given,
+    the destination directory is only listed when the index doesn't know about one of its entries.
+    Folders are always yielded before anything inside them.
+
+    Parameters:
+        _input_path: Path
+            path of input directory, should be the root
+        _destination_path: Path
+            path of destination directory, should be the instrument
+        _index: sqlite3.Connection
+            optional index of backed up files, entries found in the destination are added to it
+        _metrics: RunMetrics
+            optional metrics the time spent listing the input and destination folders is added to
+
+    Yields:
+        (change, path, stat): tuple
+            change: "new" for paths that do not exist in the destination, "updated" for files that do exist, but have been updated
+            path: path relative to the input directory
+            stat: cached stat of the path in the input
+    """
+
+    # running counts of what's been found
+    checked_files_num: int = 0
+    listed_dirs_num: int = 0
+    updated_files_num: int = 0
+    num_files: int = 0
+    num_dirs: int = 0
+
+    try:
+        # stack of (directory relative to input, whether it exists in the destination)
+        directories: list = [(Path(), _destination_path.is_dir())]
+        while directories:
+            relative_dir, destination_dir_exists = directories.pop()
+            listing_started: float = time.perf_counter()
+            source_entries: dict = _scan_directory(_input_path.joinpath(relative_dir))
+            if _metrics: _metrics.record_listing('input', time.perf_counter() - listing_started)
+            # destination is only listed once something in this folder isn't in the index
+            destination_entries: dict = None
+
+            # reversed so that directories come back off the stack in sorted order
+            for name in sorted(source_entries, reverse=True):
+                checked_files_num += 1
+                adjusted_path = relative_dir.joinpath(name)
+                source_stat = source_entries[name].stat()
+
+                backed_up: tuple = _lookup_index(_index, adjusted_path) if _index else None
+                if backed_up is None:
+                    if destination_entries is None:
+                        listing_started: float = time.perf_counter()
+                        destination_entries = _scan_directory(_destination_path.joinpath(relative_dir)) if destination_dir_exists else {}
+                        listed_dirs_num += destination_dir_exists
+                        if _metrics and destination_dir_exists: _metrics.record_listing('destination', time.perf_counter() - listing_started)
+                    destination_entry = destination_entries.get(name)
+                    if destination_entry is not None:
+                        destination_stat = destination_entry.stat()
+                        backed_up = (stat.S_ISDIR(destination_stat.st_mode), destination_stat.st_size, destination_stat.st_mtime)
+                        if _index: _record_in_index(_index, adjusted_path, destination_stat)
+
+                if backed_up is None:
+                    if stat.S_ISDIR(source_stat.st_mode):
+                        num_dirs += 1
+                        logging.info(f"Found new folder: {adjusted_path}")
+                    elif stat.S_ISREG(source_stat.st_mode):
+                        num_files += 1
+                        logging.info(f"Found new file: {adjusted_path}")
+                    yield ('new', adjusted_path, source_stat)
+                elif all([
+                    stat.S_ISREG(source_stat.st_mode),
+                    not backed_up[0],
+                    _is_modified(source_stat, backed_up[1], backed_up[2])]):
+                    updated_files_num += 1
+                    logging.info(f"Found modified file: {adjusted_path}")
+                    yield ('updated', adjusted_path, source_stat)
+
+                if stat.S_ISDIR(source_stat.st_mode): directories.append((adjusted_path, backed_up is not None and backed_up[0]))
+    except:
+        logging.critical("Critical error when trying to identify changes between directories!")
+        raise
+    finally:
+        if _index: _index.commit()
+        if _metrics: _metrics.entries_checked += checked_files_num
+
+    logging.info(f"Checked {checked_files_num} files; listed {listed_dirs_num} destination folder(s).")
+    logging.info(f"Found {updated_files_num} modified file(s).")
+    logging.info(f"Found {num_files + num_dirs} total new paths: {num_dirs} folder(s) and {num_files} file(s).\n")
+    return None
+def _is_modified(_source_stat: os.stat_result, _destination_size: int, _destination_mtime: float) -> bool:
+    """
+    Function compares the cached stat of an input file with the size and modification time of its destination copy.
+
+    Parameters:
+        _source_stat: os.stat_result
+            stat of the file in the input
+        _destination_size: int
+            size of the file in the destination
+        _destination_mtime: float
+            modification time of the file in the destination
+
+    Returns:
+        (bool): True if the sizes differ or the modification times differ by more than MTIME_TOLERANCE
+    """
+
+    if _source_stat.st_size != _destination_size: return True
+    return abs(_source_stat.st_mtime - _destination_mtime) > MTIME_TOLERANCE
+def _open_index(_log_path: Path, _instrument: str) -> sqlite3.Connection:
+    """
+    Function opens (and creates if needed) the local index of files backed up for an instrument.
+
+    Parameters:
+        _log_path: Path
+            path of log output directory, where the index is kept
+        _instrument: str
+            name of the instrument
+
+    Returns:
+        index: sqlite3.Connection
+            connection to the index
+    """
+
+    index = sqlite3.connect(_log_path.joinpath(f'{_instrument}_index.sqlite'))
+    index.execute("CREATE TABLE IF NOT EXISTS backed_up (path TEXT PRIMARY KEY, is_dir INTEGER NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL)")
+    index.commit()
+    return index
+def _lookup_index(_index: sqlite3.Connection, _path: Path) -> tuple:
+    """
+    Function looks up a path in the index of backed up files.
+
+    Parameters:
+        _index: sqlite3.Connection
+            index of backed up files
+        _path: Path
+            path relative to the instrument folder
+
+    Returns:
+        (tuple): (is_dir, size, mtime) of the backed up path, or None if the index doesn't know about it
+    """
+
+    row = _index.execute("SELECT is_dir, size, mtime FROM backed_up WHERE path = ?", (_path.as_posix(),)).fetchone()
+    if row is None: return None
+    return (bool(row[0]), row[1], row[2])
+def _record_in_index(_index: sqlite3.Connection, _path: Path, _stat: os.stat_result) -> None:
+    """
+    Function records a backed up path in the index. Changes are only saved when the index is committed.
+
+    Parameters:
+        _index: sqlite3.Connection
+            index of backed up files
+        _path: Path
+            path relative to the instrument folder
+        _stat: os.stat_result
+            stat of the backed up path
+
+    Returns:
+        None
+    """
+
+    _index.execute(
+        "INSERT OR REPLACE INTO backed_up (path, is_dir, size, mtime) VALUES (?, ?, ?, ?)",
+        (_path.as_posix(), stat.S_ISDIR(_stat.st_mode), _stat.st_size, _stat.st_mtime))
+    return None
+def _rebuild_index(_index: sqlite3.Connection, _destination_path: Path) -> None:
+    """
+    Function throws away the index of backed up files and rebuilds it by walking the whole destination.
+
+    Parameters:
+        _index: sqlite3.Connection
+            index of backed up files
+        _destination_path: Path
+            path of destination directory, should be the instrument
+
+    Returns:
+        None
+    """
+
+    logging.info(f"Rebuilding index of {_destination_path} ...")
+    _index.execute("DELETE FROM backed_up")
+
+    indexed_num: int = 0
+    directories: list = [Path()] if _destination_path.is_dir() else []
+    while directories:
+        relative_dir = directories.pop()
+        for name, entry in _scan_directory(_destination_path.joinpath(relative_dir)).items():
+            # temporary files of interrupted copies aren't backed up yet, bundles are indexed by what's in them
+            if is_partial(name) or (relative_dir == Path() and name == BUNDLE_DIR): continue
+            destination_stat = entry.stat()
+            _record_in_index(_index, relative_dir.joinpath(name), destination_stat)
+            indexed_num += 1
+            if stat.S_ISDIR(destination_stat.st_mode): directories.append(relative_dir.joinpath(name))
+    # files that are only in bundles, unless they've been unpacked since
+    for file, bundled_stat in bundled_files(_destination_path):
+        if _lookup_index(_index, file) is not None: continue
+        _record_in_index(_index, file, bundled_stat)
+        indexed_num += 1
+
+    _index.commit()
+    logging.info(f"Rebuilt index of {_destination_path} with {indexed_num} path(s).\n")
     return None
-def _identify_changes(_input_path: Path, _destination_path: Path) -> dict:
+def _write_plan(_changes: Iterable, _plan_path: Path, _instrument: str, _input_path: Path, _destination_path: Path) -> Iterator:
     """
-    Function identifies identifies differences between paths and returns a dictionary of changes.
+    Function passes changes through unchanged while writing them to a plan file that --apply-plan can execute later.
+    The plan is JSON lines: a header, then one line per change. Paths are relative to the input and destination in the header.
 
     Parameters:
+        _changes: Iterable
+            (change, path, stat) records, see _identify_changes()
+        _plan_path: Path
+            path of the plan file
+        _instrument: str
+            name of the instrument
         _input_path: Path
             path of input directory, should be the root
         _destination_path: Path
             path of destination directory, should be the instrument
 
+    Yields:
+        (change, path, stat): tuple
+            the changes that were passed in
+    """
+
+    planned_num: int = 0
+    with open(_plan_path, 'w', encoding='utf-8') as plan_file:
+        plan_file.write(json.dumps({
+            'plan': 1,
+            'instrument': _instrument,
+            'input_path': str(_input_path.resolve()),
+            'destination_path': str(_destination_path.resolve()),
+            'created': datetime.now().isoformat(timespec='seconds')}) + '\n')
+        for change, file, file_stat in _changes:
+            plan_file.write(json.dumps({
+                'action': change,
+                'type': 'dir' if stat.S_ISDIR(file_stat.st_mode) else 'file',
+                'path': file.as_posix(),
+                'size': file_stat.st_size,
+                'mtime': file_stat.st_mtime}) + '\n')
+            planned_num += 1
+            yield (change, file, file_stat)
+    logging.info(f"Wrote plan with {planned_num} change(s) to {_plan_path}; copy them with --apply-plan {_plan_path}")
+    return None
+def _read_plan_header(_plan_path: Path) -> dict:
+    """
+    Function reads the header of a plan file written by _write_plan().
+
+    Parameters:
+        _plan_path: Path
+            path of the plan file
+
     Returns:
-        _directory_changes: dict
-            "new_files": list of files that do not exist in the destination
-            "updated_files": list of files that do exist, but have been updated
+        header: dict
+            "instrument", "input_path", "destination_path" and "created" of the plan
     """
 
-    new_files: list = []
-    updated_files: list = []
+    with open(_plan_path, encoding='utf-8') as plan_file:
+        header: dict = json.loads(plan_file.readline())
+    if header.get('plan') != 1: raise ValueError("not a plan file")
+    return header
+def _planned_changes(_plan_path: Path, _input_path: Path, _destination_path: Path, _index: sqlite3.Connection = None) -> Iterator:
+    """
+    Function yields the changes in a plan file, rechecking each entry (and only that entry) right before it's copied:
+    entries whose input is gone are dropped, and entries that have been backed up since the plan was made are skipped.
 
-    # running count of files that've been checked
-    checked_files_num: int = 0
+    Parameters:
+        _plan_path: Path
+            path of the plan file
+        _input_path: Path
+            path of input directory, should be the root
+        _destination_path: Path
+            path of destination directory, should be the instrument
+        _index: sqlite3.Connection
+            optional index of backed up files, entries found in the destination are added to it
+
+    Yields:
+        (change, path, stat): tuple
+            see _identify_changes()
+    """
+
+    planned_num: int = 0
+    skipped_num: int = 0
+    with open(_plan_path, encoding='utf-8') as plan_file:
+        header: dict = json.loads(plan_file.readline())
+        logging.info(f"Applying plan {_plan_path} made {header['created']} ...")
+        for line in plan_file:
+            entry: dict = json.loads(line)
+            file: Path = Path(entry['path'])
+            planned_num += 1
+
+            try: source_stat = os.stat(_input_path.joinpath(file))
+            except FileNotFoundError:
+                logging.warning(f"Planned file {file} no longer exists in the input, skipping it.")
+                skipped_num += 1
+                continue
+            if entry['size'] != source_stat.st_size or abs(entry['mtime'] - source_stat.st_mtime) > MTIME_TOLERANCE:
+                logging.info(f"Planned file {file} changed in the input since the plan was made, copying the current version.")
+
+            try: destination_stat = os.stat(_destination_path.joinpath(file))
+            except FileNotFoundError: destination_stat = None
+            if destination_stat is None:
+                yield ('new', file, source_stat)
+                continue
+
+            if _index: _record_in_index(_index, file, destination_stat)
+            if all([
+                stat.S_ISREG(source_stat.st_mode),
+                stat.S_ISREG(destination_stat.st_mode),
+                _is_modified(source_stat, destination_stat.st_size, destination_stat.st_mtime)]):
+                yield ('updated', file, source_stat)
+            else:
+                # folders that already exist and files that were backed up since the plan was made
+                if not stat.S_ISDIR(source_stat.st_mode): logging.info(f"Planned file {file} is already backed up, skipping it.")
+                skipped_num += 1
+
+    logging.info(f"Applied plan with {planned_num} change(s); {skipped_num} no longer needed copying.\n")
+    return None
+def _watched_changes(_input_path: Path, _destination_path: Path, _paths: list, _index: sqlite3.Connection = None) -> Iterator:
+    """
+    Function yields the changes among paths reported by a watcher, checking each path against the index
+    (and only if the index doesn't know about it, the destination).
+
+    Parameters:
+        _input_path: Path
+            path of input directory, should be the root
+        _destination_path: Path
+            path of destination directory, should be the instrument
+        _paths: list
+            sorted paths that changed, relative to the input directory
+        _index: sqlite3.Connection
+            optional index of backed up files, entries found in the destination are added to it
+
+    Yields:
+        (change, path, stat): tuple
+            see _identify_changes()
+    """
+
+    for file in _paths:
+        # temporary files are often gone by the time they've settled
+        try: source_stat = os.stat(_input_path.joinpath(file))
+        except FileNotFoundError: continue
+        if not (stat.S_ISDIR(source_stat.st_mode) or stat.S_ISREG(source_stat.st_mode)): continue
 
-    # recursive list of files in the input, relative to input
-    for file in _input_path.glob('**/*'):
-        checked_files_num += 1
-        adjusted_path = file.resolve().relative_to(_input_path.resolve())
-        if not _destination_path.joinpath(adjusted_path).exists(): new_files.append(adjusted_path)
+        backed_up: tuple = _lookup_index(_index, file) if _index else None
+        if backed_up is None:
+            try: destination_stat = os.stat(_destination_path.joinpath(file))
+            except FileNotFoundError: destination_stat = None
+            if destination_stat is not None:
+                backed_up = (stat.S_ISDIR(destination_stat.st_mode), destination_stat.st_size, destination_stat.st_mtime)
+                if _index: _record_in_index(_index, file, destination_stat)
+
+        if backed_up is None:
+            logging.info(f"Found new {'folder' if stat.S_ISDIR(source_stat.st_mode) else 'file'}: {file}")
+            yield ('new', file, source_stat)
         elif all([
-            _destination_path.joinpath(adjusted_path).exists(),
-            _input_path.joinpath(adjusted_path).is_file(),
-            _input_path.joinpath(adjusted_path).stat().st_mtime != _input_path.joinpath(adjusted_path).stat().st_mtime]):
-            updated_files.append(adjusted_path)
+            stat.S_ISREG(source_stat.st_mode),
+            not backed_up[0],
+            _is_modified(source_stat, backed_up[1], backed_up[2])]):
+            logging.info(f"Found modified file: {file}")
+            yield ('updated', file, source_stat)
+    return None
+def _load_failure_queue(_queue_path: Path) -> dict:
+    """
+    Function loads the queue of files that failed to copy in earlier runs.
+
+    Parameters:
+        _queue_path: Path
+            path of the queue file
+
+    Returns:
+        queue: dict
+            relative path (posix): {"path": str, "change": "new" or "updated", "error": str, "failed_at": str}
+    """
+
+    if not _queue_path.exists(): return {}
+    with open(_queue_path, encoding='utf-8') as queue_file:
+        return {entry['path']: entry for entry in json.load(queue_file)}
+def _save_failure_queue(_queue_path: Path, _queue: dict) -> None:
+    """
+    Function atomically replaces the queue of files that failed to copy, removing it if it's empty.
+
+    Parameters:
+        _queue_path: Path
+            path of the queue file
+        _queue: dict
+            queue, see _load_failure_queue()
+
+    Returns:
+        None
+    """
+
+    if not _queue:
+        _queue_path.unlink(missing_ok=True)
+        return None
+    temporary_queue_path: Path = _queue_path.with_name(f"{_queue_path.name}.tmp")
+    with open(temporary_queue_path, 'w', encoding='utf-8') as queue_file:
+        json.dump([_queue[path] for path in sorted(_queue)], queue_file, indent=4)
+    os.replace(temporary_queue_path, _queue_path)
+    logging.warning(f"{len(_queue)} file(s) are queued as failed in {_queue_path}; run again with --retry-failed to retry them.")
+    return None
+def _queued_changes(_input_path: Path, _queue: dict) -> Iterator:
+    """
+    Function yields the files in the queue of failed files as changes, without checking the rest of the input.
+    Files that no longer exist in the input are dropped from the queue.
+
+    Parameters:
+        _input_path: Path
+            path of input directory, should be the root
+        _queue: dict
+            queue, see _load_failure_queue()
+
+    Yields:
+        (change, path, stat): tuple
+            see _identify_changes()
+    """
+
+    logging.info(f"Retrying {len(_queue)} queued file(s) ...")
+    # sorted so that folders come before anything inside them
+    for path in sorted(_queue):
+        try: source_stat = _input_path.joinpath(path).stat()
+        except FileNotFoundError:
+            logging.warning(f"Queued file {path} no longer exists in the input, dropping it from the queue.")
+            _queue.pop(path)
+            continue
+        yield (_queue[path]['change'], Path(path), source_stat)
+    return None
+def _backup_instrument(job: Namespace, runtime: str, pool: WorkerPool, stop: threading.Event, metrics: RunMetrics, log_prefix: str = '') -> dict:
+    """
+    Function backs up a single instrument: identifies directory changes between its paths (or just takes the files that
+    failed last time, or the files in a plan) and copies files from the input to the destination as they're found.
+    With --watch, it then keeps copying what changes in the input until stopped.
+
+    Parameters:
+        job: Namespace
+            arguments of the instrument (see get_args())
+        runtime: str
+            start of the run, used to name the checksum manifest and the plan
+        pool: WorkerPool
+            copy workers, shared with the other instruments
+        stop: threading.Event
+            set to stop watching the input
+        metrics: RunMetrics
+            metrics of the backup, saved as JSON beside the log
+        log_prefix: str
+            prefix of every message logged for this instrument
+
+    Returns:
+        summary: dict
+            see _copy_to_drive(), None if the backup crashed
+    """
+
+    LOG_PREFIX.set(log_prefix)
+
+    # open the local index of what has already been backed up, rebuilding it if asked to
+    index = _open_index(job.log_path, job.instrument)
+    if job.reindex:
+        try: _rebuild_index(index, job.destination_path)
+        except:
+            logging.critical("Critical error when trying to rebuild the index!")
+            index.close()
+            return None
+
+    # block signatures of synced copies are kept locally, so syncing a file again doesn't read its copy back from the destination
+    signature_cache = SignatureCache(job.log_path.joinpath(f'{job.instrument}_signatures.sqlite')) if job.sync_updated or job.retry_failed else None
+
+    # start watching before the backup, so nothing written while it runs is missed
+    watcher = _open_watcher(job) if job.watch else None
 
-    logging.info(f"Checked {checked_files_num} files.")
+    failure_queue: dict = _load_failure_queue(job.failure_queue_path)
+    if job.retry_failed: changes: Iterator = _queued_changes(job.input_path, failure_queue)
+    elif job.plan_path: changes: Iterator = _planned_changes(job.plan_path, job.input_path, job.destination_path, index)
+    else: changes: Iterator = _identify_changes(job.input_path, job.destination_path, index, metrics)
+    # save what --check finds so it can be copied without checking again
+    if job.check: changes = _write_plan(changes, job.log_path.joinpath(f'{runtime}_{job.instrument}.plan.jsonl'), job.instrument, job.input_path, job.destination_path)
+    manifest_path: Path = job.log_path.joinpath(f'{runtime}_{job.instrument}.{job.algorithm}') if job.algorithm else None
+    metrics_path: Path = job.log_path.joinpath(f'{runtime}_{job.instrument}.metrics.json')
+    try: summary: dict = _copy_to_drive(
+        job.input_path, job.destination_path, changes, job.workers, index, job.check, manifest_path, job.algorithm, job.verify, job.backend,
+        job.sync_updated or job.retry_failed, job.retries, job.backoff, failure_queue, job.limiter, pool, job.bundle_small, metrics, signature_cache)
+    except:
+        logging.critical("Critical error when trying to performing backup!")
+        summary: dict = None
+    if not job.check or summary is None: _save_failure_queue(job.failure_queue_path, failure_queue)
+    metrics.write(metrics_path)
+
+    if watcher:
+        if summary is not None: summary = _watch_input(job, watcher, index, manifest_path, failure_queue, pool, stop, summary, metrics, metrics_path, signature_cache)
+        watcher.close()
+    if signature_cache: signature_cache.close()
+    index.close()
+    return summary
+def _open_watcher(job: Namespace):
+    """
+    Function starts watching the input of an instrument with inotify, falling back to polling if inotify isn't available.
+
+    Parameters:
+        job: Namespace
+            arguments of the instrument (see get_args())
+
+    Returns:
+        (InotifyWatcher or PollingWatcher): see watch.py
+    """
+
+    if job.poll_interval is None:
+        try: return InotifyWatcher(job.input_path)
+        except (OSError, AttributeError) as error: logging.warning(f"Can't watch {job.input_path} with inotify ({error}); checking it every 30 s instead.")
+    return PollingWatcher(job.input_path, job.poll_interval or 30.0)
+def _watch_input(job: Namespace, watcher, index: sqlite3.Connection, manifest_path: Path, failure_queue: dict, pool: WorkerPool, stop: threading.Event, summary: dict, metrics: RunMetrics = None, metrics_path: Path = None, signature_cache: SignatureCache = None) -> dict:
+    """
+    Function copies whatever changes in the input of an instrument until stopped. Changed paths are only copied once
+    nothing has changed them for --settle seconds, so files that are still being written aren't copied half-way; only the
+    changed paths are checked against the index and destination, never the whole input (unless the watcher missed changes).
+
+    Parameters:
+        job: Namespace
+            arguments of the instrument (see get_args())
+        watcher: InotifyWatcher or PollingWatcher
+            watcher of the input, see watch.py
+        index: sqlite3.Connection
+            index of backed up files
+        manifest_path: Path
+            optional path of the checksum manifest the copied files are added to
+        failure_queue: dict
+            queue of failed files (see _load_failure_queue()), saved after every batch
+        pool: WorkerPool
+            copy workers, shared with the other instruments
+        stop: threading.Event
+            set to stop watching
+        summary: dict
+            summary of the backup before watching, see _copy_to_drive()
+        metrics: RunMetrics
+            optional metrics everything copied while watching is added to
+        metrics_path: Path
+            optional path the metrics are saved to after every batch
+        signature_cache: SignatureCache
+            optional local cache of the block signatures of synced copies
+
+    Returns:
+        summary: dict
+            totals of the backup and everything copied while watching, see _copy_to_drive()
+    """
+
+    logging.info(f"Watching {job.input_path} for changes ({watcher.method}); files are copied once they haven't changed for {job.settle:g} s. Stop with Ctrl+C.\n")
+    # path: monotonic time it last changed, None stands for the whole input when the watcher missed changes
+    last_changed: dict = {}
+    while not stop.is_set():
+        now: float = time.monotonic()
+        timeout: float = min([WATCH_TICK, *[changed_at + job.settle + WATCH_TICK - now for changed_at in last_changed.values()]])
+        for path in watcher.changes(timeout): last_changed[path] = time.monotonic()
+        if watcher.overflowed:
+            logging.warning("Some changes were missed, the whole input will be checked again once it settles.")
+            watcher.overflowed = False
+            last_changed[None] = time.monotonic()
 
-    # counts
-    updated_files_num: int = len(updated_files)
-    num_files: int = len([thing for thing in new_files if _input_path.joinpath(thing).is_file()])
-    num_dirs: int = len([thing for thing in new_files if _input_path.joinpath(thing).is_dir()])
-    total: int = num_files + num_dirs
+        # copy whatever has settled, folders before anything inside them; paths that settle within a tick of each other are copied together
+        now: float = time.monotonic()
+        if not last_changed or now - min(last_changed.values()) < job.settle + WATCH_TICK: continue
+        settled: list = [path for path, changed_at in last_changed.items() if now - changed_at >= job.settle]
+        for path in settled: last_changed.pop(path)
+        if None in settled: changes: Iterator = _identify_changes(job.input_path, job.destination_path, index, metrics)
+        else: changes: Iterator = _watched_changes(job.input_path, job.destination_path, sorted(settled), index)
+        try: batch_summary: dict = _copy_to_drive(
+            job.input_path, job.destination_path, changes, job.workers, index, False, manifest_path, job.algorithm, job.verify, job.backend,
+            job.sync_updated, job.retries, job.backoff, failure_queue, job.limiter, pool, job.bundle_small, metrics, signature_cache)
+        except:
+            logging.critical("Critical error when trying to performing backup!")
+            _save_failure_queue(job.failure_queue_path, failure_queue)
+            return None
+        _save_failure_queue(job.failure_queue_path, failure_queue)
+        if metrics_path: metrics.write(metrics_path)
+        summary = {
+            'copied': summary['copied'] + batch_summary['copied'],
+            'failed': summary['failed'] + batch_summary['failed'],
+            'skipped_updated': summary['skipped_updated'] + batch_summary['skipped_updated']}
+
+    logging.info(f"Stopped watching {job.input_path}; {len(last_changed)} changed path(s) hadn't settled yet and will be copied by the next backup.")
+    return summary
+def _log_summary(_summaries: dict, _check: bool = False) -> None:
+    """
+    Function logs the total of a backup of several instruments.
 
-    # generate a human-readable list of updated files and inform that they won't be copied automatically
-    updated_files_str: str = '\n'.join([f"\t{str(file)}" for file in updated_files])
-    logging.info(f"Found {updated_files_num} modified file(s): \n{updated_files_str}")
-    if updated_files_num: logging.info("These files will not be copied automatically!\n")
+    Parameters:
+        _summaries: dict
+            instrument: summary returned by _copy_to_drive(), None if its backup crashed
+        _check: bool
+            if True, nothing was copied
 
-    # generate a human-readable list of files to copy
-    new_files_str: str = '\n'.join([f"\t{str(file)}" for file in new_files])
-    logging.info(f"Found {total} total new paths: {num_dirs} folder(s) and {num_files} file(s) :\n{new_files_str}\n")
+    Returns:
+        None
+    """
 
-    return {'new_files': new_files, 'updated_files': updated_files}
+    summary_lines: list = []
+    for instrument, summary in _summaries.items():
+        if summary is None: summary_lines.append(f"\t{instrument}: crashed, see the critical error above")
+        elif _check: summary_lines.append(f"\t{instrument}: checked")
+        else: summary_lines.append(f"\t{instrument}: copied {summary['copied']} file(s), {len(summary['failed'])} failed")
+    summaries: list = [summary for summary in _summaries.values() if summary is not None]
+    copied_num: int = sum([summary['copied'] for summary in summaries])
+    failed_num: int = sum([len(summary['failed']) for summary in summaries])
+    crashed_num: int = len(_summaries) - len(summaries)
+    summary_lines_str: str = '\n'.join(summary_lines)
+    if _check: message: str = f"All checks finished for {len(_summaries)} instrument(s):\n{summary_lines_str}"
+    else: message: str = f"All backups finished for {len(_summaries)} instrument(s). Successfully copied {copied_num} file(s); {failed_num} file(s) failed:\n{summary_lines_str}"
+    if failed_num or crashed_num: logging.warning(message)
+    else: logging.info(message)
+    return None
+def _add_log_prefix(_record: logging.LogRecord) -> bool:
+    """ Logging filter that adds the prefix of the instrument being backed up to a record """
+    _record.log_prefix = LOG_PREFIX.get()
+    return True
 def _log_params(args: Namespace) -> None:
     """Log argparse arguments to logfile"""
     logging.info("Using config.json in src/")
-    logging.info(f"Input path: {args.input_path}")
-    logging.info(f"Instrument: {args.instrument}")
-    logging.info(f"Destination path: {args.destination_path}\n")
+    for job in args.jobs:
+        logging.info(f"Instrument: {job.instrument}")
+        logging.info(f"\tInput path: {job.input_path}")
+        logging.info(f"\tDestination path: {job.destination_path}")
+        logging.info(f"\tMax rate: {f'{job.max_rate / 1024 ** 2:g} MiB/s' if job.max_rate else 'unlimited'}{f' ({len(job.limiter.schedule)} scheduled window(s))' if job.limiter.schedule else ''}")
+    if len(args.jobs) > 1 and args.max_rate is not None: logging.info("\tThe max rate is shared by all instruments.")
+    logging.info(f"Workers: {args.workers}{' (shared by all instruments)' if len(args.jobs) > 1 else ''}")
+    logging.info(f"Copy backend: {args.backend}")
+    if args.sync_updated: logging.info("Modified files will be synced.")
+    if args.bundle_small: logging.info(f"New files smaller than {args.bundle_small / 1024:g} KiB will be bundled.")
+    logging.info(f"Retries: {args.retries} (backoff starting at {args.backoff:g} s)")
+    if args.low_priority: logging.info("Running with low CPU and I/O priority.")
+    logging.info(f"Checksum: {args.algorithm}{' (verified by reading back the destination)' if args.verify else ''}\n")
+    if args.reindex: logging.info(f'Running --reindex; the index in {args.log_path} will be rebuilt from the destination.\n')
+    if args.retry_failed: logging.info(f'Running --retry-failed; only files queued in {", ".join([str(job.failure_queue_path) for job in args.jobs])} will be copied.\n')
+    if args.plan_path: logging.info(f'Running --apply-plan; only files planned in {args.plan_path} will be copied.\n')
+    if args.watch: logging.info(f"Running --watch; the input will be watched {f'every {args.poll_interval:g} s' if args.poll_interval else 'with inotify'} after the backup, copying files that haven't changed for {args.settle:g} s.\n")
     if args.check: logging.warning(f'Running --check; files will not be copied!\n')
     return None
 def _parse_config() -> dict:
@@ -163,6 +1243,10 @@ def _parse_config() -> dict:
             "instruments": dict
                 instrument_name: (str) path to instrument raw data
             "log_output": (str) path of log output directory
+            "sources": optional dict
+                instrument_name: (str) path the instrument's files are copied from, used by --all
+            "throttle": optional dict
+                instrument_name: {"max_rate": rate, "schedule": [{"start": "HH:MM", "end": "HH:MM", "max_rate": rate}, ...]}
     """
 
     config_path = Path(__file__).parent.joinpath('config.json')
@@ -201,31 +1285,51 @@ def main() -> None:
     args = get_args(configs)
 
     runtime = datetime.now().strftime('%Y%m%d-%H%M%S')
+    log_name: str = 'all' if args.all_instruments else '+'.join(args.instruments)
     logging.basicConfig(
         encoding='utf-8',
         level=logging.INFO,
         handlers=[
-            logging.FileHandler(args.log_path.joinpath(f'{runtime}_{args.instrument}.log')),
-            logging.StreamHandler()],
+            logging.FileHandler(args.log_path.joinpath(f'{runtime}_{log_name}.log')),
+            ProgressHandler()],
         datefmt='%Y-%m-%d %H:%M:%S',
-        format='%(asctime)s %(levelname)s : %(message)s')
+        format='%(asctime)s %(levelname)s : %(log_prefix)s%(message)s')
+    for handler in logging.getLogger().handlers: handler.addFilter(_add_log_prefix)
     
     # log the parameters used
     _log_params(args)
-    
-    # identify directory changes between the paths
-    try: directory_changes: dict = _identify_changes(args.input_path, args.destination_path)
-    except:
-        logging.critical("Critical error when trying to identify changes between directories!")
-        quit()
+    if args.low_priority: lower_priority()
 
-    # copy files from the input to the destination
-    if not args.check:
-        try: _copy_to_drive(args.input_path, args.destination_path, directory_changes)
-        except:
-            logging.critical("Critical error when trying to performing backup!")
-            quit()
+    # Ctrl+C (or a service manager) stops --watch once the files being copied are done, a second Ctrl+C stops right away
+    stop = threading.Event()
+    if args.watch:
+        def _stop_watching(_signal_number, _frame) -> None:
+            logging.warning("Stopping once the files being copied are done ...")
+            stop.set()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGINT, _stop_watching)
+        signal.signal(signal.SIGTERM, _stop_watching)
+
+    # show the progress of every instrument on the console (if it's a terminal)
+    metrics: dict = {job.instrument: RunMetrics(job.instrument) for job in args.jobs}
+    console_handler: ProgressHandler = [handler for handler in logging.getLogger().handlers if isinstance(handler, ProgressHandler)][0]
+    progress = ProgressReporter(console_handler, list(metrics.values()))
+    progress.start()
+
+    # back up every instrument at the same time, with the copy workers shared between them
+    pool = WorkerPool(args.workers)
+    try:
+        if len(args.jobs) == 1: summaries: dict = {args.jobs[0].instrument: _backup_instrument(args.jobs[0], runtime, pool, stop, metrics[args.jobs[0].instrument])}
+        else:
+            with ThreadPoolExecutor(max_workers=len(args.jobs)) as executor:
+                futures: dict = {job.instrument: executor.submit(copy_context().run, _backup_instrument, job, runtime, pool, stop, metrics[job.instrument], f'[{job.instrument}] ') for job in args.jobs}
+            summaries: dict = {instrument: future.result() for instrument, future in futures.items()}
+    finally:
+        pool.shutdown()
+        progress.stop()
 
+    if len(args.jobs) > 1: _log_summary(summaries, args.check)
+    if None in summaries.values(): quit()
     return None
 # --------------------------------------------------
 if __name__ == '__main__':
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+__description__ =\
+"""
+Purpose: Benchmark the scan, copy and checksum steps of backup.py and archive-ngs-run.py on synthetic MiSeq-like runs.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from argparse import (
+    Namespace,
+    ArgumentParser,
+    RawTextHelpFormatter)
+from pathlib import Path
+# --------------------------------------------------
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import statistics
+import subprocess
+import tempfile
+import importlib.util
+from datetime import datetime
+# --------------------------------------------------
+import backup
+import checksum
+import run_index
+from transfer import parse_size
+# archive-ngs-run.py can't be imported by name
+_archive_spec = importlib.util.spec_from_file_location('archive_ngs_run', Path(__file__).parent.joinpath('archive-ngs-run.py'))
+archive = importlib.util.module_from_spec(_archive_spec)
+_archive_spec.loader.exec_module(archive)
+# --------------------------------------------------
+BENCHMARKS: tuple = ('scan', 'copy', 'verify', 'archive')
+# names follow the MiSeq output, _find_miseq_output() looks for {date}_{instrument}_{run}_{flowcell}
+RUN_NAME: str = '221210-run01_benchmark'
+MISEQ_OUTPUT_NAME: str = '221210_M00000_0001_000000000-BENCH'
+# --------------------------------------------------
+def get_args() -> Namespace:
+    """ Get command-line arguments """
+
+    parser = ArgumentParser(
+        description=__description__,
+        epilog=f"v{__version__} : {__author__} | {__comments__}",
+        formatter_class=RawTextHelpFormatter)
+    parser.add_argument(
+        '--output',
+        dest='output_path',
+        metavar='PATH',
+        type=Path,
+        help="JSON file the results are written to [Default: benchmark_<runtime>.json]")
+    parser.add_argument(
+        '--compare',
+        dest='compare_path',
+        metavar='PATH',
+        type=Path,
+        help="results of an earlier benchmark (e.g. of another version) to compare against")
+    parser.add_argument(
+        '--only',
+        dest='benchmarks',
+        choices=BENCHMARKS,
+        nargs='+',
+        default=list(BENCHMARKS),
+        help="benchmarks to run [Default: all]\n"
+            "  scan: backup._identify_changes() against an empty, a backed up (indexed) and a backed up (not indexed) destination\n"
+            "  copy: backup._copy_to_drive() into an empty destination, for every --workers\n"
+            "  verify: archive-ngs-run.py _generate_md5() and _check_md5(), without and with the checksum cache\n"
+            "  archive: archive-ngs-run.py _perform_archive()")
+    parser.add_argument(
+        '--files',
+        dest='small_files',
+        metavar='N',
+        type=int,
+        default=2000,
+        help="number of small files (InterOp, thumbnails, logs) in the run [Default: 2000]")
+    parser.add_argument(
+        '--small-size',
+        dest='small_size',
+        metavar='SIZE',
+        type=parse_size,
+        default=parse_size('4K'),
+        help="median size of the small files, which are log-normally distributed around it [Default: 4K]")
+    parser.add_argument(
+        '--samples',
+        dest='samples',
+        metavar='N',
+        type=int,
+        default=8,
+        help="number of samples, each with an R1 and R2 .fastq.gz in every Alignment_*/*/Fastq folder [Default: 8]")
+    parser.add_argument(
+        '--fastq-size',
+        dest='fastq_size',
+        metavar='SIZE',
+        type=parse_size,
+        default=parse_size('8M'),
+        help="size of every .fastq.gz [Default: 8M]")
+    parser.add_argument(
+        '--alignments',
+        dest='alignments',
+        metavar='N',
+        type=int,
+        default=1,
+        help="number of Alignment_* folders [Default: 1]")
+    parser.add_argument(
+        '--depth',
+        dest='depth',
+        metavar='N',
+        type=int,
+        default=2,
+        help="levels of folders the thumbnails are nested in below Thumbnail_Images/L001 [Default: 2]")
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        metavar='N',
+        type=int,
+        nargs='+',
+        default=[1, 4],
+        help="numbers of workers the copy benchmark is run with [Default: 1 4]")
+    parser.add_argument(
+        '--checksum',
+        dest='checksum_algorithm',
+        choices=checksum.CHECKSUM_ALGORITHMS,
+        default='md5',
+        help="algorithm the verify benchmark hashes with [Default: md5]")
+    parser.add_argument(
+        '--repeat',
+        dest='repeat',
+        metavar='N',
+        type=int,
+        default=3,
+        help="number of times every benchmark is run, the fastest run counts [Default: 3]")
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        type=int,
+        default=0,
+        help="seed of the synthetic run, the same seed always gives the same run [Default: 0]")
+    parser.add_argument(
+        '--tmp',
+        dest='tmp_path',
+        metavar='PATH',
+        type=Path,
+        help="folder the synthetic run and the destinations are made in, should be on the disk to benchmark [Default: system temp]")
+    parser.add_argument(
+        '--log',
+        action='store_true',
+        help="keep the logging of the benchmarked functions (to the console), it's disabled by default.")
+
+    args = parser.parse_args()
+
+    # parser errors and processing
+    # --------------------------------------------------
+    if args.repeat < 1: parser.error(f"--repeat must be at least 1, got {args.repeat}.")
+    if min(args.workers) < 1: parser.error(f"--workers must be at least 1, got {min(args.workers)}.")
+    if args.output_path is None: args.output_path = Path(f"benchmark_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+
+    return args
+# --------------------------------------------------
+def generate_run(root: Path, small_files: int = 2000, small_size: int = 4096, samples: int = 8, fastq_size: int = 8 * 1024 ** 2, alignments: int = 1, depth: int = 2, seed: int = 0) -> dict:
+    """
+    Function generates a synthetic run folder shaped like a MiSeq run on the Z-drive:
+    {run}/{MiSeq output}/Data/Intensities/BaseCalls/Alignment_*/{timestamp}/Fastq/*.fastq.gz, InterOp/*.bin,
+    Thumbnail_Images/L001/..., Logs/*.log and the run XMLs. File contents are random, so they don't compress.
+
+    Parameters:
+        root: Path
+            folder the run is made in
+        small_files: int
+            number of small files, split between InterOp, thumbnails and logs
+        small_size: int
+            median size of the small files, log-normally distributed around it
+        samples: int
+            number of samples, each with an R1 and R2 .fastq.gz (plus the Undetermined reads)
+        fastq_size: int
+            size of every .fastq.gz
+        alignments: int
+            number of Alignment_* folders, each with a copy of the FASTQ files
+        depth: int
+            levels of folders the thumbnails are nested in below Thumbnail_Images/L001
+        seed: int
+            seed of the random generator
+
+    Returns:
+        tree: dict
+            "run_path": (str) path of the run folder
+            "files", "folders", "bytes": totals of the run
+    """
+
+    generator = random.Random(seed)
+    run_path: Path = root.joinpath(RUN_NAME)
+    miseq_output_path: Path = run_path.joinpath(MISEQ_OUTPUT_NAME)
+    files: dict = {}
+
+    # run XMLs and sample sheet
+    for name in ('RunInfo.xml', 'runParameters.xml', 'SampleSheet.csv', 'RTAComplete.txt'):
+        files[miseq_output_path.joinpath(name)] = 2048
+    # FASTQ files, the bulk of the bytes
+    for alignment in range(1, alignments + 1):
+        fastq_path: Path = miseq_output_path.joinpath('Data', 'Intensities', 'BaseCalls', f'Alignment_{alignment}', f'20221210_12000{alignment}', 'Fastq')
+        for sample in range(samples + 1):
+            sample_name: str = f'Sample{sample}_S{sample}' if sample else 'Undetermined_S0'
+            for read in (1, 2): files[fastq_path.joinpath(f'{sample_name}_L001_R{read}_001.fastq.gz')] = int(fastq_size)
+    # small files: a tenth InterOp, a tenth logs, the rest thumbnails nested depth folders deep
+    small_sizes: list = [max(1, round(generator.lognormvariate(0, 1) * small_size)) for _ in range(small_files)]
+    for number, size in enumerate(small_sizes):
+        if number % 10 == 0: files[miseq_output_path.joinpath('InterOp', f'Metrics{number:05d}Out.bin')] = size
+        elif number % 10 == 1: files[miseq_output_path.joinpath('Logs', f'{number:05d}_Log.log')] = size
+        else:
+            nested: list = [f'C{(number // 50) % 300 + 1}.1', *[f'{level}' for level in range(1, depth)]][:depth]
+            files[miseq_output_path.joinpath('Thumbnail_Images', 'L001', *nested, f's_1_{number:05d}_a.jpg')] = size
+
+    for file, size in files.items():
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(generator.randbytes(size))
+    folders: int = sum([1 for path in run_path.rglob('*') if path.is_dir()])
+    return {'run_path': str(run_path), 'files': len(files), 'folders': folders, 'bytes': sum(files.values())}
+def _time(function, repeat: int, setup=None) -> list:
+    """
+    Function times a function, repeat times.
+
+    Parameters:
+        function: function
+            function to time, called without arguments
+        repeat: int
+            number of times to time it
+        setup: function
+            optional function called (untimed) before every run, e.g. to empty a destination
+
+    Returns:
+        (list): seconds of every run
+    """
+
+    seconds: list = []
+    for _ in range(repeat):
+        if setup: setup()
+        started: float = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - started)
+    return seconds
+def _result(seconds: list, files: int = None, size: int = None, **extra) -> dict:
+    """ Function summarizes the timings of a benchmark, the fastest run counts for the throughput. """
+    result: dict = {'seconds': seconds, 'min': min(seconds), 'median': statistics.median(seconds), **extra}
+    if files is not None: result['files_per_second'] = files / result['min']
+    if size is not None: result['bytes_per_second'] = size / result['min']
+    return result
+def _empty(path: Path) -> None:
+    """ Function removes a folder if it exists, and makes it again empty. """
+    if path.exists(): shutil.rmtree(path)
+    path.mkdir(parents=True)
+    return None
+def benchmark_scan(run_path: Path, work_path: Path, tree: dict, repeat: int) -> dict:
+    """
+    Function times backup._identify_changes() against an empty destination (everything is new), a destination that
+    has everything with an index that knows it, and the same destination without an index (every folder is listed).
+    """
+
+    destination_path: Path = work_path.joinpath('scan-destination')
+    _empty(destination_path)
+    scan = lambda index=None: sum([1 for _ in backup._identify_changes(run_path, destination_path, index)])
+    results: dict = {'empty_destination': _result(_time(scan, repeat), tree['files'] + tree['folders'])}
+
+    shutil.copytree(run_path, destination_path, dirs_exist_ok=True)
+    results['backed_up_no_index'] = _result(_time(scan, repeat), tree['files'] + tree['folders'])
+    index = backup._open_index(work_path, 'benchmark')
+    backup._rebuild_index(index, destination_path)
+    results['backed_up_indexed'] = _result(_time(lambda: scan(index), repeat), tree['files'] + tree['folders'])
+    index.close()
+    work_path.joinpath('benchmark_index.sqlite').unlink()
+    shutil.rmtree(destination_path)
+    return results
+def benchmark_copy(run_path: Path, work_path: Path, tree: dict, repeat: int, workers_list: list) -> dict:
+    """ Function times backup._copy_to_drive() (with the scan feeding it) into an empty destination, for every number of workers. """
+
+    destination_path: Path = work_path.joinpath('copy-destination')
+    results: dict = {}
+    for workers in workers_list:
+        copy = lambda: backup._copy_to_drive(
+            run_path, destination_path, backup._identify_changes(run_path, destination_path), workers,
+            _manifest_path=work_path.joinpath('copy.md5'), _algorithm='md5')
+        results[f'workers_{workers}'] = _result(_time(copy, repeat, lambda: _empty(destination_path)), tree['files'], tree['bytes'], workers=workers)
+    shutil.rmtree(destination_path)
+    work_path.joinpath('copy.md5').unlink(missing_ok=True)
+    return results
+def benchmark_verify(run_path: Path, work_path: Path, tree: dict, repeat: int, algorithm: str = 'md5') -> dict:
+    """
+    Function times archive-ngs-run.py _generate_md5() of a run, and _check_md5() of a run against its archived copy,
+    with nothing cached (every file is read), and _check_md5() again with the checksum caches of the previous run.
+    """
+
+    miseq_output_path: Path = run_path.joinpath(MISEQ_OUTPUT_NAME)
+    archive_path: Path = work_path.joinpath('verify-archive')
+    _empty(archive_path)
+    shutil.copytree(run_path, archive_path.joinpath(RUN_NAME))
+    remove_checksums = lambda: [path.joinpath(name).unlink(missing_ok=True) for path in (run_path, archive_path.joinpath(RUN_NAME)) for name in (checksum.manifest_name(algorithm), checksum.cache_name(algorithm))]
+
+    results: dict = {'generate_md5': _result(_time(lambda: archive._generate_md5(miseq_output_path, algorithm), repeat, remove_checksums), tree['files'], tree['bytes'])}
+    matched: list = []
+    results['check_md5'] = _result(
+        _time(lambda: matched.append(archive._check_md5(run_index.RunIndex(run_path), archive_path.joinpath(RUN_NAME), algorithm)), repeat, remove_checksums),
+        tree['files'] * 2, tree['bytes'] * 2)
+    results['check_md5']['matched'] = all(matched)
+    matched_cached: list = []
+    results['check_md5_cached'] = _result(
+        _time(lambda: matched_cached.append(archive._check_md5(run_index.RunIndex(run_path), archive_path.joinpath(RUN_NAME), algorithm)), repeat),
+        tree['files'] * 2, tree['bytes'] * 2)
+    results['check_md5_cached']['matched'] = all(matched_cached)
+    remove_checksums()
+    shutil.rmtree(archive_path)
+    return results
+def benchmark_archive(run_path: Path, work_path: Path, tree: dict, repeat: int) -> dict:
+    """ Function times archive-ngs-run.py _perform_archive() (with the index of the run it needs) of a run into an empty archive folder. """
+
+    archive_path: Path = work_path.joinpath('archive')
+    results: dict = {'perform_archive': _result(
+        _time(lambda: archive._perform_archive(run_index.RunIndex(run_path), archive_path, False), repeat, lambda: _empty(archive_path)),
+        tree['files'], tree['bytes'])}
+    shutil.rmtree(archive_path)
+    run_path.joinpath(checksum.cache_name()).unlink(missing_ok=True)
+    return results
+def _compare(results: dict, old_results: dict) -> list:
+    """
+    Function compares the fastest run of every benchmark with an earlier benchmark.
+
+    Returns:
+        (list): lines of "benchmark: old s -> new s (speedup)"
+    """
+
+    lines: list = []
+    for benchmark, cases in results['results'].items():
+        for case, result in cases.items():
+            old_result: dict = old_results.get('results', {}).get(benchmark, {}).get(case)
+            if not old_result: continue
+            lines.append(f"{benchmark}.{case}: {old_result['min']:.3f} s -> {result['min']:.3f} s ({old_result['min'] / max(result['min'], 1e-9):.2f}x)")
+    return lines
+def _git_commit() -> str:
+    """ Function returns the commit of the working copy the benchmark is run from, None if it isn't a git repository. """
+    try: return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError): return None
+# --------------------------------------------------
+def main() -> None:
+    """ Insert docstring here """
+
+    args = get_args()
+    if not args.log: logging.disable(logging.CRITICAL)
+    else: logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s : %(message)s')
+
+    results: dict = {
+        'benchmark': 1,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'versions': {'backup': backup.__version__, 'archive-ngs-run': archive.__version__, 'git': _git_commit()},
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {key: (str(value) if isinstance(value, Path) else value) for key, value in vars(args).items()},
+        'results': {}}
+
+    with tempfile.TemporaryDirectory(prefix='z-drive-benchmark-', dir=args.tmp_path) as work_dir:
+        work_path: Path = Path(work_dir)
+        print(f"Generating the synthetic run in {work_path} ...", file=sys.stderr)
+        results['tree'] = generate_run(work_path.joinpath('input'), args.small_files, args.small_size, args.samples, args.fastq_size, args.alignments, args.depth, args.seed)
+        run_path: Path = Path(results['tree']['run_path'])
+        print(f"Generated {results['tree']['files']} file(s) in {results['tree']['folders']} folder(s), {results['tree']['bytes'] / 1024 ** 2:.1f} MiB.", file=sys.stderr)
+
+        for benchmark in args.benchmarks:
+            print(f"Running {benchmark} ...", file=sys.stderr)
+            if benchmark == 'scan': results['results']['scan'] = benchmark_scan(run_path, work_path, results['tree'], args.repeat)
+            elif benchmark == 'copy': results['results']['copy'] = benchmark_copy(run_path, work_path, results['tree'], args.repeat, args.workers)
+            elif benchmark == 'verify': results['results']['verify'] = benchmark_verify(run_path, work_path, results['tree'], args.repeat, args.checksum_algorithm)
+            elif benchmark == 'archive': results['results']['archive'] = benchmark_archive(run_path, work_path, results['tree'], args.repeat)
+        results['tree']['run_path'] = RUN_NAME
+
+    with open(args.output_path, 'w', encoding='utf-8') as output_file: json.dump(results, output_file, indent=4)
+    for benchmark, cases in results['results'].items():
+        for case, result in cases.items():
+            if not isinstance(result, dict):
+                print(f"{benchmark}.{case}: {result}")
+                continue
+            throughput_str: str = f", {result['bytes_per_second'] / 1024 ** 2:.1f} MiB/s" if 'bytes_per_second' in result else ''
+            print(f"{benchmark}.{case}: {result['min']:.3f} s (median {result['median']:.3f} s){throughput_str}")
+    print(f"Wrote results to {args.output_path} .")
+
+    if args.compare_path:
+        with open(args.compare_path, encoding='utf-8') as compare_file: old_results: dict = json.load(compare_file)
+        print(f"\nCompared to {args.compare_path} ({old_results['versions'].get('git') or old_results['created']}):")
+        for line in _compare(results, old_results): print(f"\t{line}")
+    return None
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+__description__ =\
+"""
+Purpose: Bundles of small files (tar batches with an index), written by backup.py --bundle-small.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from argparse import (
+    Namespace,
+    ArgumentParser,
+    RawTextHelpFormatter)
+from pathlib import Path
+# --------------------------------------------------
+import os
+import stat
+import io
+import json
+import hashlib
+import tarfile
+import itertools
+from datetime import datetime
+from collections.abc import Iterator
+# --------------------------------------------------
+from transfer import (
+    COPY_BUFFER_SIZE,
+    ChecksumMismatchError,
+    RateLimiter,
+    partial_paths,
+    hash_file)
+# --------------------------------------------------
+# bundles are kept in this folder at the root of the instrument folder
+BUNDLE_DIR: str = '.bundles'
+BUNDLE_SUFFIX: str = '.tar'
+INDEX_SUFFIX: str = '.index.json'
+# a bundle is written once it holds this many bytes or files
+BUNDLE_MAX_SIZE: int = 64 * 1024 * 1024
+BUNDLE_MAX_FILES: int = 10000
+# numbers bundles written in the same second by the same process
+_bundle_numbers = itertools.count()
+# --------------------------------------------------
+def write_bundle(source_root: Path, destination_root: Path, files: list, algorithm: str = 'md5', verify: bool = False, limiter: RateLimiter = None) -> tuple:
+    """
+    Function packs small files into a single tar bundle in memory and writes it to the destination in one sequential
+    write, so that the per-file overhead of the share (opening, closing, setting metadata) is only paid once per bundle.
+    An index beside the bundle records where every file starts, so files can be listed and extracted without reading
+    the whole bundle. The bundle is written to a temporary name first and the index is written last, so a bundle
+    without an index is never complete.
+
+    Parameters:
+        source_root: Path
+            path of the input directory, should be the root
+        destination_root: Path
+            path of the destination directory, should be the instrument; the bundle is written to its BUNDLE_DIR
+        files: list
+            paths of the files to bundle, relative to source_root
+        algorithm: str
+            name of the hashlib algorithm used for the checksum of every file, or None to skip the checksums
+        verify: bool
+            if True, read the bundle back from the destination and compare its checksum
+        limiter: RateLimiter
+            optional limit on the bytes sent per second
+
+    Returns:
+        (tuple): (bundle_file, digests, errors)
+            bundle_file: path of the bundle
+            digests: dict, file: hex digest (or None if no algorithm was given) of every bundled file
+            errors: dict, file: error for the files that couldn't be read
+    """
+
+    bundle_file: Path = destination_root.joinpath(BUNDLE_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{next(_bundle_numbers):05d}{BUNDLE_SUFFIX}")
+    digests: dict = {}
+    errors: dict = {}
+    members: dict = {}
+
+    # build the whole bundle in memory, it's at most about BUNDLE_MAX_SIZE
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        for file in files:
+            try:
+                with open(source_root.joinpath(file), 'rb') as source:
+                    source_stat: os.stat_result = os.fstat(source.fileno())
+                    content: bytes = source.read()
+            except OSError as error:
+                errors[file] = error
+                continue
+            member = tarfile.TarInfo(file.as_posix())
+            member.size = len(content)
+            member.mtime = source_stat.st_mtime
+            member.mode = stat.S_IMODE(source_stat.st_mode)
+            tar.addfile(member, io.BytesIO(content))
+            # the content ends at the current position of the tar, padded to whole blocks
+            offset: int = tar.offset - -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            digests[file] = hashlib.new(algorithm, content).hexdigest() if algorithm else None
+            members[file.as_posix()] = {'offset': offset, 'size': member.size, 'mtime': source_stat.st_mtime, 'mode': member.mode, 'digest': digests[file]}
+    view = memoryview(data.getbuffer())
+
+    # one sequential write to a temporary name
+    bundle_file.parent.mkdir(parents=True, exist_ok=True)
+    partial_file, _ = partial_paths(bundle_file)
+    try:
+        with open(partial_file, 'wb') as destination:
+            for offset in range(0, len(view), COPY_BUFFER_SIZE):
+                chunk = view[offset:offset + COPY_BUFFER_SIZE]
+                if limiter: limiter.consume(len(chunk))
+                destination.write(chunk)
+            destination.flush()
+            os.fsync(destination.fileno())
+    except:
+        partial_file.unlink(missing_ok=True)
+        raise
+    os.replace(partial_file, bundle_file)
+
+    bundle_digest: str = hashlib.new(algorithm, view).hexdigest() if algorithm else None
+    view.release()
+    if verify and algorithm is not None:
+        destination_digest: str = hash_file(bundle_file, algorithm)
+        if destination_digest != bundle_digest:
+            bundle_file.unlink()
+            raise ChecksumMismatchError(f"checksum mismatch of bundle {bundle_file.name}, {bundle_digest} in memory but {destination_digest} in the destination")
+
+    # the index is what makes the bundle count
+    index: dict = {'bundle': 1, 'created': datetime.now().isoformat(timespec='seconds'), 'algorithm': algorithm, 'digest': bundle_digest, 'members': members}
+    index_file: Path = index_path(bundle_file)
+    temporary_index_file: Path = index_file.with_name(f"{index_file.name}.tmp")
+    with open(temporary_index_file, 'w', encoding='utf-8') as opened_index_file: json.dump(index, opened_index_file)
+    os.replace(temporary_index_file, index_file)
+    return (bundle_file, digests, errors)
+def index_path(bundle_file: Path) -> Path:
+    """ Function returns the path of the index of a bundle. """
+    return bundle_file.with_name(f"{bundle_file.name}{INDEX_SUFFIX}")
+def read_index(bundle_file: Path) -> dict:
+    """
+    Function reads the index of a bundle.
+
+    Parameters:
+        bundle_file: Path
+            path of the bundle
+
+    Returns:
+        index: dict
+            "created": time the bundle was written
+            "algorithm": name of the hashlib algorithm of the checksums, or None
+            "digest": checksum of the whole bundle
+            "members": dict
+                path relative to the instrument folder: {"offset", "size", "mtime", "mode", "digest"}
+    """
+
+    with open(index_path(bundle_file), encoding='utf-8') as index_file:
+        return json.load(index_file)
+def find_bundles(destination_root: Path) -> list:
+    """
+    Function lists the complete bundles (the ones with an index) in an instrument folder.
+
+    Parameters:
+        destination_root: Path
+            path of the instrument folder
+
+    Returns:
+        (list): sorted paths of the bundles
+    """
+
+    bundle_dir: Path = destination_root.joinpath(BUNDLE_DIR)
+    if not bundle_dir.is_dir(): return []
+    return sorted([bundle_file for bundle_file in bundle_dir.glob(f'*{BUNDLE_SUFFIX}') if index_path(bundle_file).exists()])
+def bundled_files(destination_root: Path) -> Iterator:
+    """
+    Function yields every file in the complete bundles of an instrument folder.
+
+    Parameters:
+        destination_root: Path
+            path of the instrument folder
+
+    Yields:
+        (path, stat): tuple
+            path: path of the file, relative to the instrument folder
+            stat: os.stat_result with the mode, size and modification time the file had when it was bundled
+    """
+
+    for bundle_file in find_bundles(destination_root):
+        for member, info in read_index(bundle_file)['members'].items():
+            yield (Path(member), os.stat_result((stat.S_IFREG | info['mode'], 0, 0, 0, 0, 0, info['size'], 0, int(info['mtime']), 0), {'st_mtime': info['mtime']}))
+    return None
+def extract_member(bundle_file: Path, member: str, index: dict = None) -> bytes:
+    """
+    Function reads a single file out of a bundle, using the index to seek straight to it.
+
+    Parameters:
+        bundle_file: Path
+            path of the bundle
+        member: str
+            path of the file, relative to the instrument folder
+        index: dict
+            index of the bundle, read if not given
+
+    Returns:
+        (bytes): content of the file
+    """
+
+    info: dict = (index or read_index(bundle_file))['members'][member]
+    with open(bundle_file, 'rb') as opened_bundle_file:
+        opened_bundle_file.seek(info['offset'])
+        return opened_bundle_file.read(info['size'])
+def unpack_bundle(bundle_file: Path, destination_root: Path = None, members: list = None, remove: bool = False) -> int:
+    """
+    Function writes the files in a bundle to their own paths (with their modification time and mode), best run on the
+    machine that holds the destination, where it's just a local sequential read. Files that already exist at least
+    as new as their bundled version are left alone.
+
+    Parameters:
+        bundle_file: Path
+            path of the bundle
+        destination_root: Path
+            folder the files are written to, the instrument folder holding the bundle if not given
+        members: list
+            paths of the files to write, every file if not given
+        remove: bool
+            if True, remove the bundle and its index once every file in it is written
+
+    Returns:
+        (int): number of files written
+    """
+
+    index: dict = read_index(bundle_file)
+    destination_root = destination_root or bundle_file.parent.parent
+    unpacked_num: int = 0
+    with open(bundle_file, 'rb') as opened_bundle_file:
+        for member in (members or index['members']):
+            info: dict = index['members'][member]
+            destination_file: Path = destination_root.joinpath(member)
+            try:
+                if os.stat(destination_file).st_mtime >= info['mtime']: continue
+            except FileNotFoundError: pass
+
+            opened_bundle_file.seek(info['offset'])
+            content: bytes = opened_bundle_file.read(info['size'])
+            destination_file.parent.mkdir(parents=True, exist_ok=True)
+            partial_file, _ = partial_paths(destination_file)
+            with open(partial_file, 'wb') as destination: destination.write(content)
+            os.chmod(partial_file, info['mode'])
+            os.utime(partial_file, (info['mtime'], info['mtime']))
+            os.replace(partial_file, destination_file)
+            unpacked_num += 1
+
+    if remove and members is None:
+        index_path(bundle_file).unlink()
+        bundle_file.unlink()
+    return unpacked_num
+# --------------------------------------------------
+def get_args() -> Namespace:
+    """ Get command-line arguments """
+
+    parser = ArgumentParser(
+        description=__description__,
+        epilog=f"v{__version__} : {__author__} | {__comments__}",
+        formatter_class=RawTextHelpFormatter)
+    parser.add_argument(
+        'command',
+        choices=['list', 'extract', 'unpack'],
+        help="list: list the files in the bundles\n"
+            "extract: write some files of a bundle to --output\n"
+            "unpack: write every file of the bundles to its own path in the instrument folder, then remove the bundles")
+    parser.add_argument(
+        'bundles',
+        metavar='BUNDLE',
+        type=Path,
+        nargs='+',
+        help="bundle(s) to read, or an instrument folder for all of its bundles")
+    parser.add_argument(
+        '--file',
+        dest='members',
+        metavar='PATH',
+        action='append',
+        help="(extract) path of a file to extract, relative to the instrument folder; can be repeated")
+    parser.add_argument(
+        '--output',
+        dest='output_path',
+        metavar='PATH',
+        type=Path,
+        default=Path('.'),
+        help="(extract) folder the extracted files are written to [Default: .]")
+    parser.add_argument(
+        '--keep',
+        action='store_true',
+        help="(unpack) keep the bundles after unpacking them.")
+
+    args = parser.parse_args()
+
+    # parser errors and processing
+    # --------------------------------------------------
+    if args.command == 'extract' and not args.members: parser.error("extract needs at least one --file.")
+    bundles: list = []
+    for bundle in args.bundles:
+        if bundle.is_dir(): bundles.extend(find_bundles(bundle))
+        elif index_path(bundle).exists(): bundles.append(bundle)
+        else: parser.error(f"{bundle} is not a complete bundle (it has no {INDEX_SUFFIX}).")
+    args.bundles = bundles
+
+    return args
+# --------------------------------------------------
+def main() -> None:
+    """ Insert docstring here """
+
+    args = get_args()
+
+    for bundle_file in args.bundles:
+        if args.command == 'list':
+            for member, info in read_index(bundle_file)['members'].items():
+                print(f"{info['size']:>12}  {datetime.fromtimestamp(info['mtime']).strftime('%Y-%m-%d %H:%M:%S')}  {member}\t{bundle_file.name}")
+        elif args.command == 'extract':
+            index: dict = read_index(bundle_file)
+            members: list = [member for member in args.members if member in index['members']]
+            unpacked_num: int = unpack_bundle(bundle_file, args.output_path, members) if members else 0
+            if members: print(f"Extracted {unpacked_num} file(s) from {bundle_file}.")
+        elif args.command == 'unpack':
+            unpacked_num: int = unpack_bundle(bundle_file, remove=not args.keep)
+            print(f"Unpacked {unpacked_num} file(s) from {bundle_file}.")
+    return None
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
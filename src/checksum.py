@@ -0,0 +1,209 @@
+__description__ =\
+"""
+Purpose: Checksum manifests of whole folders, hashed in parallel and readable by md5sum -c (or b2sum -c, sha256sum -c).
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# --------------------------------------------------
+from transfer import hash_file
+# --------------------------------------------------
+# algorithms a manifest can be made with, each readable by the coreutils tool of the same name (md5sum, b2sum, ...)
+CHECKSUM_ALGORITHMS: tuple = ('md5', 'sha1', 'sha256', 'blake2b')
+# every hashing thread reads with its own buffer of this size, reused for every file it hashes
+CHECKSUM_BUFFER_SIZE: int = 8 * 1024 * 1024
+CHECKSUM_WORKERS: int = 8
+# bumped when the format of the cache changes, older caches are ignored
+CACHE_VERSION: int = 1
+# --------------------------------------------------
+class ChecksumError(RuntimeError):
+    """ Raised when some files of a folder couldn't be hashed, so no manifest was written. """
+    def __init__(self, errors: dict) -> None:
+        """
+        Parameters:
+            errors: dict
+                relative path of every file that couldn't be hashed: the error
+        """
+        self.errors: dict = errors
+        path, error = next(iter(errors.items()))
+        super().__init__(f"Couldn't hash {len(errors)} file(s), e.g. {path}: {error}")
+class ChecksumCache:
+    """
+    Digests of files hashed before, each kept with the size, modification time (ns) and inode the file had when it was
+    hashed. A file whose stat still matches gets its cached digest back instead of being read again, so hashing a folder
+    again only reads the files that are new or changed. Shared by every hashing thread.
+    """
+    def __init__(self, cache_path: Path, algorithm: str = 'md5') -> None:
+        """
+        Parameters:
+            cache_path: Path
+                JSON file the cache is kept in, a missing (or unreadable) file starts an empty cache
+            algorithm: str
+                algorithm of the digests, a cache of another algorithm is ignored
+        """
+        self.cache_path: Path = cache_path
+        self.algorithm: str = algorithm
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+        # relative path: [size, mtime_ns, inode, digest]
+        self._entries: dict = {}
+        # entries of files seen since the cache was loaded, the only ones saved
+        self._seen: dict = {}
+        try:
+            with open(cache_path, encoding='utf-8') as cache_file: cache: dict = json.load(cache_file)
+            if cache.get('version') == CACHE_VERSION and cache.get('algorithm') == algorithm: self._entries = cache['files']
+        except (FileNotFoundError, ValueError, KeyError): pass
+    def lookup(self, path: str, path_stat: os.stat_result) -> str:
+        """ Returns the cached digest of a file if it hasn't changed since it was hashed, None otherwise. """
+        entry: list = self._entries.get(path)
+        with self._lock:
+            if entry and entry[:3] == [path_stat.st_size, path_stat.st_mtime_ns, path_stat.st_ino]:
+                self.hits += 1
+                self._seen[path] = entry
+                return entry[3]
+            self.misses += 1
+        return None
+    def record(self, path: str, path_stat: os.stat_result, digest: str) -> None:
+        """ Adds the digest of a file that was just hashed, with the stat it had before it was read. """
+        with self._lock: self._seen[path] = [path_stat.st_size, path_stat.st_mtime_ns, path_stat.st_ino, digest]
+        return None
+    def save(self, prune: bool = True) -> None:
+        """
+        Saves the cache, replacing the file atomically. With prune, only the entries of files seen since the cache was
+        loaded are kept (which drops deleted files, after the whole folder was hashed); otherwise the new entries are
+        added to the ones loaded.
+        """
+        temporary_cache_path: Path = self.cache_path.with_name(f'{self.cache_path.name}.tmp')
+        with self._lock: files: dict = dict(sorted((self._seen if prune else {**self._entries, **self._seen}).items()))
+        with open(temporary_cache_path, 'w', encoding='utf-8') as cache_file:
+            json.dump({'version': CACHE_VERSION, 'algorithm': self.algorithm, 'files': files}, cache_file)
+        os.replace(temporary_cache_path, self.cache_path)
+        return None
+# --------------------------------------------------
+def manifest_name(algorithm: str = 'md5') -> str:
+    """ Function returns the name of the manifest of an algorithm, checksum.md5 for md5 (like before). """
+    return f'checksum.{algorithm}'
+def cache_name(algorithm: str = 'md5') -> str:
+    """ Function returns the name of the (hidden) checksum cache kept beside the manifest of an algorithm. """
+    return f'.checksum.{algorithm}.cache.json'
+def list_files(root: Path) -> list:
+    """
+    Function lists every regular file below a folder, like find -type f: symlinks are neither followed nor listed.
+
+    Returns:
+        (list): relative paths (str, with / separators) of the files, sorted
+    """
+
+    files: list = []
+    folders: list = ['']
+    while folders:
+        folder: str = folders.pop()
+        with os.scandir(root.joinpath(folder)) as directory:
+            for entry in directory:
+                relative_path: str = f'{folder}/{entry.name}' if folder else entry.name
+                if entry.is_dir(follow_symlinks=False): folders.append(relative_path)
+                elif entry.is_file(follow_symlinks=False): files.append(relative_path)
+    return sorted(files)
+def checksum_tree(root: Path, algorithm: str = 'md5', workers: int = CHECKSUM_WORKERS, cache: ChecksumCache = None, files: list = None) -> dict:
+    """
+    Function hashes every file below a folder, workers files at a time. hashlib releases the GIL while hashing,
+    so the threads hash (and wait on the disk or network) in parallel. With a cache, files that haven't changed
+    since they were last hashed are only stat'ed; the cache is saved afterwards, even if some files couldn't be read.
+
+    Parameters:
+        root: Path
+            folder to hash
+        algorithm: str
+            hashlib algorithm, one of CHECKSUM_ALGORITHMS
+        workers: int
+            number of files hashed at the same time
+        cache: ChecksumCache
+            optional cache of earlier digests (of the same algorithm)
+        files: list
+            optional relative paths (str, with / separators) of the files to hash, e.g. from a listing made earlier; the
+            folder is listed with list_files() if None
+
+    Returns:
+        digests: dict
+            relative path (str, with / separators) of every file: hex digest, sorted by path
+
+    Raises ChecksumError if any file couldn't be read.
+    """
+
+    buffers = threading.local()
+    def _hash(relative_path: str) -> str:
+        try:
+            file_stat: os.stat_result = os.stat(root.joinpath(relative_path))
+            if cache and (digest := cache.lookup(relative_path, file_stat)): return digest
+            if not hasattr(buffers, 'buffer'): buffers.buffer = bytearray(CHECKSUM_BUFFER_SIZE)
+            digest = hash_file(root.joinpath(relative_path), algorithm, buffers.buffer)
+        except OSError as error: return error
+        if cache: cache.record(relative_path, file_stat, digest)
+        return digest
+
+    files = sorted(files) if files is not None else list_files(root)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor: results: list = list(executor.map(_hash, files))
+    if cache: cache.save()
+    errors: dict = {file: result for file, result in zip(files, results) if isinstance(result, OSError)}
+    if errors: raise ChecksumError(errors)
+    return dict(zip(files, results))
+def write_manifest(digests: dict, manifest_path: Path) -> None:
+    """
+    Function writes a manifest in the format of md5sum (two spaces between the digest and the path, which starts with ./
+    like the output of find), sorted by path. It's written under a temporary name and renamed, so a manifest is either
+    complete or missing. Paths with a backslash or a newline are escaped the way md5sum -c expects.
+    """
+
+    temporary_manifest_path: Path = manifest_path.with_name(f'{manifest_path.name}.tmp')
+    with open(temporary_manifest_path, 'w', encoding='utf-8', errors='surrogateescape', newline='\n') as manifest_file:
+        for path in sorted(digests):
+            if any([character in path for character in '\\\n\r']):
+                escaped_path: str = path.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r')
+                manifest_file.write(f'\\{digests[path]}  ./{escaped_path}\n')
+            else: manifest_file.write(f'{digests[path]}  ./{path}\n')
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.replace(temporary_manifest_path, manifest_path)
+    return None
+def read_manifest(manifest_path: Path) -> dict:
+    """
+    Function reads a manifest written by write_manifest() or md5sum (with or without ./ before the paths).
+
+    Returns:
+        digests: dict
+            relative path (str, with / separators) of every file: hex digest
+    """
+
+    digests: dict = {}
+    with open(manifest_path, encoding='utf-8', errors='surrogateescape', newline='\n') as manifest_file:
+        for line in manifest_file:
+            line = line.rstrip('\n')
+            if not line: continue
+            escaped: bool = line.startswith('\\')
+            digest, path = line[1 if escaped else 0:].split(' ', 1)
+            # md5sum writes " *" before paths hashed in binary mode, "  " otherwise
+            path = path[1:]
+            if escaped: path = path.replace('\\\\', '\0').replace('\\n', '\n').replace('\\r', '\r').replace('\0', '\\')
+            digests[path[2:] if path.startswith('./') else path] = digest
+    return digests
+def compare_manifests(expected: dict, found: dict) -> dict:
+    """
+    Function compares two manifests.
+
+    Returns:
+        differences: dict
+            "missing": paths only in expected, "extra": paths only in found, "mismatched": paths with different digests (all sorted lists)
+    """
+
+    return {
+        'missing': sorted(set(expected) - set(found)),
+        'extra': sorted(set(found) - set(expected)),
+        'mismatched': sorted([path for path in set(expected) & set(found) if expected[path] != found[path]])}
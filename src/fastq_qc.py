@@ -0,0 +1,170 @@
+__description__ =\
+"""
+Purpose: Quick QC of the .fastq.gz files of a run (read counts, lengths, quality per cycle and N content), without fastqc.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import os
+import gzip
+import json
+from collections import Counter
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+# --------------------------------------------------
+# bytes of a FASTQ file (decompressed) read at a time, the whole records in them are summarized together
+QC_READ_SIZE: int = 4 * 1024 * 1024
+# Illumina qualities are Phred+33
+PHRED_OFFSET: int = 33
+# quality characters below Q30, deleted to count the bases of at least Q30
+BELOW_Q30: bytes = bytes(range(PHRED_OFFSET + 30))
+QC_TSV_COLUMNS: tuple = ('sample', 'reads', 'bases', 'min_length', 'mean_length', 'max_length', 'gc_content', 'n_content', 'mean_quality', 'q30_fraction', 'error')
+# --------------------------------------------------
+def sample_name(fastq_path: Path) -> str:
+    """ Function returns the name of the sample of a FASTQ file, its name without .fastq(.gz). """
+    return fastq_path.name.removesuffix('.gz').removesuffix('.fastq').removesuffix('.fq')
+def summarize_fastq(fastq_path: Path) -> dict:
+    """
+    Function reads a .fastq.gz (or .fastq) file once, QC_READ_SIZE bytes at a time, and summarizes it. Every batch is
+    summarized with bytes.count(), translate() and sum() over the whole batch (or one cycle of it) instead of every base.
+
+    Parameters:
+        fastq_path: Path
+            FASTQ file to summarize
+
+    Returns:
+        summary: dict
+            reads, bases, lengths, GC and N content, mean quality and fraction of bases of at least Q30, the read length
+            distribution and the mean quality and N content of every cycle
+
+    Raises ValueError if a record isn't a FASTQ record, and EOFError if a .gz file is truncated.
+    """
+
+    reads, bases, gc_bases, n_bases, q30_bases, quality_sum = 0, 0, 0, 0, 0, 0
+    lengths: Counter = Counter()
+    quality_per_cycle: list = []
+    n_per_cycle: list = []
+
+    with (gzip.open(fastq_path, 'rb') if fastq_path.name.endswith('.gz') else open(fastq_path, 'rb')) as fastq_file:
+        for batch in _read_records(fastq_file):
+            if any([not header.startswith(b'@') for header in batch[0::4]]) or any([not separator.startswith(b'+') for separator in batch[2::4]]):
+                raise ValueError(f"{fastq_path.name} has a malformed record after read {reads}.")
+            sequences: list = [line.rstrip(b'\r') for line in batch[1::4]]
+            qualities: list = [line.rstrip(b'\r') for line in batch[3::4]]
+            if any([len(sequence) != len(quality) for sequence, quality in zip(sequences, qualities)]):
+                raise ValueError(f"{fastq_path.name} has a read whose sequence and quality differ in length after read {reads}.")
+
+            reads += len(sequences)
+            lengths.update(map(len, sequences))
+            all_bases: bytes = b''.join(sequences)
+            all_qualities: bytes = b''.join(qualities)
+            bases += len(all_bases)
+            gc_bases += all_bases.count(b'G') + all_bases.count(b'C') + all_bases.count(b'g') + all_bases.count(b'c')
+            n_bases += all_bases.count(b'N') + all_bases.count(b'n')
+            q30_bases += len(all_qualities.translate(None, BELOW_Q30))
+            quality_sum += sum(all_qualities)
+
+            # reads of the same length are joined, so every cycle is a strided slice of the joined bytes; the number of
+            # reads of every cycle comes from the lengths
+            by_length: dict = {}
+            for sequence, quality in zip(sequences, qualities): by_length.setdefault(len(sequence), []).append((sequence, quality))
+            for length, length_reads in by_length.items():
+                if length > len(quality_per_cycle):
+                    quality_per_cycle.extend([0] * (length - len(quality_per_cycle)))
+                    n_per_cycle.extend([0] * (length - len(n_per_cycle)))
+                length_bases: bytes = b''.join([sequence for sequence, _ in length_reads]).upper()
+                length_qualities: bytes = b''.join([quality for _, quality in length_reads])
+                for cycle in range(length):
+                    quality_per_cycle[cycle] += sum(length_qualities[cycle::length])
+                    n_per_cycle[cycle] += length_bases[cycle::length].count(b'N')
+
+    reads_per_cycle: list = []
+    reads_left: int = reads
+    for cycle in range(len(quality_per_cycle)):
+        reads_per_cycle.append(reads_left)
+        reads_left -= lengths.get(cycle + 1, 0)
+    return {
+        'file': str(fastq_path),
+        'sample': sample_name(fastq_path),
+        'reads': reads,
+        'bases': bases,
+        'min_length': min(lengths) if lengths else 0,
+        'mean_length': bases / reads if reads else 0.0,
+        'max_length': max(lengths) if lengths else 0,
+        'gc_content': gc_bases / bases if bases else 0.0,
+        'n_content': n_bases / bases if bases else 0.0,
+        'mean_quality': (quality_sum - PHRED_OFFSET * bases) / bases if bases else 0.0,
+        'q30_fraction': q30_bases / bases if bases else 0.0,
+        'length_distribution': {str(length): count for length, count in sorted(lengths.items())},
+        'mean_quality_per_cycle': [round((quality - PHRED_OFFSET * count) / count, 2) for quality, count in zip(quality_per_cycle, reads_per_cycle)],
+        'n_content_per_cycle': [round(n / count, 6) for n, count in zip(n_per_cycle, reads_per_cycle)]}
+def _read_records(fastq_file) -> Iterator:
+    """
+    Function reads a FASTQ file QC_READ_SIZE bytes at a time (readline() of a gzip file is much slower) and splits them
+    into lines.
+
+    Yields:
+        (list): the lines (bytes, without their newlines) of whole records, 4 per record
+    """
+
+    lines: list = []
+    remainder: bytes = b''
+    while chunk := fastq_file.read(QC_READ_SIZE):
+        lines.extend((remainder + chunk).split(b'\n'))
+        remainder = lines.pop()
+        records_end: int = len(lines) - len(lines) % 4
+        if records_end: yield lines[:records_end]
+        lines = lines[records_end:]
+    # the last line, unless the file ends with a newline
+    if remainder: lines.append(remainder)
+    if len(lines) % 4: raise ValueError(f"{getattr(fastq_file, 'name', 'The file')} ends with an incomplete record.")
+    if lines: yield lines
+    return None
+def _summarize(fastq_path: Path) -> dict:
+    """ Function summarizes a FASTQ file in a worker process, returning what went wrong instead of raising it. """
+    try: return summarize_fastq(fastq_path)
+    except (OSError, EOFError, ValueError) as error: return {'file': str(fastq_path), 'sample': sample_name(fastq_path), 'error': f'{type(error).__name__}: {error}'}
+def qc_fastq_files(fastq_files: list, destination_dir: Path, tsv_path: Path, workers: int = 1) -> list:
+    """
+    Function summarizes FASTQ files with summarize_fastq(), workers files at a time in separate processes (parsing is
+    CPU-bound, so threads would share one core), and writes the summary of every file to {sample}.qc.json in the
+    destination directory and one line per file to a TSV. Files that can't be read are in the TSV with their error.
+
+    Parameters:
+        fastq_files: list
+            FASTQ files (Path) to summarize
+        destination_dir: Path
+            directory the JSON summaries are written to
+        tsv_path: Path
+            TSV of the whole run
+        workers: int
+            number of files summarized at the same time
+
+    Returns:
+        summaries: list
+            the summary (dict) of every file, in the order of fastq_files
+    """
+
+    destination_dir.mkdir(parents=True, exist_ok=True)
+    # the largest files first, so one doesn't start last and hold up the rest
+    by_size: list = sorted(fastq_files, key=lambda fastq_path: fastq_path.stat().st_size, reverse=True)
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(fastq_files) or 1))) as executor:
+        by_path: dict = dict(zip(by_size, executor.map(_summarize, by_size)))
+    summaries: list = [by_path[fastq_path] for fastq_path in fastq_files]
+
+    for summary in summaries:
+        if 'error' not in summary: _write_atomically(destination_dir.joinpath(f"{summary['sample']}.qc.json"), json.dumps(summary, indent=4))
+    rows: list = ['\t'.join(QC_TSV_COLUMNS)]
+    for summary in summaries:
+        rows.append('\t'.join([f'{value:.4f}' if isinstance(value, float) else str(value) for value in [summary.get(column, '') for column in QC_TSV_COLUMNS]]))
+    _write_atomically(tsv_path, '\n'.join(rows) + '\n')
+    return summaries
+def _write_atomically(path: Path, text: str) -> None:
+    """ Function writes a text file under a temporary name and renames it, so it's either complete or missing. """
+    temporary_path: Path = path.with_name(f'{path.name}.tmp')
+    with open(temporary_path, 'w', encoding='utf-8') as text_file: text_file.write(text)
+    os.replace(temporary_path, path)
+    return None
@@ -0,0 +1,253 @@
+__description__ =\
+"""
+Purpose: Throughput, latency and ETA of backup runs, shown on the console and saved as JSON beside the log.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import os
+import stat
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from collections import deque
+from collections.abc import Iterator, Iterable
+# --------------------------------------------------
+# the rolling throughput (and so the ETA) is averaged over this many seconds
+ROLLING_WINDOW: float = 30.0
+# seconds between updates of the progress line
+PROGRESS_INTERVAL: float = 1.0
+# --------------------------------------------------
+class RunMetrics:
+    """
+    Counters of a single instrument's backup: how long the scan took (and how much of it went to listing the input
+    and the destination), and the bytes, duration and backend of every copy. Shared by the scan and every copy worker.
+    """
+    def __init__(self, instrument: str) -> None:
+        """
+        Parameters:
+            instrument: str
+                name of the instrument being backed up
+        """
+        self.instrument: str = instrument
+        self.started: datetime = datetime.now()
+        self._start: float = time.perf_counter()
+        self._lock = threading.Lock()
+
+        self.scanning: bool = False
+        self.scan_seconds: float = 0.0
+        self.input_listing_seconds: float = 0.0
+        self.destination_listing_seconds: float = 0.0
+        self.entries_checked: int = 0
+        self.destination_dirs_listed: int = 0
+        # what the scan found that will be copied
+        self.found_files: int = 0
+        self.found_bytes: int = 0
+
+        # when the first batch of copies started, and the time spent in batches of copies (the backup, then every
+        # batch of --watch), which leaves out the time spent waiting for changes in between
+        self.copy_started: float = None
+        self.copy_seconds: float = 0.0
+        self._batch_started: float = None
+        self.worker_wait_seconds: float = 0.0
+        self.failed_files: int = 0
+        # (path, bytes, seconds, backend, number of files) of every copy
+        self.copies: list = []
+        self.copied_files: int = 0
+        self.copied_bytes: int = 0
+        # (time, bytes) of the copies in the last ROLLING_WINDOW seconds
+        self._recent: deque = deque()
+    def timed_scan(self, changes: Iterable) -> Iterator:
+        """ Passes changes through, adding the time spent waiting for each one to the scan time. """
+        self.scanning = True
+        try:
+            iterator = iter(changes)
+            while True:
+                started: float = time.perf_counter()
+                try: change = next(iterator)
+                except StopIteration: break
+                finally: self.scan_seconds += time.perf_counter() - started
+                yield change
+        finally: self.scanning = False
+        return None
+    def start_copy(self) -> None:
+        """ Marks the start of a batch of copies. """
+        self._batch_started = time.perf_counter()
+        if self.copy_started is None: self.copy_started = self._batch_started
+        return None
+    def finish_copy(self) -> None:
+        """ Marks the end of a batch of copies, adding its time to the copy time. """
+        if self._batch_started is not None: self.copy_seconds += time.perf_counter() - self._batch_started
+        self._batch_started = None
+        return None
+    def record_listing(self, side: str, seconds: float) -> None:
+        """ Adds the time it took to list a folder of the "input" or the "destination". """
+        if side == 'input': self.input_listing_seconds += seconds
+        else:
+            self.destination_listing_seconds += seconds
+            self.destination_dirs_listed += 1
+        return None
+    def record_found(self, path_stat: os.stat_result) -> None:
+        """ Adds a path that will be copied to what's left to do. """
+        if stat.S_ISREG(path_stat.st_mode):
+            self.found_files += 1
+            self.found_bytes += path_stat.st_size
+        return None
+    def record_copy(self, path: Path, size: int, seconds: float, backend: str, files: int = 1) -> None:
+        """ Adds a finished copy (or a bundle of files). """
+        now: float = time.perf_counter()
+        with self._lock:
+            self.copies.append((path.as_posix() if isinstance(path, Path) else str(path), size, seconds, backend, files))
+            self.copied_files += files
+            self.copied_bytes += size
+            self._recent.append((now, size))
+        return None
+    def record_failure(self) -> None:
+        """ Adds a path that couldn't be copied. """
+        with self._lock: self.failed_files += 1
+        return None
+    def throughput(self) -> float:
+        """ Returns the bytes copied per second over the last ROLLING_WINDOW seconds. """
+        now: float = time.perf_counter()
+        with self._lock:
+            while self._recent and now - self._recent[0][0] > ROLLING_WINDOW: self._recent.popleft()
+            recent_bytes: int = sum([size for _, size in self._recent])
+        if self.copy_started is None: return 0.0
+        return recent_bytes / max(1e-3, min(ROLLING_WINDOW, now - self.copy_started))
+    def eta(self) -> float:
+        """ Returns the seconds left to copy what has been found so far at the rolling throughput, None if unknown. """
+        rate: float = self.throughput()
+        if not rate: return None
+        return max(0, self.found_bytes - self.copied_bytes) / rate
+    def progress(self) -> str:
+        """ Returns a single line of progress. """
+        done_fraction: float = self.copied_bytes / self.found_bytes if self.found_bytes else 0.0
+        eta: float = self.eta()
+        eta_str: str = str(timedelta(seconds=round(eta))) if eta is not None else '?'
+        return (
+            f"{self.instrument}: {self.copied_files}/{self.found_files} file(s), "
+            f"{format_bytes(self.copied_bytes)}/{format_bytes(self.found_bytes)} ({done_fraction:.0%}), "
+            f"{format_bytes(self.throughput())}/s, ETA {eta_str}{' (still scanning)' if self.scanning else ''}")
+    def summary(self) -> str:
+        """ Returns the totals as a single line for the log. """
+        metrics: dict = self.to_dict()
+        copy: dict = metrics['copy']
+        return (
+            f"Scan took {metrics['scan']['seconds']:.1f} s (listing: {metrics['scan']['input_listing_seconds']:.1f} s input, "
+            f"{metrics['scan']['destination_listing_seconds']:.1f} s destination); copying took {copy['seconds']:.1f} s for "
+            f"{format_bytes(copy['bytes'])} ({format_bytes(copy['bytes_per_second'])}/s, median {copy['file_seconds']['p50']:.3f} s per file, "
+            f"{copy['worker_wait_seconds']:.1f} s waiting on the workers).")
+    def to_dict(self) -> dict:
+        """ Returns every metric as a dict that can be saved as JSON. """
+        with self._lock: copies: list = list(self.copies)
+        copy_seconds: float = self.copy_seconds + (time.perf_counter() - self._batch_started if self._batch_started is not None else 0.0)
+        file_seconds: list = sorted([seconds for _, _, seconds, _, files in copies if files == 1])
+        by_backend: dict = {}
+        for _, size, seconds, backend, files in copies:
+            backend_metrics: dict = by_backend.setdefault(backend, {'files': 0, 'bytes': 0, 'busy_seconds': 0.0})
+            backend_metrics['files'] += files
+            backend_metrics['bytes'] += size
+            backend_metrics['busy_seconds'] += seconds
+        return {
+            'instrument': self.instrument,
+            'started': self.started.isoformat(timespec='seconds'),
+            'wall_seconds': time.perf_counter() - self._start,
+            'scan': {
+                'seconds': self.scan_seconds,
+                'input_listing_seconds': self.input_listing_seconds,
+                'destination_listing_seconds': self.destination_listing_seconds,
+                'entries_checked': self.entries_checked,
+                'destination_dirs_listed': self.destination_dirs_listed,
+                'files_found': self.found_files,
+                'bytes_found': self.found_bytes},
+            'copy': {
+                'seconds': copy_seconds,
+                'files': self.copied_files,
+                'failed_files': self.failed_files,
+                'bytes': self.copied_bytes,
+                'bytes_per_second': self.copied_bytes / copy_seconds if copy_seconds else 0.0,
+                'busy_seconds': sum([seconds for _, _, seconds, _, _ in copies]),
+                'worker_wait_seconds': self.worker_wait_seconds,
+                'file_seconds': {
+                    'p50': _percentile(file_seconds, 0.5),
+                    'p90': _percentile(file_seconds, 0.9),
+                    'p99': _percentile(file_seconds, 0.99),
+                    'max': file_seconds[-1] if file_seconds else 0.0},
+                'by_backend': by_backend},
+            'files': [{'path': path, 'bytes': size, 'seconds': seconds, 'backend': backend, 'files': files} for path, size, seconds, backend, files in copies]}
+    def write(self, metrics_path: Path) -> None:
+        """ Saves every metric as JSON, replacing the file atomically. """
+        temporary_metrics_path: Path = metrics_path.with_name(f"{metrics_path.name}.tmp")
+        with open(temporary_metrics_path, 'w', encoding='utf-8') as metrics_file: json.dump(self.to_dict(), metrics_file, indent=4)
+        os.replace(temporary_metrics_path, metrics_path)
+        return None
+class ProgressHandler(logging.StreamHandler):
+    """
+    Console log handler that keeps a progress line below the log messages when the console is a terminal:
+    the line is cleared before every message and drawn again after it.
+    """
+    def __init__(self, stream=None) -> None:
+        super().__init__(stream)
+        self.enabled: bool = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self._line: str = ''
+    def emit(self, record: logging.LogRecord) -> None:
+        if not (self.enabled and self._line): return super().emit(record)
+        self.stream.write('\r\033[K')
+        super().emit(record)
+        self.stream.write(self._line)
+        self.flush()
+        return None
+    def show(self, line: str) -> None:
+        """ Replaces the progress line, an empty line removes it. """
+        if not self.enabled: return None
+        self.acquire()
+        try:
+            self._line = line
+            self.stream.write(f'\r\033[K{line}')
+            self.flush()
+        finally: self.release()
+        return None
+class ProgressReporter:
+    """ Thread that redraws the progress line of a ProgressHandler every PROGRESS_INTERVAL seconds. """
+    def __init__(self, handler: ProgressHandler, metrics: list) -> None:
+        """
+        Parameters:
+            handler: ProgressHandler
+                console handler the progress is shown by
+            metrics: list
+                RunMetrics of every instrument being backed up
+        """
+        self.handler: ProgressHandler = handler
+        self.metrics: list = metrics
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+    def start(self) -> None:
+        """ Starts drawing the progress line, unless the console isn't a terminal. """
+        if self.handler.enabled: self._thread.start()
+        return None
+    def stop(self) -> None:
+        """ Stops drawing and removes the progress line. """
+        self._stop.set()
+        if self._thread.is_alive(): self._thread.join()
+        self.handler.show('')
+        return None
+    def _run(self) -> None:
+        while not self._stop.wait(PROGRESS_INTERVAL):
+            self.handler.show(' | '.join([metrics.progress() for metrics in self.metrics]))
+        return None
+# --------------------------------------------------
+def format_bytes(size: float) -> str:
+    """ Function formats a number of bytes with a binary unit. """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024: return f"{size:.1f} {unit}" if unit != 'B' else f"{size:.0f} B"
+        size /= 1024
+    return f"{size:.1f} TiB"
+def _percentile(values: list, fraction: float) -> float:
+    """ Function returns a percentile of sorted values (nearest rank), 0 if there are none. """
+    if not values: return 0.0
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
@@ -0,0 +1,156 @@
+__description__ =\
+"""
+Purpose: Streaming PhiX alignment of the Undetermined reads for archive-ngs-run.py, without a SAM file on disk.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import os
+import gzip
+import json
+import zlib
+import time
+import threading
+import subprocess
+from itertools import islice
+from collections.abc import Iterator
+# --------------------------------------------------
+import profiling
+# --------------------------------------------------
+PHIX_REFERENCE: Path = Path('/home/agc/Documents/ref/genomes/phiX/phix174.fasta')
+# SAM flags, see the SAM specification
+FLAG_UNMAPPED: int = 0x4
+FLAG_REVERSE: int = 0x10
+FLAG_READ1: int = 0x40
+FLAG_READ2: int = 0x80
+FLAG_SECONDARY: int = 0x100
+FLAG_SUPPLEMENTARY: int = 0x800
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+# --------------------------------------------------
+def read_pairs(read_1: Path, read_2: Path) -> Iterator:
+    """
+    Function reads the records of an R1/R2 pair of FASTQ files in step.
+
+    Yields:
+        (tuple): (R1 record, R2 record), each the 4 lines of the record (str, with their newlines)
+    """
+
+    with gzip.open(read_1, 'rt') as file_1, gzip.open(read_2, 'rt') as file_2:
+        while True:
+            record_1: list = list(islice(file_1, 4))
+            record_2: list = list(islice(file_2, 4))
+            if not record_1 or not record_2:
+                if record_1 or record_2: raise ValueError(f"{read_1.name} and {read_2.name} don't have the same number of reads.")
+                return None
+            yield (record_1, record_2)
+def is_sampled(header: str, fraction: float, seed: int = 0) -> bool:
+    """
+    Function decides whether a read is in a subsample, from the CRC32 of its name (without /1, /2 or the comment) and the
+    seed, so the same reads (and both reads of a pair) are always picked, whatever the order they're read in.
+    """
+    name: str = header[1:].split(maxsplit=1)[0].removesuffix('/1').removesuffix('/2')
+    return zlib.crc32(f'{seed}:{name}'.encode()) < fraction * 2 ** 32
+def stream_phix(read_1: Path, read_2: Path, destination_dir: Path, reference: Path = PHIX_REFERENCE, threads: int = 1, fraction: float = 1.0, seed: int = 0) -> dict:
+    """
+    Function aligns the Undetermined reads to PhiX with bwa mem and writes the reads that mapped to PhiX.R1.fastq.gz and
+    PhiX.R2.fastq.gz as the alignments come out of bwa (like samtools view -F 4 | samtools fastq), so the SAM output is
+    never written to disk. With a fraction below 1, only a deterministic subsample of the read pairs (see is_sampled())
+    is streamed to bwa, which is enough to estimate the PhiX content. bwa's messages are written to bwa.log.
+
+    Parameters:
+        read_1, read_2: Path
+            the Undetermined R1 and R2 .fastq.gz files
+        destination_dir: Path
+            directory the PhiX reads and bwa.log are written to
+        reference: Path
+            PhiX reference, indexed with bwa index
+        threads: int
+            number of threads bwa aligns with
+        fraction: float
+            fraction (0 < fraction <= 1) of the read pairs to align
+        seed: int
+            seed of the subsample
+
+    Returns:
+        summary: dict
+            pairs read and aligned, primary alignments, mapped reads and the PhiX alignment rate (mapped / aligned reads)
+    """
+
+    subsample: bool = fraction < 1.0
+    # without a subsample, bwa reads the files itself; otherwise the sampled pairs are interleaved into its stdin (-p)
+    command: list = ['bwa', 'mem', '-t', str(max(1, threads)), *(['-p', str(reference), '-'] if subsample else [str(reference), str(read_1), str(read_2)])]
+    summary: dict = {
+        'read_1': str(read_1),
+        'read_2': str(read_2),
+        'reference': str(reference),
+        'fraction': fraction,
+        'seed': seed if subsample else None,
+        'pairs_read': None,
+        'pairs_aligned': None,
+        'reads_aligned': 0,
+        'reads_mapped': 0,
+        'phix_rate': 0.0}
+
+    with open(destination_dir.joinpath('bwa.log'), 'w') as log_file:
+        start_time: float = time.perf_counter()
+        aligner = subprocess.Popen(command, stdin=subprocess.PIPE if subsample else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log_file, text=True, bufsize=1024 * 1024)
+        feeder_errors: list = []
+        def _feed() -> None:
+            pairs_read, pairs_aligned = 0, 0
+            try:
+                for record_1, record_2 in read_pairs(read_1, read_2):
+                    pairs_read += 1
+                    if not is_sampled(record_1[0], fraction, seed): continue
+                    pairs_aligned += 1
+                    aligner.stdin.writelines(record_1)
+                    aligner.stdin.writelines(record_2)
+            except (OSError, ValueError) as error: feeder_errors.append(error)
+            finally:
+                summary['pairs_read'], summary['pairs_aligned'] = pairs_read, pairs_aligned
+                try: aligner.stdin.close()
+                except OSError: pass
+            return None
+        feeder = threading.Thread(target=_feed, name='phiX-subsample', daemon=True)
+        if subsample: feeder.start()
+
+        temporary_paths: list = [destination_dir.joinpath(f'.PhiX.R{read}.fastq.gz.partial') for read in (1, 2)]
+        try:
+            with gzip.open(temporary_paths[0], 'wt') as phix_1, gzip.open(temporary_paths[1], 'wt') as phix_2:
+                for line in aligner.stdout:
+                    if line.startswith('@'): continue
+                    fields: list = line.rstrip('\n').split('\t', 11)
+                    flag: int = int(fields[1])
+                    if flag & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY): continue
+                    summary['reads_aligned'] += 1
+                    if flag & FLAG_UNMAPPED: continue
+                    summary['reads_mapped'] += 1
+                    sequence, quality = fields[9], fields[10]
+                    # reads are stored as aligned, the original read is the reverse complement
+                    if flag & FLAG_REVERSE: sequence, quality = sequence.translate(COMPLEMENT)[::-1], quality[::-1]
+                    (phix_2 if flag & FLAG_READ2 else phix_1).write(f'@{fields[0]}\n{sequence}\n+\n{quality}\n')
+        except:
+            aligner.kill()
+            for temporary_path in temporary_paths: temporary_path.unlink(missing_ok=True)
+            raise
+        finally:
+            aligner.stdout.close()
+            return_code: int = profiling.wait_command(aligner, command, start_time)
+            if subsample: feeder.join()
+        if return_code != 0 or feeder_errors:
+            for temporary_path in temporary_paths: temporary_path.unlink(missing_ok=True)
+            if return_code != 0: raise RuntimeError(f"bwa mem exited with {return_code}, see {destination_dir.joinpath('bwa.log')}")
+            raise feeder_errors[0]
+
+    for read, temporary_path in zip((1, 2), temporary_paths): os.replace(temporary_path, destination_dir.joinpath(f'PhiX.R{read}.fastq.gz'))
+    if not subsample: summary['pairs_read'] = summary['pairs_aligned'] = summary['reads_aligned'] // 2
+    summary['phix_rate'] = summary['reads_mapped'] / summary['reads_aligned'] if summary['reads_aligned'] else 0.0
+    return summary
+def write_summary(summary: dict, summary_path: Path) -> None:
+    """ Function writes the summary of stream_phix() as JSON, replacing the file atomically. """
+    temporary_summary_path: Path = summary_path.with_name(f'{summary_path.name}.tmp')
+    with open(temporary_summary_path, 'w', encoding='utf-8') as summary_file: json.dump(summary, summary_file, indent=4)
+    os.replace(temporary_summary_path, summary_path)
+    return None
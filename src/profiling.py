@@ -0,0 +1,204 @@
+__description__ =\
+"""
+Purpose: Profiles the stages of archive-ngs-run.py: time, CPU, memory, I/O and exit status of every stage and command.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import os
+import json
+import time
+import logging
+import resource
+import subprocess
+from contextvars import ContextVar
+# --------------------------------------------------
+from metrics import format_bytes
+# --------------------------------------------------
+# commands run by the stage of the current thread (list of dict), None outside of a stage
+COMMANDS: ContextVar = ContextVar('commands', default=None)
+# ru_maxrss is in KiB on Linux
+RSS_UNIT: int = 1024
+# ru_inblock and ru_oublock count blocks of 512 bytes
+BLOCK_SIZE: int = 512
+# --------------------------------------------------
+class Profile:
+    """
+    What a stage used while it ran. Commands run with run_command() or waited for with wait_command() are profiled
+    one by one (wait4() returns the resources used by that child only), so their CPU time and I/O are exact even when
+    other stages run at the same time. Their peak memory isn't below the memory of the script when it started them:
+    a child is forked from the script and, on Linux, keeps the peak of the forked copy after it runs the command.
+    The CPU time and bytes read and written by the script itself (e.g. copying and hashing), and the CPU time of every
+    child that ended while the stage ran (getrusage(RUSAGE_CHILDREN), which also counts e.g. the processes of
+    fastq_qc), are only known for the whole process, so they include what stages running at the same time used (see
+    overlapped).
+    """
+    def __init__(self) -> None:
+        self.commands: list = []
+        self.seconds: float = None
+        self.cpu_user: float = None
+        self.cpu_system: float = None
+        self.children_cpu_user: float = None
+        self.children_cpu_system: float = None
+        self.read_bytes: int = None
+        self.write_bytes: int = None
+        self.peak_rss: int = None
+        # names of the stages that ran at the same time
+        self.overlapped: list = []
+        self._started: float = None
+        self._ended: float = None
+    def __enter__(self):
+        self._token = COMMANDS.set(self.commands)
+        self._usage: resource.struct_rusage = resource.getrusage(resource.RUSAGE_SELF)
+        self._children_usage: resource.struct_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._io: dict = process_io()
+        self._started = time.perf_counter()
+        return self
+    def __exit__(self, *exc_info) -> bool:
+        self._ended = time.perf_counter()
+        usage: resource.struct_rusage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage: resource.struct_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io: dict = process_io()
+        COMMANDS.reset(self._token)
+        self.seconds = self._ended - self._started
+        self.cpu_user = usage.ru_utime - self._usage.ru_utime
+        self.cpu_system = usage.ru_stime - self._usage.ru_stime
+        self.children_cpu_user = children_usage.ru_utime - self._children_usage.ru_utime
+        self.children_cpu_system = children_usage.ru_stime - self._children_usage.ru_stime
+        if io and self._io:
+            self.read_bytes = io['read_bytes'] - self._io['read_bytes']
+            self.write_bytes = io['write_bytes'] - self._io['write_bytes']
+        # the script's own peak (a high-water mark since it started) or the largest command, whichever is larger
+        self.peak_rss = max([usage.ru_maxrss * RSS_UNIT, *[command['peak_rss'] for command in self.commands]])
+        return False
+    def overlaps(self, other) -> bool:
+        """ Returns True if two profiled stages ran at the same time. """
+        if None in (self._started, self._ended, other._started, other._ended): return False
+        return self._started < other._ended and other._started < self._ended
+    def exit_code(self) -> int:
+        """ Returns the first non-zero exit status of the commands, 0 if they all succeeded, None if there weren't any. """
+        if not self.commands: return None
+        return next(iter([command['exit_code'] for command in self.commands if command['exit_code'] != 0]), 0)
+    def as_dict(self) -> dict:
+        """ Returns the profile as a dict (for JSON). """
+        return {
+            'seconds': self.seconds,
+            'cpu_user': self.cpu_user,
+            'cpu_system': self.cpu_system,
+            'children_cpu_user': self.children_cpu_user,
+            'children_cpu_system': self.children_cpu_system,
+            'peak_rss': self.peak_rss,
+            'read_bytes': self.read_bytes,
+            'write_bytes': self.write_bytes,
+            'exit_code': self.exit_code(),
+            'overlapped': self.overlapped,
+            'commands': self.commands}
+# --------------------------------------------------
+def process_io() -> dict:
+    """
+    Function returns the bytes the script has read and written (rchar and wchar of /proc/self/io, which count network
+    shares and the page cache too, unlike read_bytes and write_bytes), or an empty dict where /proc isn't available.
+    """
+    try:
+        with open('/proc/self/io', encoding='utf-8') as io_file: counters: dict = dict([line.split(':') for line in io_file.read().splitlines() if ':' in line])
+        return {'read_bytes': int(counters['rchar']), 'write_bytes': int(counters['wchar'])}
+    except (OSError, KeyError, ValueError): return {}
+def run_command(command, shell: bool = False, stdout=None, stderr=None) -> int:
+    """
+    Function runs a command like subprocess.run() (stdout and stderr can be None, subprocess.DEVNULL or a file, the
+    output isn't captured) and profiles it (see wait_command()).
+
+    Returns:
+        exit_code: int
+            exit status of the command, negative if it was killed by a signal
+    """
+
+    start_time: float = time.perf_counter()
+    process = subprocess.Popen(command, shell=shell, stdout=stdout, stderr=stderr)
+    return wait_command(process, command, start_time)
+def wait_command(process: subprocess.Popen, command=None, start_time: float = None) -> int:
+    """
+    Function waits for a command started with subprocess.Popen and, inside a profiled stage, records how long it ran,
+    its exit status, its CPU time, peak memory and the bytes it read and wrote to disk, from the wait4() of that child.
+    The peak memory (ru_maxrss) has the memory of the script as a floor: on Linux it counts the copy of the script the
+    command was forked from, before it was replaced by the command, so a small command shows the script's memory.
+    A failed command is logged but doesn't raise, like subprocess.run() without check. start_time (time.perf_counter())
+    is when the command was started, if it wasn't right before it's waited for.
+
+    Returns:
+        exit_code: int
+            exit status of the command, negative if it was killed by a signal
+    """
+
+    start_time = start_time if start_time is not None else time.perf_counter()
+    command = command if command is not None else process.args
+    command_str: str = command if isinstance(command, str) else ' '.join([str(argument) for argument in command])
+    if process.returncode is not None: return process.returncode
+    try:
+        _, wait_status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(wait_status)
+    except ChildProcessError:
+        # already waited for elsewhere
+        process.wait()
+        usage = None
+    commands: list = COMMANDS.get()
+    if commands is not None:
+        commands.append({
+            'command': command_str,
+            'exit_code': process.returncode,
+            'seconds': time.perf_counter() - start_time,
+            'cpu_user': usage.ru_utime if usage else 0.0,
+            'cpu_system': usage.ru_stime if usage else 0.0,
+            'peak_rss': usage.ru_maxrss * RSS_UNIT if usage else 0,
+            'read_bytes': usage.ru_inblock * BLOCK_SIZE if usage else 0,
+            'write_bytes': usage.ru_oublock * BLOCK_SIZE if usage else 0})
+    if process.returncode != 0: logging.warning(f"{command_str.split()[0]} exited with {process.returncode}: {command_str}")
+    return process.returncode
+def write_profile(profiles: dict, profile_path: Path) -> None:
+    """
+    Function writes the profiles of the stages of a run as JSON, replacing the file atomically.
+
+    Parameters:
+        profiles: dict
+            name of every stage: {"status": str, "threads": int, **Profile.as_dict()}
+        profile_path: Path
+            JSON file to write
+    """
+
+    temporary_profile_path: Path = profile_path.with_name(f'{profile_path.name}.tmp')
+    with open(temporary_profile_path, 'w', encoding='utf-8') as profile_file: json.dump(profiles, profile_file, indent=4)
+    os.replace(temporary_profile_path, profile_path)
+    return None
+def summary_table(profiles: dict) -> str:
+    """
+    Function formats the profiles of the stages of a run (see write_profile()) as a table for the log, followed by the
+    commands every stage ran, which are profiled one by one.
+    """
+    rows: list = [('stage', 'status', 'wall', 'cpu', 'child cpu', 'peak rss', 'read', 'written', 'exit')]
+    for name, profile in profiles.items():
+        rows.append((
+            name,
+            profile['status'],
+            _format_seconds(profile.get('seconds')),
+            _format_seconds((profile['cpu_user'] or 0) + (profile['cpu_system'] or 0)) if profile.get('cpu_user') is not None else '-',
+            _format_seconds(profile['children_cpu_user'] + profile['children_cpu_system']) if profile.get('children_cpu_user') is not None else '-',
+            format_bytes(profile['peak_rss']) if profile.get('peak_rss') is not None else '-',
+            format_bytes(profile['read_bytes']) if profile.get('read_bytes') is not None else '-',
+            format_bytes(profile['write_bytes']) if profile.get('write_bytes') is not None else '-',
+            str(profile['exit_code']) if profile.get('exit_code') is not None else '-'))
+    widths: list = [max([len(row[column]) for row in rows]) for column in range(len(rows[0]))]
+    lines: list = ['  '.join([value.ljust(width) if column == 0 else value.rjust(width) for column, (value, width) in enumerate(zip(row, widths))]) for row in rows]
+    if any([profile.get('commands') for profile in profiles.values()]): lines.append("commands (peak rss is at least the memory of the script, which they're forked from):")
+    for name, profile in profiles.items():
+        for command in profile.get('commands', []):
+            lines.append(f"{name}: {command['command'].split()[0]} exited with {command['exit_code']} after {_format_seconds(command['seconds'])}, cpu {_format_seconds(command['cpu_user'] + command['cpu_system'])}, peak rss {format_bytes(command['peak_rss'])}, read {format_bytes(command['read_bytes'])}, written {format_bytes(command['write_bytes'])}")
+    return '\n'.join(lines)
+def _format_seconds(seconds: float) -> str:
+    """ Function formats seconds as 1.2 s, 3m04s or 2h05m. """
+    if seconds is None: return '-'
+    if seconds < 60: return f'{seconds:.1f} s'
+    if seconds < 3600: return f'{int(seconds // 60)}m{int(seconds % 60):02d}s'
+    return f'{int(seconds // 3600)}h{int(seconds % 3600 // 60):02d}m'
@@ -0,0 +1,121 @@
+__description__ =\
+"""
+Purpose: Index of an NGS run directory, built in a single pass and shared by every stage of archive-ngs-run.py.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import os
+import fnmatch
+# --------------------------------------------------
+# folders of the run directory that are never the MiSeqOutput directory
+NOT_MISEQ_OUTPUT: tuple = ('analysis', 'docs')
+FASTQ_SUFFIX: str = '.fastq.gz'
+# --------------------------------------------------
+class RunIndex:
+    """
+    Every folder, file (with its stat) and symlink of a run directory, listed once with os.scandir, and what the
+    archive stages look for in it: the MiSeqOutput directory, the directory with the FASTQ files, the Undetermined
+    R1/R2 pair and the analysis outputs. Stages that write into the run directory rescan() what they wrote.
+    """
+    def __init__(self, root: Path) -> None:
+        """
+        Parameters:
+            root: Path
+                run directory ({date}-{run}_{information})
+        """
+        self.root: Path = root
+        # relative path (str, with / separators): os.stat_result
+        self.files: dict = {}
+        self.folders: set = set()
+        self.symlinks: set = set()
+        # relative path of a folder: names of the entries directly in it
+        self._children: dict = {}
+        self.miseq_output: Path = None
+        self.fastq_dir: Path = None
+        self.fastq_files: list = []
+        self.undetermined: tuple = None
+        self.rescan()
+    def rescan(self, folder: str = '', recursive: bool = True) -> None:
+        """
+        Lists a folder of the run directory (and everything below it) again, e.g. after a stage wrote into it.
+        If not recursive, only the entries directly in the folder are listed again, what was listed below them is kept.
+        """
+        prefix: str = f'{folder}/' if folder else ''
+        below = lambda path: path.startswith(prefix) and (recursive or '/' not in path[len(prefix):])
+        for path in [path for path in self.files if below(path)]: del self.files[path]
+        for path in [path for path in self._children if path == folder or (recursive and below(path))]: del self._children[path]
+        if recursive: self.folders = {path for path in self.folders if not (path == folder or below(path))}
+        self.symlinks = {path for path in self.symlinks if not below(path)}
+
+        pending: list = [folder]
+        while pending:
+            current: str = pending.pop(0)
+            try: directory = os.scandir(self.root.joinpath(current))
+            except FileNotFoundError: continue
+            if current: self.folders.add(current)
+            children: list = self._children.setdefault(current, [])
+            with directory:
+                for entry in directory:
+                    relative_path: str = f'{current}/{entry.name}' if current else entry.name
+                    children.append(entry.name)
+                    if entry.is_symlink(): self.symlinks.add(relative_path)
+                    elif entry.is_dir():
+                        if recursive: pending.append(relative_path)
+                        else: self.folders.add(relative_path)
+                    elif entry.is_file(): self.files[relative_path] = entry.stat()
+        # a folder that didn't exist when its parent was listed
+        parent, _, name = folder.rpartition('/')
+        if folder in self.folders and name not in self._children.setdefault(parent, []): self._children[parent].append(name)
+        self._find_outputs()
+        return None
+    def _find_outputs(self) -> None:
+        """ Finds the MiSeqOutput directory, the FASTQ directory and the Undetermined reads in what was listed. """
+        self.miseq_output = self.fastq_dir = self.undetermined = None
+        self.fastq_files = []
+        miseq_outputs: list = sorted([name for name in self._children.get('', []) if name in self.folders and name not in NOT_MISEQ_OUTPUT and is_miseq_output(name)])
+        if not miseq_outputs: return None
+        self.miseq_output = self.root.joinpath(miseq_outputs[0])
+
+        # the shallowest folder with FASTQ files (BaseCalls, or Alignment_*/*/Fastq of newer MiSeq Reporter versions)
+        fastq_dirs: set = {path.rpartition('/')[0] for path in self.files if path.startswith(f'{miseq_outputs[0]}/') and path.endswith(FASTQ_SUFFIX)}
+        if not fastq_dirs: return None
+        fastq_dir: str = min(fastq_dirs, key=lambda path: (path.count('/'), path))
+        self.fastq_dir = self.root.joinpath(fastq_dir)
+        self.fastq_files = self.files_in(fastq_dir, '*.fastq*')
+
+        undetermined: dict = {}
+        for file in self.files_in(fastq_dir, 'Undetermined*'):
+            # Undetermined_S0_L001_R1_001.fastq.gz
+            read_orientation: str = file.name.split('_')[3] if len(file.name.split('_')) > 3 else ''
+            if read_orientation in ('R1', 'R2'): undetermined[read_orientation] = file
+        if len(undetermined) == 2: self.undetermined = (undetermined['R1'], undetermined['R2'])
+        return None
+    def exists(self, path: str) -> bool:
+        """ Returns True if a path (relative to the run directory) was listed. """
+        return path in self.files or path in self.folders or path in self.symlinks
+    def files_in(self, folder: str, pattern: str = '*') -> list:
+        """ Returns the files directly in a folder (relative to the run directory) whose names match a glob pattern, sorted. """
+        prefix: str = f'{folder}/' if folder else ''
+        return [self.root.joinpath(f'{prefix}{name}') for name in sorted(self._children.get(folder, [])) if f'{prefix}{name}' in self.files and fnmatch.fnmatch(name, pattern)]
+    def files_below(self, folder: str) -> list:
+        """ Returns the paths (relative to the folder, sorted) of every file below a folder of the run directory. """
+        prefix: str = f'{folder}/' if folder else ''
+        return sorted([path[len(prefix):] for path in self.files if path.startswith(prefix)])
+    def size(self, folder: str = '') -> int:
+        """ Returns the bytes of every file below a folder of the run directory. """
+        prefix: str = f'{folder}/' if folder else ''
+        return sum([file_stat.st_size for path, file_stat in self.files.items() if path.startswith(prefix)])
+    def relative(self, path: Path) -> str:
+        """ Returns a path below the run directory as the relative path (str) the index uses. """
+        return path.relative_to(self.root).as_posix() if path != self.root else ''
+# --------------------------------------------------
+def is_miseq_output(name: str) -> bool:
+    """ Function checks whether a folder is named like a MiSeqOutput directory ({date}_{instrument}_{run}_{flowcell}). """
+    return all([
+        all([True if i in '0123456789' else False for i in name.split('_')[0]]),
+        len(name.split('_')) == 4,
+        len(name.split('-')) == 2])
@@ -0,0 +1,138 @@
+__description__ =\
+"""
+Purpose: Runs the stages of archive-ngs-run.py as a dependency graph, with independent stages running at the same time.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+import time
+import logging
+import threading
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+# --------------------------------------------------
+import profiling
+# --------------------------------------------------
+class Stage:
+    """
+    A step of the archive: a function, the stages it needs (depends) or only has to wait for (after), whether it's
+    CPU-heavy (and so gets a share of the threads) and an optional check that skips it, e.g. if its outputs exist.
+    """
+    def __init__(self, name: str, function, depends: tuple = (), after: tuple = (), cpu: bool = False, skip=None) -> None:
+        """
+        Parameters:
+            name: str
+                name of the stage, logged and used by other stages to depend on it
+            function: function
+                called without arguments, or with the number of threads it may use if cpu; its return value is kept in result
+            depends: tuple
+                stages that have to finish (or be skipped) first; if one of them fails, this stage is not run
+            after: tuple
+                stages that have to be over first, whether they succeeded or not
+            cpu: bool
+                if True, the stage gets a share of the threads, split between every CPU-heavy stage that isn't skipped
+            skip: function
+                called without arguments before anything runs, returns why the stage should be skipped (str) or None
+        """
+        self.name: str = name
+        self.function = function
+        self.depends: tuple = tuple(depends)
+        self.after: tuple = tuple(after)
+        self.cpu: bool = cpu
+        self.skip = skip
+        # pending, running, done, skipped, failed or blocked (a stage it depends on failed)
+        self.status: str = 'pending'
+        self.result = None
+        self.error: BaseException = None
+        self.threads: int = None
+        self.seconds: float = None
+        # what the stage used while it ran, see profiling.Profile
+        self.profile: profiling.Profile = profiling.Profile()
+    def _run(self):
+        """ Runs the stage in the current thread, named after it. """
+        threading.current_thread().name = self.name
+        start_time: float = time.perf_counter()
+        try:
+            with self.profile: return self.function(self.threads) if self.cpu else self.function()
+        finally: self.seconds = time.perf_counter() - start_time
+# --------------------------------------------------
+def run_stages(stages: list, threads: int) -> dict:
+    """
+    Function runs stages as soon as the stages they depend on are over, so stages that don't depend on each other
+    (e.g. copying the run and running fastqc) run at the same time. The threads are split evenly between the CPU-heavy
+    stages that aren't skipped. A stage that fails doesn't stop the others, only the stages that depend on it.
+
+    Parameters:
+        stages: list
+            every Stage to run
+        threads: int
+            number of threads the CPU-heavy stages share
+
+    Returns:
+        stages: dict
+            name of every stage: the Stage, with its status, result, error, seconds and profile
+
+    Raises ValueError if a stage depends on a stage that doesn't exist, or the stages depend on each other in a cycle.
+    """
+
+    by_name: dict = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for dependency in (*stage.depends, *stage.after):
+            if dependency not in by_name: raise ValueError(f"Stage {stage.name} depends on unknown stage {dependency}.")
+    _check_cycles(by_name)
+
+    for stage in stages:
+        reason: str = stage.skip() if stage.skip else None
+        if reason:
+            stage.status = 'skipped'
+            logging.warning(f"Skipping {stage.name}: {reason}")
+    cpu_stages: list = [stage for stage in stages if stage.cpu and stage.status == 'pending']
+    for stage in cpu_stages: stage.threads = max(1, threads // len(cpu_stages))
+
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        running: dict = {}
+        while True:
+            for stage in [stage for stage in stages if stage.status == 'pending']:
+                if any([by_name[dependency].status in ('failed', 'blocked') for dependency in stage.depends]):
+                    stage.status = 'blocked'
+                    logging.error(f"Not running {stage.name}, because {', '.join([dependency for dependency in stage.depends if by_name[dependency].status in ('failed', 'blocked')])} didn't finish.")
+                elif all([by_name[dependency].status in ('done', 'skipped', 'failed', 'blocked') for dependency in (*stage.depends, *stage.after)]):
+                    stage.status = 'running'
+                    logging.info(f"Starting {stage.name}{f' with {stage.threads} threads' if stage.cpu else ''} ...")
+                    # context variables (e.g. the run logged with every message) carry over to the stage
+                    running[executor.submit(copy_context().run, stage._run)] = stage
+            # stages blocked in this pass may unblock (or block) others
+            if any([stage.status == 'pending' and any([by_name[dependency].status == 'blocked' for dependency in stage.depends]) for stage in stages]): continue
+            if not running: break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage: Stage = running.pop(future)
+                try:
+                    stage.result = future.result()
+                    stage.status = 'done'
+                    logging.info(f"Finished {stage.name} in {stage.seconds:.1f} s.")
+                except BaseException as error:
+                    stage.status = 'failed'
+                    stage.error = error
+                    logging.error(f"{stage.name} failed after {stage.seconds:.1f} s: {error!r}")
+    for stage in stages: stage.profile.overlapped = [other.name for other in stages if other is not stage and stage.profile.overlaps(other.profile)]
+    return by_name
+def stage_profiles(by_name: dict) -> dict:
+    """
+    Function returns the profile of every stage run by run_stages(), for profiling.write_profile() and profiling.summary_table().
+
+    Returns:
+        profiles: dict
+            name of every stage: {"status": str, "threads": int, **profiling.Profile.as_dict()}
+    """
+    return {name: {'status': stage.status, 'threads': stage.threads, **stage.profile.as_dict()} for name, stage in by_name.items()}
+def _check_cycles(by_name: dict) -> None:
+    """ Function raises ValueError if the stages depend on each other in a cycle. """
+    remaining: dict = {name: set((*stage.depends, *stage.after)) for name, stage in by_name.items()}
+    while remaining:
+        ready: list = [name for name, dependencies in remaining.items() if not dependencies & set(remaining)]
+        if not ready: raise ValueError(f"Stages depend on each other in a cycle: {', '.join(sorted(remaining))}.")
+        for name in ready: del remaining[name]
+    return None
@@ -0,0 +1,751 @@
+__description__ =\
+"""
+Purpose: Copy engine shared by backup.py and archive-ngs-run.py.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import os
+import errno
+import shutil
+import hashlib
+import zlib
+import json
+import sqlite3
+import time
+import threading
+import contextvars
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, Future
+# --------------------------------------------------
+# size of the buffer each worker reads into, hashes and writes from
+COPY_BUFFER_SIZE: int = 1024 * 1024
+# files are copied to a temporary name and checkpointed every this many bytes so that an interrupted copy can be resumed
+RESUME_CHUNK_SIZE: int = 64 * 1024 * 1024
+PARTIAL_SUFFIX: str = '.partial'
+JOURNAL_SUFFIX: str = '.partial.json'
+# copy backends, in the order they're tried when the backend is "auto"
+KERNEL_BACKENDS: tuple = ('copy_file_range', 'sendfile')
+BACKENDS: tuple = ('auto', *KERNEL_BACKENDS, 'buffered')
+# errors that mean a kernel backend can't be used for this pair of files (rather than that the copy failed)
+UNSUPPORTED_ERRNOS: tuple = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+# modified files are compared with their existing copy in blocks of this size
+DELTA_BLOCK_SIZE: int = 16 * 1024
+# bytes of the signature of a block kept by SignatureCache: adler32 (4) and md5 (16)
+SIGNATURE_SIZE: int = 20
+ADLER32_MODULUS: int = 65521
+# after this much literal data in a row, the rolling search only checks block-aligned windows
+DELTA_SEARCH_LIMIT: int = 1024 * 1024
+# suffixes accepted by parse_rate() and parse_size(), as powers of 1024
+RATE_UNITS: dict = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# --------------------------------------------------
+class ChecksumMismatchError(RuntimeError):
+    """ Raised when a copy read back from the destination doesn't have the checksum of the source. """
+class RateLimiter:
+    """
+    Token bucket shared by every copy worker, limiting the total number of bytes sent per second.
+    An optional schedule changes the limit by time of day, e.g. to allow more bandwidth off-hours.
+    """
+    def __init__(self, max_rate: float = None, schedule: list = None) -> None:
+        """
+        Parameters:
+            max_rate: float
+                bytes per second outside of the schedule, None for unlimited
+            schedule: list
+                list of {"start": "HH:MM", "end": "HH:MM", "max_rate": rate} windows (see parse_rate()), the first
+                window that contains the current time wins; windows may wrap around midnight
+        """
+        self.max_rate: float = max_rate
+        self.schedule: list = [
+            (_parse_time(window['start']), _parse_time(window['end']), parse_rate(window['max_rate']))
+            for window in (schedule or [])]
+        self._tokens: float = 0.0
+        self._last_refill: float = time.monotonic()
+        self._lock = threading.Lock()
+    def current_rate(self) -> float:
+        """ Returns the limit in bytes per second right now, None for unlimited. """
+        now = datetime.now().time()
+        for start, end, max_rate in self.schedule:
+            if (start <= now < end) if start <= end else (now >= start or now < end): return max_rate
+        return self.max_rate
+    def consume(self, amount: int) -> None:
+        """ Blocks until amount bytes may be sent. """
+        max_rate: float = self.current_rate()
+        if not max_rate: return None
+        with self._lock:
+            now: float = time.monotonic()
+            # the bucket holds at most one second worth of tokens
+            self._tokens = min(max_rate, self._tokens + (now - self._last_refill) * max_rate) - amount
+            self._last_refill = now
+            deficit: float = -self._tokens
+        # sleep off whatever was borrowed, outside of the lock so that other workers queue up behind it
+        if deficit > 0: time.sleep(deficit / max_rate)
+        return None
+class WorkerPool:
+    """
+    Copy workers shared by several destinations (e.g. instruments backed up together).
+    Every destination gets an equal share of the queue, so one with many small files can't starve the others,
+    and the share of a destination that finishes goes to the ones that are still copying.
+    """
+    def __init__(self, workers: int = 1) -> None:
+        """
+        Parameters:
+            workers: int
+                number of files copied concurrently, by all destinations together
+        """
+        self.workers: int = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._destinations: int = 0
+        self._lock = threading.Lock()
+    def attach(self) -> None:
+        """ Registers a destination that will submit copies. """
+        with self._lock: self._destinations += 1
+        return None
+    def detach(self) -> None:
+        """ Unregisters a destination once it has submitted all of its copies. """
+        with self._lock: self._destinations -= 1
+        return None
+    def max_pending(self) -> int:
+        """ Returns how many copies a destination may have queued or running at once. """
+        with self._lock: return max(1, self.workers * 2 // max(1, self._destinations))
+    def submit(self, function, *args) -> Future:
+        """ Submits a copy, context variables (e.g. the instrument logged with every message) carry over to the worker. """
+        return self._executor.submit(contextvars.copy_context().run, function, *args)
+    def shutdown(self) -> None:
+        """ Waits for every submitted copy and stops the workers. """
+        self._executor.shutdown(wait=True)
+        return None
+class SignatureCache:
+    """
+    Block signatures of the copies brought up to date by sync_file(), kept in a local SQLite database so the next sync
+    of a file doesn't have to read its copy back from the destination (on a network share that costs as much as sending
+    the file again). A signature is only used while the copy still has the size and mtime it had when it was written.
+    """
+    def __init__(self, database_path: Path) -> None:
+        """
+        Parameters:
+            database_path: Path
+                SQLite database of the signatures, created if it doesn't exist
+        """
+        # shared by every copy worker, one at a time
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS block_signatures (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, block_size INTEGER, blocks BLOB)')
+        self._connection.commit()
+        self._lock = threading.Lock()
+    def lookup(self, file: Path, file_stat: os.stat_result, block_size: int) -> dict:
+        """ Returns the signatures of a copy (see _block_signatures()), None if they aren't known for its size and mtime. """
+        with self._lock: row: tuple = self._connection.execute(
+            'SELECT blocks FROM block_signatures WHERE path = ? AND size = ? AND mtime_ns = ? AND block_size = ?',
+            (str(file), file_stat.st_size, file_stat.st_mtime_ns, block_size)).fetchone()
+        if row is None: return None
+        signatures: dict = {}
+        blocks: bytes = row[0]
+        for block_index, offset in enumerate(range(0, len(blocks), SIGNATURE_SIZE)):
+            block_length: int = min(block_size, file_stat.st_size - block_index * block_size)
+            signatures.setdefault(int.from_bytes(blocks[offset:offset + 4], 'big'), {}).setdefault((block_length, blocks[offset + 4:offset + SIGNATURE_SIZE]), block_index)
+        return signatures
+    def record(self, file: Path, file_stat: os.stat_result, block_size: int, blocks: bytes) -> None:
+        """ Saves the signatures of a copy: the adler32 (4 bytes, big-endian) and md5 of every block, one after the other. """
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO block_signatures VALUES (?, ?, ?, ?, ?)',
+                (str(file), file_stat.st_size, file_stat.st_mtime_ns, block_size, blocks))
+            self._connection.commit()
+        return None
+    def close(self) -> None:
+        """ Closes the database. """
+        with self._lock: self._connection.close()
+        return None
+# --------------------------------------------------
+def parse_rate(rate) -> float:
+    """
+    Function parses a transfer rate.
+
+    Parameters:
+        rate: str, int or None
+            bytes per second, optionally with a K/M/G suffix (powers of 1024), e.g. "20M"; 0, "0" or None for unlimited
+
+    Returns:
+        (float): bytes per second, None for unlimited
+    """
+
+    if rate is None: return None
+    return parse_size(str(rate).strip().upper().removesuffix('/S')) or None
+def parse_size(size) -> float:
+    """
+    Function parses a number of bytes.
+
+    Parameters:
+        size: str or int
+            bytes, optionally with a K/M/G suffix (powers of 1024), e.g. "64K"
+
+    Returns:
+        (float): bytes
+    """
+
+    size = str(size).strip().upper().removesuffix('B')
+    unit: str = size[-1] if size and size[-1] in RATE_UNITS else ''
+    value: float = float(size[:len(size) - len(unit)]) * RATE_UNITS[unit]
+    if value < 0: raise ValueError(f"size can't be negative: {size}")
+    return value
+def _parse_time(value: str):
+    """ Function parses a HH:MM time of day. """
+    return datetime.strptime(value, '%H:%M').time()
+def lower_priority() -> None:
+    """
+    Function lowers the CPU priority (nice 10) and I/O priority (idle class, through ionice) of this process
+    so that it only gets the disk and CPU when nothing else wants them. Threads and child processes started
+    afterwards inherit both.
+
+    Parameters:
+        None
+
+    Returns:
+        None
+    """
+
+    if hasattr(os, 'nice'): os.nice(10)
+    try: subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError): pass
+    return None
+# --------------------------------------------------
+def copy_file(source_file: Path, destination_file: Path, algorithm: str = 'md5', verify: bool = False, backend: str = 'auto', limiter: RateLimiter = None) -> tuple:
+    """
+    Function copies a single file (and all of its metadata, like shutil.copy2) from the source to the destination.
+    The file is written to a temporary name and only renamed into place once it is complete, so a crash never leaves
+    a truncated file at the destination path.
+
+    The buffered backend computes the checksum from the same buffers that are written, so the source is only read
+    once; files larger than RESUME_CHUNK_SIZE are checkpointed in a journal beside the temporary file, and an
+    interrupted copy is resumed from its last checkpoint. The kernel backends (copy_file_range, sendfile) never
+    bring the data into userspace, so the checksum (if any) is computed by reading the finished copy back (and, to
+    verify it, the source as well); "auto" only tries them when no checksum is needed. Each backend falls back to the next one per file if the kernel or
+    filesystem doesn't support it.
+
+    Parameters:
+        source_file: Path
+            path of the file to copy
+        destination_file: Path
+            path of the copy
+        algorithm: str
+            name of the hashlib algorithm used for the checksum, or None to skip the checksum
+        verify: bool
+            if True, read the copy back from the destination and compare its checksum
+        backend: str
+            one of BACKENDS
+        limiter: RateLimiter
+            optional limit on the bytes sent per second
+
+    Returns:
+        (tuple): (digest, backend)
+            digest: hex digest of the source file, or None if no algorithm was given
+            backend: name of the backend that actually copied the file
+    """
+
+    partial_file, journal_file = partial_paths(destination_file)
+    # parent should already exist, but don't let a file land in a missing folder
+    destination_file.parent.mkdir(parents=True, exist_ok=True)
+
+    if backend == 'auto': backends: list = [*KERNEL_BACKENDS, 'buffered'] if algorithm is None else ['buffered']
+    elif backend in KERNEL_BACKENDS: backends: list = list(KERNEL_BACKENDS[KERNEL_BACKENDS.index(backend):]) + ['buffered']
+    else: backends: list = ['buffered']
+
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    use_journal: bool = False
+    digest: str = None
+
+    try:
+        with open(source_file, 'rb') as source:
+            source_stat = os.fstat(source.fileno())
+            use_journal = source_stat.st_size > RESUME_CHUNK_SIZE and backends == ['buffered']
+            for used_backend in backends:
+                if used_backend == 'buffered':
+                    digest = _buffered_copy(source, source_stat, partial_file, journal_file, use_journal, algorithm, buffer, limiter)
+                    break
+                if _kernel_copy(used_backend, source, source_stat.st_size, partial_file, limiter): break
+    except:
+        # small files are just started over, so don't leave their temporary file lying around
+        if not use_journal: partial_file.unlink(missing_ok=True)
+        raise
+
+    shutil.copystat(source_file, partial_file)
+    os.replace(partial_file, destination_file)
+    if use_journal: journal_file.unlink(missing_ok=True)
+
+    # kernel backends never saw the data, so the copy has to be read back to get its checksum, and with verify the
+    # source too, since the digest of the copy alone can't tell whether it matches
+    if used_backend != 'buffered' and algorithm is not None:
+        destination_digest: str = hash_file(destination_file, algorithm, buffer)
+        digest = hash_file(source_file, algorithm, buffer) if verify else destination_digest
+    elif verify and algorithm is not None: destination_digest: str = hash_file(destination_file, algorithm, buffer)
+    if verify and algorithm is not None:
+        if destination_digest != digest:
+            # remove the bad copy so that the next run doesn't think it's already backed up
+            destination_file.unlink()
+            raise ChecksumMismatchError(f"checksum mismatch, {digest} in the input but {destination_digest} in the destination")
+
+    return (digest, used_backend)
+def _buffered_copy(source, source_stat: os.stat_result, partial_file: Path, journal_file: Path, use_journal: bool, algorithm: str, buffer: bytearray, limiter: RateLimiter = None) -> str:
+    """
+    Function copies an open file into a temporary file through a userspace buffer, hashing as it goes.
+
+    Parameters:
+        source: file
+            source file, opened for reading at the start
+        source_stat: os.stat_result
+            stat of the source file
+        partial_file: Path
+            temporary file in the destination
+        journal_file: Path
+            resume journal of the temporary file
+        use_journal: bool
+            if True, checkpoint the copy in the journal and resume from an earlier checkpoint if possible
+        algorithm: str
+            name of the hashlib algorithm used for the checksum, or None to skip the checksum
+        buffer: bytearray
+            buffer to read into, hash and write from
+        limiter: RateLimiter
+            optional limit on the bytes sent per second
+
+    Returns:
+        digest: str
+            hex digest of the source file, or None if no algorithm was given
+    """
+
+    checksum = hashlib.new(algorithm) if algorithm is not None else None
+    view = memoryview(buffer)
+    journal: dict = {'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns, 'chunk_size': RESUME_CHUNK_SIZE, 'chunks': []}
+
+    # pick up where an interrupted copy left off
+    offset: int = 0
+    if use_journal: offset, checksum = _resume_partial(source, partial_file, journal_file, journal, checksum, buffer)
+
+    with open(partial_file, 'r+b' if offset else 'wb') as destination:
+        destination.seek(offset)
+        destination.truncate()
+        chunk_checksum: int = 0
+        # reads never cross a checkpoint
+        while read_size := source.readinto(view[:RESUME_CHUNK_SIZE - offset % RESUME_CHUNK_SIZE]):
+            if checksum is not None: checksum.update(view[:read_size])
+            if use_journal: chunk_checksum = zlib.crc32(view[:read_size], chunk_checksum)
+            if limiter: limiter.consume(read_size)
+            destination.write(view[:read_size])
+            offset += read_size
+
+            # checkpoint: only record the chunk once it has actually made it to the destination
+            if use_journal and offset % RESUME_CHUNK_SIZE == 0:
+                destination.flush()
+                os.fsync(destination.fileno())
+                journal['chunks'].append(chunk_checksum)
+                _write_journal(journal_file, journal)
+                chunk_checksum = 0
+
+    return checksum.hexdigest() if checksum is not None else None
+def _kernel_copy(backend: str, source, size: int, partial_file: Path, limiter: RateLimiter = None) -> bool:
+    """
+    Function copies an open file into a temporary file without the data passing through userspace.
+
+    Parameters:
+        backend: str
+            "copy_file_range" or "sendfile"
+        source: file
+            source file, opened for reading at the start
+        size: int
+            size of the source file
+        partial_file: Path
+            temporary file in the destination
+        limiter: RateLimiter
+            optional limit on the bytes sent per second, kernel copies are then split into COPY_BUFFER_SIZE pieces
+
+    Returns:
+        (bool): True if the file was copied, False if this backend isn't supported for these files
+    """
+
+    if not hasattr(os, backend): return False
+    source_fd: int = source.fileno()
+    offset: int = 0
+    with open(partial_file, 'wb') as destination:
+        destination_fd: int = destination.fileno()
+        try:
+            while offset < size:
+                count: int = min(COPY_BUFFER_SIZE if limiter else RESUME_CHUNK_SIZE, size - offset)
+                if limiter: limiter.consume(count)
+                if backend == 'copy_file_range': copied: int = os.copy_file_range(source_fd, destination_fd, count, offset, offset)
+                else: copied: int = os.sendfile(destination_fd, source_fd, offset, count)
+                # the file shrank while it was being copied
+                if not copied: break
+                offset += copied
+        except OSError as error:
+            # only fall back if nothing has been copied yet, otherwise this is a real failure
+            if offset == 0 and error.errno in UNSUPPORTED_ERRNOS: return False
+            raise
+    return True
+def partial_paths(destination_file: Path) -> tuple:
+    """
+    Function gives the paths of the temporary file and resume journal used while copying a file.
+
+    Parameters:
+        destination_file: Path
+            final path of the file in the destination
+
+    Returns:
+        (tuple): (temporary file, journal file), both hidden beside the final path
+    """
+
+    return (
+        destination_file.with_name(f".{destination_file.name}{PARTIAL_SUFFIX}"),
+        destination_file.with_name(f".{destination_file.name}{JOURNAL_SUFFIX}"))
+def is_partial(name: str) -> bool:
+    """ Function checks whether a file name is a temporary file or resume journal left by copy_file(). """
+    return name.startswith('.') and name.endswith((PARTIAL_SUFFIX, JOURNAL_SUFFIX, f"{JOURNAL_SUFFIX}.tmp"))
+def _resume_partial(source, partial_file: Path, journal_file: Path, journal: dict, checksum, buffer: bytearray) -> tuple:
+    """
+    Function finds the offset an interrupted copy can be resumed from.
+    Checkpointed chunks are only trusted if the source file hasn't changed since: the source is re-read
+    (locally) up to the last checkpoint and compared with the checksum of every chunk, so the destination
+    never has to be read back.
+
+    Parameters:
+        source: file
+            source file, opened for reading at the start; left positioned at the returned offset
+        partial_file: Path
+            temporary file in the destination
+        journal_file: Path
+            resume journal of the temporary file
+        journal: dict
+            journal of the current copy, verified chunks are added to it
+        checksum: hashlib object
+            checksum of the whole file so far, or None
+        buffer: bytearray
+            buffer to reuse for reading
+
+    Returns:
+        (tuple): (offset, checksum)
+            offset: number of bytes that are already correct in the temporary file, 0 to start over
+            checksum: checksum of the whole file up to the offset
+    """
+
+    if not (partial_file.exists() and journal_file.exists()): return (0, checksum)
+    try:
+        with open(journal_file) as previous_journal_file: previous_journal: dict = json.load(previous_journal_file)
+    except (OSError, ValueError):
+        return (0, checksum)
+    if any([previous_journal.get(key) != journal[key] for key in ('size', 'mtime_ns', 'chunk_size')]): return (0, checksum)
+
+    view = memoryview(buffer)
+    # never trust more than what is actually in the temporary file
+    checkpointed_num: int = min(len(previous_journal.get('chunks', [])), partial_file.stat().st_size // RESUME_CHUNK_SIZE)
+    for chunk_num in range(checkpointed_num):
+        chunk_hasher = checksum.copy() if checksum is not None else None
+        chunk_checksum: int = 0
+        remaining: int = RESUME_CHUNK_SIZE
+        while remaining:
+            read_size: int = source.readinto(view[:min(remaining, len(buffer))])
+            if not read_size: break
+            if chunk_hasher is not None: chunk_hasher.update(view[:read_size])
+            chunk_checksum = zlib.crc32(view[:read_size], chunk_checksum)
+            remaining -= read_size
+        if remaining or chunk_checksum != previous_journal['chunks'][chunk_num]: break
+        # only keep the chunk once it's known to be good
+        checksum = chunk_hasher
+        journal['chunks'].append(chunk_checksum)
+
+    offset: int = len(journal['chunks']) * RESUME_CHUNK_SIZE
+    source.seek(offset)
+    return (offset, checksum)
+def _write_journal(journal_file: Path, journal: dict) -> None:
+    """
+    Function atomically replaces the resume journal of a temporary file.
+
+    Parameters:
+        journal_file: Path
+            resume journal of the temporary file
+        journal: dict
+            journal to write
+
+    Returns:
+        None
+    """
+
+    temporary_journal_file: Path = journal_file.with_name(f"{journal_file.name}.tmp")
+    with open(temporary_journal_file, 'w') as opened_journal_file: json.dump(journal, opened_journal_file)
+    os.replace(temporary_journal_file, journal_file)
+    return None
+def hash_file(file: Path, algorithm: str = 'md5', buffer: bytearray = None) -> str:
+    """
+    Function computes the checksum of a single file.
+
+    Parameters:
+        file: Path
+            path of the file
+        algorithm: str
+            name of the hashlib algorithm used for the checksum
+        buffer: bytearray
+            optional buffer to reuse for reading
+
+    Returns:
+        digest: str
+            hex digest of the file
+    """
+
+    checksum = hashlib.new(algorithm)
+    buffer = buffer if buffer is not None else bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(file, 'rb') as opened_file:
+        while read_size := opened_file.readinto(buffer):
+            checksum.update(view[:read_size])
+    return checksum.hexdigest()
+def sync_file(source_file: Path, destination_file: Path, algorithm: str = 'md5', verify: bool = False, block_size: int = DELTA_BLOCK_SIZE, limiter: RateLimiter = None, signature_cache: SignatureCache = None) -> tuple:
+    """
+    Function brings an existing copy up to date by only sending the blocks that changed, rsync-style.
+    The existing copy is split into blocks and each block gets a weak (rolling adler32) and strong (md5) checksum.
+    The source is then read once with a rolling window: windows that match a block of the existing copy are
+    cloned from it (copy_file_range, which SMB3/NFS 4.2 can do on the server), everything else is written as
+    literal data. After DELTA_SEARCH_LIMIT bytes of literal data in a row the window jumps a whole block at a time,
+    which keeps large appended or rewritten regions fast. The new file is built under a temporary name and renamed
+    into place, like copy_file(). With a signature cache, the signatures of the existing copy are taken from it when
+    the copy hasn't changed since it was synced, and the signatures of the new copy are computed from the source as
+    it's read and saved to it, so only the first sync of a file reads its existing copy.
+
+    Parameters:
+        source_file: Path
+            path of the modified file
+        destination_file: Path
+            path of the existing, out of date, copy
+        algorithm: str
+            name of the hashlib algorithm used for the checksum, or None to skip the checksum
+        verify: bool
+            if True, read the copy back from the destination and compare its checksum
+        block_size: int
+            size of the blocks the existing copy is split into
+        limiter: RateLimiter
+            optional limit on the bytes sent per second, only literal data counts
+        signature_cache: SignatureCache
+            optional local cache of the signatures of the copies
+
+    Returns:
+        (tuple): (digest, literal_bytes, matched_bytes)
+            digest: hex digest of the source file, or None if no algorithm was given
+            literal_bytes: number of bytes that had to be sent
+            matched_bytes: number of bytes reused from the existing copy
+    """
+
+    partial_file, _ = partial_paths(destination_file)
+    checksum = hashlib.new(algorithm) if algorithm is not None else None
+    destination_stat: os.stat_result = destination_file.stat()
+    signatures: dict = signature_cache.lookup(destination_file, destination_stat, block_size) if signature_cache else None
+    if signatures is None: signatures = _block_signatures(destination_file, block_size)
+    tail_size: int = destination_stat.st_size % block_size
+    # signatures of the new copy (see SignatureCache.record()), and the data of the block that hasn't been read whole yet
+    new_blocks: bytearray = bytearray()
+    new_block: bytes = b''
+
+    literal_bytes: int = 0
+    matched_bytes: int = 0
+    # run of blocks waiting to be cloned from the existing copy: [offset in existing copy, length]
+    pending_match: list = None
+
+    try:
+        with open(source_file, 'rb') as source, open(destination_file, 'rb') as existing, open(partial_file, 'wb') as destination:
+            def _flush_match() -> None:
+                nonlocal pending_match
+                if pending_match:
+                    _clone_range(existing, destination, *pending_match)
+                    pending_match = None
+                return None
+            def _write_literal(_data) -> None:
+                nonlocal literal_bytes
+                if _data:
+                    _flush_match()
+                    if limiter: limiter.consume(len(_data))
+                    destination.write(_data)
+                    literal_bytes += len(_data)
+                return None
+            def _add_match(_offset: int, _length: int) -> None:
+                nonlocal pending_match, matched_bytes
+                if pending_match and pending_match[0] + pending_match[1] == _offset: pending_match[1] += _length
+                else:
+                    _flush_match()
+                    pending_match = [_offset, _length]
+                matched_bytes += _length
+                return None
+            def _read_more() -> bytes:
+                nonlocal new_block
+                chunk: bytes = source.read(COPY_BUFFER_SIZE)
+                if checksum is not None: checksum.update(chunk)
+                if signature_cache:
+                    new_block += chunk
+                    blocks_end: int = len(new_block) - len(new_block) % block_size if chunk else len(new_block)
+                    for block_start in range(0, blocks_end, block_size): new_blocks.extend(_block_signature(new_block[block_start:block_start + block_size]))
+                    new_block = new_block[blocks_end:]
+                return chunk
+
+            data: bytes = _read_more()
+            at_end: bool = not data
+            # data[literal_start:position] is literal data that hasn't been written yet
+            literal_start: int = 0
+            position: int = 0
+            weak: int = None
+            # offset of data[0] in the source, and where the current run of literal data started
+            data_offset: int = 0
+            literal_run_start: int = 0
+            while True:
+                # keep a whole block in the window, dropping what's already been handled
+                if len(data) - position < block_size and not at_end:
+                    _write_literal(data[literal_start:position])
+                    chunk: bytes = _read_more()
+                    at_end = not chunk
+                    data = data[position:] + chunk
+                    data_offset += position
+                    literal_start = position = 0
+                    weak = None
+                    continue
+
+                if len(data) - position < block_size:
+                    # end of the file: the only block left to match is the (shorter) last block of the existing copy
+                    if tail_size and len(data) - position >= tail_size:
+                        tail_start: int = len(data) - tail_size
+                        tail: bytes = data[tail_start:]
+                        block_index: int = signatures.get(zlib.adler32(tail), {}).get((tail_size, hashlib.md5(tail).digest()))
+                        if block_index is not None:
+                            _write_literal(data[literal_start:tail_start])
+                            _add_match(block_index * block_size, tail_size)
+                            literal_start = len(data)
+                    position = len(data)
+                    break
+
+                if weak is None: weak = zlib.adler32(data[position:position + block_size])
+                block_index: int = None
+                if weak in signatures: block_index = signatures[weak].get((block_size, hashlib.md5(data[position:position + block_size]).digest()))
+
+                if block_index is not None:
+                    _write_literal(data[literal_start:position])
+                    _add_match(block_index * block_size, block_size)
+                    position += block_size
+                    literal_start = position
+                    literal_run_start = data_offset + position
+                    weak = None
+                elif data_offset + position - literal_run_start >= DELTA_SEARCH_LIMIT:
+                    # long run of new data (appended or rewritten): stop searching byte by byte and jump a block at a time
+                    position += block_size
+                    weak = None
+                elif position + block_size < len(data):
+                    # roll the window one byte forward
+                    weak = _roll_adler32(weak, data[position], data[position + block_size], block_size)
+                    position += 1
+                else:
+                    # the next byte hasn't been read yet
+                    position += 1
+                    weak = None
+
+            _write_literal(data[literal_start:position])
+            _flush_match()
+    except:
+        partial_file.unlink(missing_ok=True)
+        raise
+
+    shutil.copystat(source_file, partial_file)
+    os.replace(partial_file, destination_file)
+    digest: str = checksum.hexdigest() if checksum is not None else None
+
+    if verify and algorithm is not None:
+        destination_digest: str = hash_file(destination_file, algorithm)
+        if destination_digest != digest:
+            # remove the bad copy so that the next run doesn't think it's already backed up
+            destination_file.unlink()
+            raise ChecksumMismatchError(f"checksum mismatch, {digest} in the input but {destination_digest} in the destination")
+
+    if signature_cache: signature_cache.record(destination_file, destination_file.stat(), block_size, bytes(new_blocks))
+    return (digest, literal_bytes, matched_bytes)
+def _block_signatures(file: Path, block_size: int) -> dict:
+    """
+    Function computes the weak and strong checksum of every block of a file.
+
+    Parameters:
+        file: Path
+            path of the file
+        block_size: int
+            size of the blocks, the last block may be shorter
+
+    Returns:
+        signatures: dict
+            weak checksum: {(block length, strong checksum): block index}
+    """
+
+    signatures: dict = {}
+    with open(file, 'rb') as opened_file:
+        block_index: int = 0
+        while block := opened_file.read(block_size):
+            # keep the first block if the same block appears more than once
+            signatures.setdefault(zlib.adler32(block), {}).setdefault((len(block), hashlib.md5(block).digest()), block_index)
+            block_index += 1
+    return signatures
+def _block_signature(block: bytes) -> bytes:
+    """ Function returns the signature of a block kept by SignatureCache: its adler32 (4 bytes, big-endian) and md5. """
+    return zlib.adler32(block).to_bytes(4, 'big') + hashlib.md5(block).digest()
+def _roll_adler32(weak: int, byte_out: int, byte_in: int, window_size: int) -> int:
+    """
+    Function slides an adler32 checksum one byte forward.
+
+    Parameters:
+        weak: int
+            adler32 of the current window
+        byte_out: int
+            byte leaving the window
+        byte_in: int
+            byte entering the window
+        window_size: int
+            size of the window
+
+    Returns:
+        (int): adler32 of the next window
+    """
+
+    a: int = ((weak & 0xffff) - byte_out + byte_in) % ADLER32_MODULUS
+    b: int = ((weak >> 16) - window_size * byte_out + a - 1) % ADLER32_MODULUS
+    return (b << 16) | a
+def _clone_range(existing, destination, offset: int, length: int) -> None:
+    """
+    Function appends a range of an existing file to an open destination file, in the kernel when possible.
+
+    Parameters:
+        existing: file
+            existing copy, opened for reading
+        destination: file
+            new file, opened for writing and positioned at its end
+        offset: int
+            start of the range in the existing copy
+        length: int
+            length of the range
+
+    Returns:
+        None
+    """
+
+    destination.flush()
+    destination_offset: int = destination.tell()
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while length:
+                copied: int = os.copy_file_range(existing.fileno(), destination.fileno(), length, offset, destination_offset)
+                if not copied: raise OSError(errno.EIO, "existing copy is shorter than expected")
+                offset += copied
+                destination_offset += copied
+                length -= copied
+            destination.seek(destination_offset)
+            return None
+        except OSError as error:
+            if error.errno not in UNSUPPORTED_ERRNOS: raise
+            destination.seek(destination_offset)
+    # fall back to reading the range back
+    existing.seek(offset)
+    while length:
+        chunk: bytes = existing.read(min(length, COPY_BUFFER_SIZE))
+        if not chunk: raise OSError(errno.EIO, "existing copy is shorter than expected")
+        destination.write(chunk)
+        length -= len(chunk)
+    return None
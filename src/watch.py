@@ -0,0 +1,156 @@
+__description__ =\
+"""
+Purpose: Watchers that report which paths below a folder changed, used by backup.py --watch.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comments__ = "stable enough"
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import os
+import sys
+import errno
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
+# --------------------------------------------------
+# inotify event flags, see inotify(7)
+IN_MODIFY: int = 0x00000002
+IN_ATTRIB: int = 0x00000004
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+IN_DELETE_SELF: int = 0x00000400
+IN_Q_OVERFLOW: int = 0x00004000
+IN_IGNORED: int = 0x00008000
+IN_ONLYDIR: int = 0x01000000
+IN_ISDIR: int = 0x40000000
+IN_CLOEXEC: int = 0o2000000
+WATCH_MASK: int = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_BUFFER_SIZE: int = 64 * 1024
+# --------------------------------------------------
+class InotifyWatcher:
+    """
+    Watches every folder below a root with inotify (Linux), so the cost of waiting for changes only depends on what changed.
+    Changes made by other machines to a network share are not seen, use PollingWatcher for those.
+    """
+    method: str = 'inotify'
+    def __init__(self, root: Path) -> None:
+        """
+        Parameters:
+            root: Path
+                folder to watch, paths are reported relative to it
+
+        Raises OSError (or AttributeError without inotify in the C library) if inotify isn't available or there aren't
+        enough watches (fs.inotify.max_user_watches) for the tree.
+        """
+        self.root: Path = root
+        self.overflowed: bool = False
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd: int = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0: raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # watch descriptor: path of the watched folder, relative to the root
+        self._watches: dict = {}
+        try: self._add_tree(Path(''))
+        except OSError:
+            self.close()
+            raise
+    def changes(self, timeout: float) -> set:
+        """
+        Waits up to timeout seconds for changes and returns the paths (relative to the root) that were created or modified.
+        Everything inside a folder that was created or moved in is returned as well. If the kernel dropped events,
+        overflowed is set and the whole tree should be checked again.
+        """
+        changed: set = set()
+        readable, _, _ = select.select([self._fd], [], [], max(0.0, timeout))
+        if not readable: return changed
+        data: bytes = os.read(self._fd, EVENT_BUFFER_SIZE)
+        offset: int = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            name: str = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b'\0').decode(sys.getfilesystemencoding(), 'surrogateescape')
+            offset += EVENT_HEADER.size + name_length
+
+            if mask & IN_Q_OVERFLOW: self.overflowed = True
+            if mask & IN_IGNORED: self._watches.pop(wd, None)
+            if wd not in self._watches or not name: continue
+            path: Path = self._watches[wd].joinpath(name)
+            changed.add(path)
+            # new folders may already have files in them by the time they're watched
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try: changed.update(self._add_tree(path))
+                except FileNotFoundError: pass
+        return changed
+    def _add_tree(self, folder: Path) -> list:
+        """ Watches a folder and every folder below it, returns every path found below it. """
+        found: list = []
+        wd: int = self._libc.inotify_add_watch(self._fd, os.fsencode(self.root.joinpath(folder)), WATCH_MASK)
+        if wd < 0:
+            error: int = ctypes.get_errno()
+            raise OSError(error, f"{os.strerror(error)}{' (raise fs.inotify.max_user_watches)' if error == errno.ENOSPC else ''}", str(self.root.joinpath(folder)))
+        self._watches[wd] = folder
+        with os.scandir(self.root.joinpath(folder)) as directory:
+            for entry in directory:
+                found.append(folder.joinpath(entry.name))
+                if entry.is_dir(follow_symlinks=False): found.extend(self._add_tree(folder.joinpath(entry.name)))
+        return found
+    def close(self) -> None:
+        """ Stops watching. """
+        os.close(self._fd)
+        return None
+class PollingWatcher:
+    """
+    Checks the tree below a root for changes every poll_interval seconds, for systems (or network shares) without inotify.
+    Only what changed since the previous check is reported: files modified after the high-water mark (the time the
+    previous check started), and everything in folders whose entries changed since then (this catches files that were
+    moved or copied in with an older modification time). Nothing is kept per file, however big the tree is.
+    """
+    method: str = 'polling'
+    def __init__(self, root: Path, poll_interval: float = 30.0) -> None:
+        """
+        Parameters:
+            root: Path
+                folder to watch, paths are reported relative to it
+            poll_interval: float
+                seconds between checks of the tree
+        """
+        self.root: Path = root
+        self.poll_interval: float = poll_interval
+        self.overflowed: bool = False
+        self._high_water_mark: float = time.time()
+        self._next_poll: float = time.monotonic() + poll_interval
+    def changes(self, timeout: float) -> set:
+        """ Waits up to timeout seconds, checking the tree if it's time to, and returns the paths (relative to the root) that were created or modified. """
+        wait: float = min(max(0.0, timeout), self._next_poll - time.monotonic())
+        if wait > 0: time.sleep(wait)
+        if time.monotonic() < self._next_poll: return set()
+
+        poll_started: float = time.time()
+        changed: set = set()
+        try: root_changed: bool = self.root.stat().st_mtime >= self._high_water_mark
+        except FileNotFoundError: root_changed = False
+        self._check_folder(Path(''), root_changed, changed)
+        self._high_water_mark = poll_started
+        self._next_poll = time.monotonic() + self.poll_interval
+        return changed
+    def _check_folder(self, folder: Path, folder_changed: bool, changed: set) -> None:
+        """ Adds the paths in a folder (and below it) that changed since the high-water mark. """
+        try: directory = os.scandir(self.root.joinpath(folder))
+        except FileNotFoundError: return None
+        with directory:
+            for entry in directory:
+                path: Path = folder.joinpath(entry.name)
+                try: entry_stat: os.stat_result = entry.stat(follow_symlinks=False)
+                except FileNotFoundError: continue
+                entry_changed: bool = entry_stat.st_mtime >= self._high_water_mark
+                if folder_changed or entry_changed: changed.add(path)
+                if entry.is_dir(follow_symlinks=False): self._check_folder(path, entry_changed, changed)
+        return None
+    def close(self) -> None:
+        """ Stops watching. """
+        return None